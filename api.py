@@ -0,0 +1,262 @@
+import os
+import json
+import asyncio
+import logging
+from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
+from web3 import Web3
+from utils import pipeline
+from utils.executor import BoundedExecutor, ExecutorFull
+from utils.model_registry import registry
+
+# JSON API under /api/v1, the HTML UI in main.py is a client of it.
+#
+# Contracts are given in the request body rather than the URL, RPC URLs often carry an API key. Lists that can get
+# large (instructions, blocks, edges) are paginated with `offset` and `limit`. With `"stream": true`, or when the
+# client accepts application/x-ndjson, they are streamed as one JSON object per line instead, the total number of
+# items is in the X-Total-Count header. The .dot export is streamed from disk as text.
+router = APIRouter(prefix="/api/v1")
+
+logger = logging.getLogger(__name__)
+
+# CFG recovery and inference run in here, so that they don't block the event loop
+executor = BoundedExecutor()
+
+# Items returned per page if the request doesn't set a limit, and the most it may ask for
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+# Items written per chunk of a streamed response
+STREAM_CHUNK_SIZE = 256
+# Contracts scored per step of a streamed batch audit, results are sent as soon as their step is done
+STREAM_AUDIT_CHUNK_SIZE = 16
+
+NDJSON = "application/x-ndjson"
+
+class ContractRequest(BaseModel):
+    contract_address: str
+    rpc_url: str
+
+class PageRequest(ContractRequest):
+    offset: int = Field(0, ge=0)
+    limit: Optional[int] = Field(None, ge=0)
+    stream: bool = False
+
+class AuditRequest(ContractRequest):
+    token_type: str
+
+class BatchAuditRequest(BaseModel):
+    contract_addresses: List[str]
+    rpc_url: str
+    token_type: str
+    stream: bool = False
+
+def validate_contract_address(contract_address):
+    if not Web3.is_address(contract_address):
+        error = 'Invalid contract address.'
+        return False, error
+    return True, None
+
+def validate_rpc_url(rpc_url):
+    if not rpc_url:
+        error = 'RPC URL is required.'
+        return False, error
+    return True, None
+
+# Run `fn(*args)` in the executor, analyses that are turned away or take too long are reported with their own status
+# codes, so clients can retry
+async def run_analysis(fn, *args):
+    try:
+        return await executor.run(fn, *args)
+    except ExecutorFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="The analysis took too long, try again later.")
+
+def validate_token_type(token_type):
+    try:
+        registry.model_dir(token_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Validate the contract and fetch its code. Returns the code hash and the bytecode, raises an HTTPException if the
+# request is invalid or there is no code at the address.
+async def fetch_contract(contract_address, rpc_url):
+    valid_address, address_error = validate_contract_address(contract_address)
+    if not valid_address:
+        raise HTTPException(status_code=400, detail=address_error)
+    valid_rpc, rpc_error = validate_rpc_url(rpc_url)
+    if not valid_rpc:
+        raise HTTPException(status_code=400, detail=rpc_error)
+
+    try:
+        code_hash, bytecode = await pipeline.fetch_bytecode_async(contract_address, rpc_url)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Error scraping bytecode: {e}")
+    if bytecode is None:
+        raise HTTPException(status_code=404, detail="No bytecode found for the contract address.")
+    return code_hash, bytecode
+
+def wants_stream(request, page):
+    return page.stream or NDJSON in request.headers.get("accept", "")
+
+# The start and stop index of the requested page, stop is None if the rest of the items is streamed
+def page_bounds(page, streamed):
+    if page.limit is not None:
+        limit = page.limit if streamed else min(page.limit, MAX_PAGE_SIZE)
+    else:
+        limit = None if streamed else DEFAULT_PAGE_SIZE
+    return page.offset, page.offset + limit if limit is not None else None
+
+def stream_items(items, total):
+    async def lines():
+        for offset in range(0, len(items), STREAM_CHUNK_SIZE):
+            yield "".join(json.dumps(item) + "\n" for item in items[offset:offset+STREAM_CHUNK_SIZE])
+    return StreamingResponse(lines(), media_type=NDJSON, headers={"X-Total-Count": str(total)})
+
+# Respond with the `items` of the requested page, either as a JSON page or as a stream of NDJSON lines
+def page_response(items, total, bounds, streamed, **fields):
+    if streamed:
+        return stream_items(items, total)
+    start, stop = bounds
+    return {**fields, "total": total, "offset": start, "limit": stop - start, "items": items}
+
+@router.post("/bytecode")
+async def bytecode_route(contract: ContractRequest):
+    code_hash, bytecode = await fetch_contract(contract.contract_address, contract.rpc_url)
+    return {"contract_address": contract.contract_address, "code_hash": code_hash, "size": len(bytecode), "bytecode": "0x" + bytecode.hex()}
+
+# The instructions of the contract, see `pipeline.instructions`
+@router.post("/instructions")
+async def instructions_route(request: Request, page: PageRequest):
+    code_hash, bytecode = await fetch_contract(page.contract_address, page.rpc_url)
+    streamed = wants_stream(request, page)
+    bounds = page_bounds(page, streamed)
+    total, items = await asyncio.to_thread(pipeline.instructions, bytecode, *bounds)
+    return page_response(items, total, bounds, streamed, code_hash=code_hash)
+
+# Whether the control flow graph is partial and the exploration statistics
+@router.post("/cfg")
+async def cfg_route(contract: ContractRequest):
+    code_hash, bytecode = await fetch_contract(contract.contract_address, contract.rpc_url)
+    cfg = await run_analysis(pipeline.control_flow_graph_stats, code_hash, bytecode)
+    return {"code_hash": code_hash, "partial": cfg["partial"], "stats": cfg["stats"]}
+
+# The basic blocks of the control flow graph, see `pipeline.control_flow_graph_blocks`
+@router.post("/cfg/blocks")
+async def cfg_blocks_route(request: Request, page: PageRequest):
+    code_hash, bytecode = await fetch_contract(page.contract_address, page.rpc_url)
+    blocks = await run_analysis(pipeline.control_flow_graph_blocks, code_hash, bytecode)
+    streamed = wants_stream(request, page)
+    bounds = page_bounds(page, streamed)
+    items = [
+        {"start": block["start_addr"], "end": block["falltrough_addr"], "jump_dest": block["jump_dest"], "text": block["text"]}
+        for block in blocks[slice(*bounds)]
+    ]
+    return page_response(items, len(blocks), bounds, streamed, code_hash=code_hash)
+
+# The edges of the control flow graph, see `pipeline.control_flow_graph_edges`
+@router.post("/cfg/edges")
+async def cfg_edges_route(request: Request, page: PageRequest):
+    code_hash, bytecode = await fetch_contract(page.contract_address, page.rpc_url)
+    edges = await run_analysis(pipeline.control_flow_graph_edges, code_hash, bytecode)
+    streamed = wants_stream(request, page)
+    bounds = page_bounds(page, streamed)
+    items = [{"from": from_addr, "to": to_addr} for from_addr, to_addr in edges[slice(*bounds)]]
+    return page_response(items, len(edges), bounds, streamed, code_hash=code_hash)
+
+# The .dot export of the control flow graph, streamed from the file it was written to
+@router.post("/cfg/dot")
+async def cfg_dot_route(contract: ContractRequest):
+    code_hash, bytecode = await fetch_contract(contract.contract_address, contract.rpc_url)
+    path, temporary, cfg = await run_analysis(pipeline.control_flow_graph_dot_file, code_hash, bytecode)
+    return FileResponse(
+        path, media_type="text/vnd.graphviz", headers={"X-Partial": str(cfg["partial"]).lower()},
+        background=BackgroundTask(os.unlink, path) if temporary else None,
+    )
+
+# The function selectors of the contract and their signatures, None for selectors that couldn't be resolved
+@router.post("/selectors")
+async def selectors_route(contract: ContractRequest):
+    code_hash, bytecode = await fetch_contract(contract.contract_address, contract.rpc_url)
+    signatures = await pipeline.signatures_async(code_hash, bytecode)
+    return {
+        "code_hash": code_hash,
+        "selectors": [
+            {"selector": "0x" + selector, "signature": signature if signature != "Not found" else None}
+            for selector, signature in signatures
+        ],
+    }
+
+@router.post("/audit")
+async def audit_route(contract: AuditRequest):
+    validate_token_type(contract.token_type)
+    code_hash, bytecode = await fetch_contract(contract.contract_address, contract.rpc_url)
+    audit = (await run_analysis(pipeline.audit, [(code_hash, bytecode)], contract.token_type))[0]
+    return {"contract_address": contract.contract_address, "code_hash": code_hash, "token_type": contract.token_type, **audit}
+
+# Fetch the contracts of a batch audit. Returns one entry per requested address, in the order they were requested,
+# and the (entry, (code hash, bytecode)) pairs of the contracts that can be audited. Entries of contracts that can't be
+# audited get an "error".
+async def fetch_batch(batch):
+    results = [{"contract_address": contract_address} for contract_address in batch.contract_addresses]
+
+    valid = []
+    for entry in results:
+        valid_address, address_error = validate_contract_address(entry["contract_address"])
+        if valid_address:
+            valid.append(entry)
+        else:
+            entry["error"] = address_error
+
+    try:
+        # The bytecode of all contracts is fetched together in batched RPC requests
+        fetched = await pipeline.fetch_bytecodes_async([entry["contract_address"] for entry in valid], batch.rpc_url)
+    except Exception as e:
+        fetched = [e] * len(valid)
+
+    contracts = []
+    for entry, contract in zip(valid, fetched):
+        if isinstance(contract, Exception):
+            entry["error"] = f"Error scraping bytecode: {contract}"
+            logger.error(entry["error"])
+        elif contract[1] is None:
+            entry["error"] = "No bytecode found for the contract address."
+        else:
+            entry["code_hash"] = contract[0]
+            contracts.append((entry, contract))
+    return results, contracts
+
+# Audit many contracts of one token type. All contracts without cached scores are scored together, each model runs
+# once over the whole batch. Streamed batches are scored in steps of `STREAM_AUDIT_CHUNK_SIZE` contracts instead, and
+# each contract's entry is sent as soon as it is done, contracts that can't be audited first.
+@router.post("/audits")
+async def audits_route(request: Request, batch: BatchAuditRequest):
+    valid_rpc, rpc_error = validate_rpc_url(batch.rpc_url)
+    if not valid_rpc:
+        raise HTTPException(status_code=400, detail=rpc_error)
+    validate_token_type(batch.token_type)
+    results, contracts = await fetch_batch(batch)
+
+    if not wants_stream(request, batch):
+        audits = await run_analysis(pipeline.audit, [contract for _, contract in contracts], batch.token_type)
+        for (entry, _), audit in zip(contracts, audits):
+            entry.update(audit)
+        return {"token_type": batch.token_type, "results": results}
+
+    async def lines():
+        for entry in results:
+            if "error" in entry:
+                yield json.dumps(entry) + "\n"
+        for offset in range(0, len(contracts), STREAM_AUDIT_CHUNK_SIZE):
+            chunk = contracts[offset:offset+STREAM_AUDIT_CHUNK_SIZE]
+            try:
+                audits = await executor.run(pipeline.audit, [contract for _, contract in chunk], batch.token_type)
+            except Exception as e:
+                # The response has started already, the error is reported per contract
+                error = "The analysis took too long, try again later." if isinstance(e, asyncio.TimeoutError) else str(e)
+                audits = [{"error": error}] * len(chunk)
+            yield "".join(json.dumps({**entry, **audit}) + "\n" for (entry, _), audit in zip(chunk, audits))
+    return StreamingResponse(lines(), media_type=NDJSON, headers={"X-Total-Count": str(len(results))})
@@ -0,0 +1,87 @@
+# Micro-benchmark of the selector extraction on large contracts.
+#
+# Compares `disassembly.find_selectors` with the dict-per-op parser it replaced. Run it from the repository root:
+#   python -m benchmarks.selectors [bytecode files...]
+# Without arguments, it runs on a synthetic 24 KB contract with a binary-search dispatcher.
+import sys
+import time
+import random
+from utils.disassembly import disassemble, _disassemble, find_selectors
+
+# The selector extraction as it was before the shared disassembly, kept for comparison
+def legacy_find_selectors(bytecode):
+    ops = []
+    pos = 0
+    while pos < len(bytecode):
+        op = {}
+        if bytecode[pos] >= 0x60 and bytecode[pos] <= 0x7f:
+            if pos+2+int(bytecode[pos]-0x60) > len(bytecode):
+                break
+            op["Opcode"] = bytecode[pos]
+            op["IsPush"] = True
+            op["arg"] = bytecode[pos+1 : pos+2+int(bytecode[pos]-0x60)]
+            pos += int(bytecode[pos]-0x60) + 1
+        else:
+            op["Opcode"] = bytecode[pos]
+            op["IsPush"] = False
+            op["arg"] = b''
+        ops.append(op)
+        pos += 1
+
+    selectors = []
+    for offset in range(len(ops) - 4):
+        if ops[offset]["IsPush"] and ops[offset+1]["Opcode"] == 0x14 and ops[offset+2]["IsPush"] and ops[offset+3]["Opcode"] == 0x57:
+            selector = ops[offset]["arg"]
+            if len(selector) > 4:
+                continue
+            while len(selector) < 4:
+                selector = b'\x00' + selector
+            selectors.append(selector)
+    return selectors
+
+# Runtime bytecode of `size` bytes with a dispatcher over `num_selectors` selectors, split in halves by GT comparisons
+# like solc does for large contracts, followed by arbitrary code
+def synthetic_contract(num_selectors=256, size=24 * 1024, seed=0):
+    rng = random.Random(seed)
+    selectors = sorted(rng.randrange(1, 2**32 - 1) for _ in range(num_selectors))
+    code = bytearray()
+    for idx, selector in enumerate(selectors):
+        if idx % 16 == 0:
+            # DUP1 PUSH4 pivot GT PUSH2 target JUMPI
+            code += bytes([0x80, 0x63]) + selector.to_bytes(4, "big") + bytes([0x11, 0x61, 0x00, 0x00, 0x57])
+        # DUP1 PUSH4 selector EQ PUSH2 target JUMPI
+        code += bytes([0x80, 0x63]) + selector.to_bytes(4, "big") + bytes([0x14, 0x61, 0x00, 0x00, 0x57])
+    # Arbitrary code without any 0x5f-0x7f bytes, so it doesn't swallow the dispatcher
+    while len(code) < size:
+        code.append(rng.choice([0x01, 0x02, 0x50, 0x54, 0x55, 0x5b, 0x60, 0x80, 0x90, 0x56]))
+        if code[-1] == 0x60:
+            code.append(rng.randrange(256))
+    return bytes(code[:size])
+
+def bench(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main(files):
+    if files:
+        contracts = [(f, bytes.fromhex(open(f).read().strip())) for f in files]
+    else:
+        contracts = [("synthetic", synthetic_contract())]
+
+    for name, bytecode in contracts:
+        repeat = 20
+        legacy = bench(lambda: legacy_find_selectors(bytecode), repeat)
+        decode = bench(lambda: _disassemble(bytecode), repeat)
+        scan = bench(lambda: find_selectors(disassemble(bytecode)), repeat)
+        num_selectors = len(set(find_selectors(disassemble(bytecode))))
+        print(f"{name}: {len(bytecode)} bytes, {num_selectors} selectors")
+        print(f"  legacy parser:          {legacy * 1000:8.2f} ms")
+        print(f"  decode (once per code): {decode * 1000:8.2f} ms")
+        print(f"  scan of shared decode:  {scan * 1000:8.2f} ms ({legacy / scan:.1f}x)")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,208 @@
+# Benchmarks of each analysis stage on the bytecode corpus in benchmarks/corpus.
+#
+# The corpus is split into small, typical and pathological contracts. Every stage is timed and memory-profiled on its
+# own, and the results are compared with a stored baseline. Run it from the repository root:
+#   python -m benchmarks.suite                    compare with benchmarks/baseline.json
+#   python -m benchmarks.suite --update-baseline  store the results as the new baseline
+# The exit code is 1 if any stage got slower or uses more memory than the baseline allows, or if a stage's output
+# changed. Timings depend on the machine, so the baseline should be recorded on the machine the suite runs on.
+#
+# The Graph2Vec and classifier stages need trained models, they are skipped if there are none in the model directory.
+import gc
+import os
+import io
+import sys
+import glob
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import torch
+from utils import evm_cfg, visualization, cfg_binary, disassembly, stack_mapping
+from utils.exploration import explore
+from utils.infer_models import load_file
+from utils.model_registry import ModelRegistry
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), "corpus")
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# A stage counts as a regression when it is this much slower than the baseline, and by more than `MIN_SECONDS`
+DEFAULT_TOLERANCE = 0.25
+MIN_SECONDS = 0.001
+# A stage counts as a regression when its peak memory grows by more than this fraction, and by more than `MIN_KB`
+MEMORY_TOLERANCE = 0.10
+MIN_KB = 64
+# Quick stages are repeated until they ran for at least this long in total, to even out the noise of the machine
+MIN_TOTAL_SECONDS = 0.2
+
+def load_corpus(corpus_dir=CORPUS_DIR):
+    contracts = []
+    for path in sorted(glob.glob(os.path.join(corpus_dir, "*", "*.bin"))):
+        category = os.path.basename(os.path.dirname(path))
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as f:
+            contracts.append((f"{category}/{name}", bytes.fromhex(f.read())))
+    return contracts
+
+def clear_caches():
+    # Both the decoding and the stack mappings are memoised by the bytecode, each run has to start cold
+    disassembly._disassemble_cached.cache_clear()
+    stack_mapping.stack_mapping.cache_clear()
+
+# Best wall time of at least `repeat` runs of `fn`, and the peak memory allocated during one more run. `setup` runs
+# before each of them and isn't measured. Like `timeit`, the garbage collector is off while timing.
+def measure(fn, repeat, setup=None):
+    best = float("inf")
+    total = 0.0
+    runs = 0
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        while runs < repeat or total < MIN_TOTAL_SECONDS:
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            best = min(best, elapsed)
+            total += elapsed
+            runs += 1
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {"seconds": best, "peak_kb": peak // 1024}
+
+# The stages of one contract, each as a dict of stage -> measurements, and the outputs that have to stay the same
+def run_contract(bytecode, repeat, members, tmp_dir):
+    stages = {}
+
+    blocks, stages["create_basic_blocks"] = measure(lambda: evm_cfg.create_basic_blocks(bytecode), repeat, clear_caches)
+
+    codes = [bytecode[block.start_addr:block.falltrough_addr] for block in blocks.values()]
+    _, stages["stack_mapping"] = measure(lambda: [stack_mapping.StackMapping(code) for code in codes], repeat)
+
+    exploration, stages["exploration"] = measure(lambda: explore(blocks), repeat)
+
+    def write_dot():
+        with io.StringIO() as f:
+            visualization.write_dot(blocks, f, exploration)
+            return f.tell()
+    dot_size, stages["dot_export"] = measure(write_dot, repeat)
+
+    dot_file = os.path.join(tmp_dir, "graph.dot")
+    with open(dot_file, "w") as f:
+        visualization.write_dot(blocks, f, exploration)
+    graph, stages["load_file"] = measure(lambda: load_file(dot_file), repeat)
+
+    cfg_file = os.path.join(tmp_dir, "graph.cfgb")
+    cfg_binary.save_cfg(graph, cfg_file)
+    _, stages["load_binary"] = measure(lambda: load_file(cfg_file), repeat)
+
+    if members:
+        documents, stages["wl_features"] = measure(lambda: [member.graph_features([graph]) for member in members], repeat)
+        vectors, stages["graph2vec_inference"] = measure(
+            lambda: [member.infer_documents(member_documents) for member, member_documents in zip(members, documents)], repeat)
+        def classify():
+            with torch.no_grad():
+                return [member.nn(torch.Tensor(member_vectors))[:, 0].tolist() for member, member_vectors in zip(members, vectors)]
+        scores, stages["classifier"] = measure(classify, repeat)
+
+    outputs = {
+        "blocks": len(blocks),
+        "edges": len(exploration.known_edges),
+        "anywhere_edges": len(exploration.anywhere_edges),
+        "partial": exploration.partial,
+        "dot_size": dot_size,
+    }
+    return stages, outputs
+
+def run(contracts, repeat, members):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, bytecode in contracts:
+            stages, outputs = run_contract(bytecode, repeat, members, tmp_dir)
+            results[name] = {"size": len(bytecode), "stages": stages, "outputs": outputs}
+    return results
+
+# Regressions of `results` compared with `baseline`, as a list of messages
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result["outputs"] != expected["outputs"]:
+            regressions.append(f"{name}: output changed from {expected['outputs']} to {result['outputs']}")
+        for stage, measured in result["stages"].items():
+            reference = expected["stages"].get(stage)
+            if reference is None:
+                continue
+            slower = measured["seconds"] - reference["seconds"]
+            if slower > MIN_SECONDS and measured["seconds"] > reference["seconds"] * (1 + tolerance):
+                regressions.append(f"{name} {stage}: {measured['seconds'] * 1000:.2f} ms, baseline {reference['seconds'] * 1000:.2f} ms")
+            grown = measured["peak_kb"] - reference["peak_kb"]
+            if grown > MIN_KB and measured["peak_kb"] > reference["peak_kb"] * (1 + MEMORY_TOLERANCE):
+                regressions.append(f"{name} {stage}: peak {measured['peak_kb']} KB, baseline {reference['peak_kb']} KB")
+    return regressions
+
+def report(results, baseline):
+    for name, result in results.items():
+        print(f"{name}: {result['size']} bytes, {result['outputs']['blocks']} blocks, {result['outputs']['edges']} edges")
+        expected = baseline.get(name, {}).get("stages", {})
+        for stage, measured in result["stages"].items():
+            line = f"  {stage:20} {measured['seconds'] * 1000:10.2f} ms {measured['peak_kb']:10} KB"
+            reference = expected.get(stage)
+            if reference is not None and reference["seconds"] > 0:
+                line += f"   {measured['seconds'] / reference['seconds']:5.2f}x baseline"
+            print(line)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark each analysis stage on the bytecode corpus")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline to compare with or to update")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="fraction a stage may be slower than the baseline")
+    parser.add_argument("--repeat", type=int, default=5, help="minimum runs per stage, the best one counts")
+    parser.add_argument("--models", default="models_erc20", help="model directory for the Graph2Vec and classifier stages")
+    parser.add_argument("--corpus", default=CORPUS_DIR, help="directory with one subdirectory of .bin files per category")
+    args = parser.parse_args(argv)
+
+    members = []
+    if os.path.isdir(args.models):
+        registry = ModelRegistry({"benchmark": args.models}, frozen=False)
+        if registry.signature(args.models):
+            members = registry.get("benchmark").members
+    if not members:
+        print(f"No models in {args.models}, skipping the Graph2Vec and classifier stages")
+
+    results = run(load_corpus(args.corpus), args.repeat, members)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=1)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
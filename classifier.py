@@ -2,18 +2,17 @@
 import numpy
 import torch 
 import torch.nn as nn
-import random
-import sklearn.metrics as metrics
-from torch.autograd import Variable
+import torch.nn.functional as F
 import torch.optim as optim
+from torch.utils.data import TensorDataset, DataLoader, BatchSampler, RandomSampler
 
 '''
 A simple neural network in PyTorch to classify input data as benign or malicious.
 The network has an input layer, one hidden layer (Leaky ReLU activation function), and an 
 output layer (Sigmoid activation function). The network can be trained using stochastic gradient descent
-(SGD) optimization. The training is done in batches of size 10, and the training data is shuffled at the 
-beginning of each epoch. The performance of the network is measured by the recall, accuracy, and F1-score
-and it is calculated on both the training data and the testing data.
+(SGD) optimization, or any other optimizer through `CfgTrainer`. The training is done in batches (of size 10 by
+default), and the training data is shuffled at the beginning of each epoch. The performance of the network is
+measured by the recall, accuracy, and F1-score and it is calculated on both the training data and the testing data.
 '''
 class CfgClassifier(nn.Module):
 	# Initialize the model
@@ -33,99 +32,100 @@ class CfgClassifier(nn.Module):
 		# Apply the sigmoid activation function to the output
 		return torch.sigmoid(self.l3(x)) # Output is a probability between 0 and 1
 	
-	def run_epoch(self, train_graph_vecs, train_labels, test_graph_vecs, test_labels, learning_rate, malicious_weight):
-		train_metrics = self.train(train_graph_vecs, train_labels, learning_rate, malicious_weight)
+	def run_epoch(self, train_graph_vecs, train_labels, test_graph_vecs, test_labels, learning_rate, malicious_weight, batch_size=10):
+		train_metrics = self.train(train_graph_vecs, train_labels, learning_rate, malicious_weight, batch_size)
 		test_metrics = self.test(test_graph_vecs, test_labels)
 		return (train_metrics, test_metrics)
 	
-	# Train the model on a single batch of data
-	def train_batch(self, data, labels, learning_rate, malicious_weight):
-		var = Variable(data)
-		# Create a tensor to store the weights of each example in the batch
-		weights = torch.Tensor(data.size()[0],1) 
-		# Assign a weight of malicious_weight to malicious examples, and a weight of 1.0 to benign examples
-		for i in range(data.size()[0]):
-			if labels[i] == 1.0:
-				weights[i] = malicious_weight
-			else:
-				weights[i] = 1.0
+	# Train the model on the entire training dataset for one epoch
+	def train(self, train_graph_vecs, train_labels, learning_rate, malicious_weight, batch_size=10):
+		trainer = CfgTrainer(self, optim.SGD(self.parameters(), lr=learning_rate), malicious_weight, batch_size)
+		return trainer.train_epoch(train_graph_vecs, train_labels)
+
+	# Test the model on the test dataset
+	def test(self, test_graph_vecs, test_labels):
+		if len(test_graph_vecs) == 0:
+			return (0.0, 0.0, 0.0)
+		graph_vecs, labels = as_tensors(test_graph_vecs, test_labels)
+		with torch.no_grad():
+			# Get the model's predictions on the test data
+			prediction = self(graph_vecs)
+		return binary_metrics(labels, prediction > 0.5)
+
+# Convert graph vectors and their labels to a (N, d) and a (N, 1) tensor. Tensors are used as they are.
+def as_tensors(graph_vecs, labels):
+	graph_vecs = torch.as_tensor(numpy.asarray(graph_vecs, dtype=numpy.float32))
+	labels = torch.as_tensor(numpy.asarray(labels, dtype=numpy.float32)).view(-1, 1)
+	return graph_vecs, labels
+
+# (f1, recall, accuracy) of the binary `predictions` for the `labels`, both given as tensors. Like scikit-learn,
+# the F1-score and the recall are 0.0 when they are undefined.
+def binary_metrics(labels, predictions):
+	labels = labels.view(-1) == 1.0
+	predictions = predictions.view(-1)
+	true_positives = (labels & predictions).sum().item()
+	false_positives = (~labels & predictions).sum().item()
+	false_negatives = (labels & ~predictions).sum().item()
+	f1 = 2 * true_positives / (2 * true_positives + false_positives + false_negatives) if true_positives + false_positives + false_negatives > 0 else 0.0
+	recall = true_positives / (true_positives + false_negatives) if true_positives + false_negatives > 0 else 0.0
+	accuracy = (labels == predictions).sum().item() / len(labels)
+	return (f1, recall, accuracy)
+
+# Trains a CfgClassifier over many epochs with one optimizer, so that optimizers with state (momentum, Adam, ...)
+# keep it between batches and epochs. The data is shuffled with the trainer's own random generator, so training is
+# reproducible when a `seed` is given. Without one, the generator is seeded from torch's global random generator,
+# which makes training reproducible under `torch.manual_seed`.
+class CfgTrainer:
+	def __init__(self, model, optimizer, malicious_weight=1.0, batch_size=10, seed=None):
+		self.model = model
+		self.optimizer = optimizer
+		self.malicious_weight = malicious_weight
+		self.batch_size = batch_size
+		self.generator = torch.Generator()
+		if seed is None:
+			seed = int(torch.randint(2**62, (1,)).item())
+		self.generator.manual_seed(seed)
+
+	# Batches of a shuffled epoch over the dataset, each batch is gathered from the tensors in one indexing operation
+	def batches(self, graph_vecs, labels):
+		dataset = TensorDataset(graph_vecs, labels)
+		sampler = BatchSampler(RandomSampler(dataset, generator=self.generator), self.batch_size, drop_last=False)
+		return DataLoader(dataset, sampler=sampler, batch_size=None)
+
+	# Train the model on a single batch of data and return the model's predictions, as they were before the update
+	def train_batch(self, graph_vecs, labels):
+		# Malicious examples weigh `malicious_weight`, benign examples 1.0
+		weights = torch.where(labels == 1.0, self.malicious_weight, 1.0)
 		
 		# Run the forward pass to get the model's predictions
-		out = self(var)
+		out = self.model(graph_vecs)
 		
 		# Compute the loss using the binary cross-entropy loss, with the weights of each example taken into account
-		criterion = nn.BCELoss(weight=weights)
-		loss = criterion(out, labels)
-		
-		# Zero the gradients before the backward pass
-		self.zero_grad()
+		loss = F.binary_cross_entropy(out, labels, weight=weights)
 		
 		# Run backpropagation to update the model's parameters
+		self.optimizer.zero_grad()
 		loss.backward()
-		optimizer = optim.SGD(self.parameters(), lr=learning_rate)
-		optimizer.step()
+		self.optimizer.step()
 		
-		# Return the model's predictions
-		return out
-	
-	# Train the model on the entire training dataset
-	def train(self, train_graph_vecs, train_labels, learning_rate, malicious_weight):
-		# Shuffle the training data to mix up the batches
-		# Zip the two lists into a single list of tuples
-		temp = list(zip(train_graph_vecs, train_labels))
-		# Randomly shuffle the list of tuples
-		random.shuffle(temp)
-		# Unzip the shuffled list of tuples back into the original lists
-		a, b = zip(*temp)
-		train_graph_vecs, train_labels = list(a), list(b)
-
-		# Split dataset into batches
-		batch_size = 10
-		train_predictions_binary = []
-		# For each batch of data, 
-		for offset in range(0,len(train_graph_vecs), batch_size):
-			# Convert the batch of data into a Tensor
-			train_graph_vecs = numpy.array(train_graph_vecs)
-			graphs = torch.Tensor(train_graph_vecs[offset:offset+batch_size])
-			labels_list = train_labels[offset:offset+batch_size]
-			# Convert the labels into a Tensor
-			labels = torch.Tensor(labels_list).view(len(labels_list), 1)
-
-			# Train the model on the current batch
-			predictions = self.train_batch(graphs, labels, learning_rate, malicious_weight)
+		return out.detach()
 
-			# Normalize the predictions and store the results
-			for prediction in predictions:
-				# If the prediction is greater than 0.5, store 1.0, otherwise store 0.0
-				if prediction > 0.5:
-					train_predictions_binary.append(1.0)
-				else:
-					train_predictions_binary.append(0.0)
-
-		# Calculate and print the metrics for the training data
-		train_f1 = metrics.f1_score(train_labels, train_predictions_binary)
-		train_accuracy = metrics.accuracy_score(train_labels, train_predictions_binary)
-		train_recall = metrics.recall_score(train_labels, train_predictions_binary)
-		return (train_f1, train_recall, train_accuracy)
+	# Train the model on the entire training dataset for one epoch and return the (f1, recall, accuracy) of the
+	# predictions made while training
+	def train_epoch(self, train_graph_vecs, train_labels):
+		graph_vecs, labels = as_tensors(train_graph_vecs, train_labels)
+		if len(graph_vecs) == 0:
+			return (0.0, 0.0, 0.0)
+		
+		batch_labels = []
+		batch_predictions = []
+		for batch_vecs, batch_label in self.batches(graph_vecs, labels):
+			batch_predictions.append(self.train_batch(batch_vecs, batch_label) > 0.5)
+			batch_labels.append(batch_label)
+		
+		return binary_metrics(torch.cat(batch_labels), torch.cat(batch_predictions))
 
-	# Test the model on the test dataset
-	def test(self, test_graph_vecs, test_labels):
-		if len(test_graph_vecs) > 0:
-			# Get the model's predictions on the test data
-			prediction = self(torch.Tensor(test_graph_vecs))
-			# Normalize the predictions to be either 1.0 or 0.0
-			prediction_binary = []
-			for value in prediction:
-				if value > 0.5:
-					prediction_binary.append(1.0)
-				else:
-					prediction_binary.append(0.0)
-			
-			# Calculate and print the metrics for the test data
-			test_f1 = metrics.f1_score(test_labels, prediction_binary)
-			test_recall = metrics.recall_score(test_labels, prediction_binary)
-			test_accuracy = metrics.accuracy_score(test_labels, prediction_binary)
-		else:
-			test_f1, test_recall, test_accuracy = 0.0, 0.0, 0.0
-			
-		return (test_f1, test_recall, test_accuracy)
\ No newline at end of file
+	def run_epoch(self, train_graph_vecs, train_labels, test_graph_vecs, test_labels):
+		train_metrics = self.train_epoch(train_graph_vecs, train_labels)
+		test_metrics = self.model.test(test_graph_vecs, test_labels)
+		return (train_metrics, test_metrics)
@@ -1,203 +1,189 @@
 import os
-import pyevmasm
-from fastapi import FastAPI, Request, Form
-from web3 import Web3
-from utils import generate_cfg
-from utils.infer_models import audit_contract
-from utils.scrape_bytecode import scrape_bytecode
+import time
+import asyncio
+from fastapi import FastAPI, Request, Form, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse
+import api
+from api import BatchAuditRequest, validate_rpc_url
+from utils import pipeline
+from utils import metrics
+from utils.model_registry import registry
+from utils.rpc_client import close_clients
 import logging
 import coloredlogs
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from utils.signatures_evm import get_signatures
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
+app.include_router(api.router)
 templates = Jinja2Templates(directory="templates")
 
 # create logger
 logger = logging.getLogger(__name__)
 coloredlogs.install(level='INFO', logger=logger, fmt='[%(levelname)s]: %(message)s')
 
-def validate_contract_address(contract_address):
-    if not Web3.is_address(contract_address):
-        error = 'Invalid contract address.'
-        return False, error
-    return True, None
-
-def validate_rpc_url(rpc_url):
-    if not rpc_url:
-        error = 'RPC URL is required.'
-        return False, error
-    return True, None
+def log_cfg(contract_address, cfg):
+    if cfg["partial"]:
+        logger.warning(f"CFG exploration for {contract_address} ran out of its {cfg['stats']['exhausted_budget']} budget, the graph is partial: {cfg['stats']}")
+    else:
+        logger.info(f"CFG exploration for {contract_address}: {cfg['stats']}")
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    timings = metrics.track_request()
+    start = time.perf_counter()
+    with metrics.requests_in_flight.track():
+        response = await call_next(request)
+    # Requests are reported by their route rather than their path, which would make a new time series per address
+    route = request.scope.get("route")
+    metrics.request_seconds.observe(
+        time.perf_counter() - start, route=route.path if route is not None else "unmatched", method=request.method,
+        status=response.status_code,
+    )
+    if metrics.TIMING_HEADERS and timings:
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
+
+@app.get('/metrics')
+async def metrics_route():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+# Registered first, so that the executor's workers are forked before anything else in the web worker starts threads
+@app.on_event("startup")
+def start_executor():
+    api.executor.start()
+
+@app.on_event("startup")
+def preload_models():
+    # Optionally load the models when the worker starts instead of on the first audit
+    if os.environ.get("PRELOAD_MODELS"):
+        try:
+            registry.preload()
+        except Exception as e:
+            logger.error(f"Error preloading models: {e}")
+
+@app.on_event("shutdown")
+async def shutdown():
+    api.executor.shutdown()
+    await close_clients()
+
+# The HTML routes below serve the form in index.html for browsers without JavaScript, the page itself talks to the
+# JSON API. They render what the API returns as text, nothing is written to disk.
+
+def read_text(path):
+    with open(path) as f:
+        return f.read()
+
+def render(request, **context):
+    return templates.TemplateResponse("index.html", {"request": request, **context})
+
+def error_response(request, e):
+    # Analyses that are turned away or take too long keep their status codes, so clients can retry
+    status_code = e.status_code if e.status_code in (429, 504) else 200
+    return templates.TemplateResponse("index.html", {"request": request, "error": e.detail}, status_code=status_code)
 
 @app.get('/')
-def index(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+async def index(request: Request):
+    return render(request)
 
 @app.post('/scrape_bytecode')
-def scrape_bytecode_route(request: Request, contract_address: str = Form(...), rpc_url: str = Form(...)):
+async def scrape_bytecode_route(request: Request, contract_address: str = Form(...), rpc_url: str = Form(...)):
     try:
-        # Validate input values
-        valid_address, address_error = validate_contract_address(contract_address)
-        if not valid_address:
-            return templates.TemplateResponse("index.html", {"request": request, "error": address_error})
-
-        valid_rpc, rpc_error = validate_rpc_url(rpc_url)
-        if not valid_rpc:
-            return templates.TemplateResponse("index.html", {"request": request, "error": rpc_error})
-
-        scrape_bytecode(contract_address, rpc_url)
-        bin_file = f'contracts/{contract_address}/{contract_address}.bin'
-        if os.path.exists(bin_file):
-            with open(bin_file) as f:
-                output = f.read()
-        return templates.TemplateResponse("index.html", {"request": request, "contract_address": contract_address, "output": output})
-
+        contract = await api.bytecode_route(api.ContractRequest(contract_address=contract_address, rpc_url=rpc_url))
+        return render(request, contract_address=contract_address, output=contract["bytecode"][2:])
+    except HTTPException as e:
+        return error_response(request, e)
     except Exception as e:
         error = f"Error scraping bytecode: {e}"
         logger.error(error)
-        return templates.TemplateResponse("index.html", {"request": request, "error": error})
-    
+        return render(request, error=error)
+
 @app.post('/generate_cfg')
-def generate_cfg_route(request: Request, contract_address: str = Form(...), rpc_url: str = Form(...)):
+async def generate_cfg_route(request: Request, contract_address: str = Form(...), rpc_url: str = Form(...)):
     try:
-        valid_address, address_error = validate_contract_address(contract_address)
-        if not valid_address:
-            return templates.TemplateResponse("index.html", {"request": request, "error": address_error})
-
-        valid_rpc, rpc_error = validate_rpc_url(rpc_url)
-        if not valid_rpc:
-            return templates.TemplateResponse("index.html", {"request": request, "error": rpc_error})
-
-        bin_file = f'contracts/{contract_address}/{contract_address}.bin'
-        if not os.path.exists(bin_file):
-            scrape_bytecode(contract_address, rpc_url)
-            if not os.path.exists(bin_file):
-                error = "Bytecode file does not exist."
-                return templates.TemplateResponse("index.html", {"request": request, "error": error})
-
-        generate_cfg.generate_control_flow_graph(bin_file, f"contracts/{contract_address}/{contract_address}.dot")
-
-        dot_file = f'contracts/{contract_address}/{contract_address}.dot'
-        if os.path.exists(dot_file):
-            with open(dot_file) as f:
-                output = f.read()
-
-        return templates.TemplateResponse("index.html", {"request": request, "contract_address": contract_address, "output": output})
-
+        code_hash, bytecode = await api.fetch_contract(contract_address, rpc_url)
+        path, temporary, cfg = await api.run_analysis(pipeline.control_flow_graph_dot_file, code_hash, bytecode)
+        try:
+            dot = await asyncio.to_thread(read_text, path)
+        finally:
+            if temporary:
+                os.unlink(path)
+        log_cfg(contract_address, cfg)
+        return render(request, contract_address=contract_address, output=dot, partial=cfg["partial"])
+    except HTTPException as e:
+        return error_response(request, e)
     except Exception as e:
         error = f"Error generating cfg: {e}"
         logger.error(error)
-        return templates.TemplateResponse("index.html", {"request": request, "error": error})
-
+        return render(request, error=error)
 
 @app.post('/disasm')
-def disasm_route(request: Request, contract_address: str = Form(...), rpc_url: str = Form(...)):
+async def disasm_route(request: Request, contract_address: str = Form(...), rpc_url: str = Form(...)):
     try:
-        valid_address, address_error = validate_contract_address(contract_address)
-        if not valid_address:
-            return templates.TemplateResponse("index.html", {"request": request, "error": address_error})
-
-        valid_rpc, rpc_error = validate_rpc_url(rpc_url)
-        if not valid_rpc:
-            return templates.TemplateResponse("index.html", {"request": request, "error": rpc_error})
-
-        bin_file = f'contracts/{contract_address}/{contract_address}.bin'
-        if not os.path.exists(bin_file):
-            scrape_bytecode(contract_address, rpc_url)
-            if not os.path.exists(bin_file):
-                error = "Bytecode file does not exist."
-                return templates.TemplateResponse("index.html", {"request": request, "error": error})
-
-        with open(bin_file, mode="r") as file:
-            evm_bytecode = file.read()
-        disassembly = pyevmasm.evmasm.disassemble(evm_bytecode)
-        asm_file = f"contracts/{contract_address}/{contract_address}.asm"
-        with open(asm_file, mode="w") as file:
-            file.write(disassembly)
-        if os.path.exists(asm_file):
-            with open(asm_file) as f:
-                output = f.read()
-
-        return templates.TemplateResponse("index.html", {"request": request, "contract_address": contract_address, "output": output})
-
+        code_hash, bytecode = await api.fetch_contract(contract_address, rpc_url)
+        disassembly = await asyncio.to_thread(pipeline.disassemble, code_hash, bytecode)
+        return render(request, contract_address=contract_address, output=disassembly)
+    except HTTPException as e:
+        return error_response(request, e)
     except Exception as e:
         error = f"Error generating disasm: {e}"
         logger.error(error)
-        return templates.TemplateResponse("index.html", {"request": request, "error": error})
-
+        return render(request, error=error)
 
 @app.post('/get_signatures')
-def get_signatures_route(request: Request, contract_address: str = Form(...), rpc_url: str = Form(...)):
+async def get_signatures_route(request: Request, contract_address: str = Form(...), rpc_url: str = Form(...)):
     try:
-        valid_address, address_error = validate_contract_address(contract_address)
-        if not valid_address:
-            return templates.TemplateResponse("index.html", {"request": request, "error": address_error})
-
-        valid_rpc, rpc_error = validate_rpc_url(rpc_url)
-        if not valid_rpc:
-            return templates.TemplateResponse("index.html", {"request": request, "error": rpc_error})
-
-        bin_file = f'contracts/{contract_address}/{contract_address}.bin'
-        if not os.path.exists(bin_file):
-            scrape_bytecode(contract_address, rpc_url)
-            if not os.path.exists(bin_file):
-                error = "Bytecode file does not exist."
-                return templates.TemplateResponse("index.html", {"request": request, "error": error})
-
-        with open(bin_file, mode="r") as file:
-            evm_bytecode = file.read()
-        signatures = get_signatures(evm_bytecode)
-        sigs_file = f"contracts/{contract_address}/{contract_address}.sigs"
-        with open(sigs_file, mode="w") as file:
-            for sig in signatures:
-                formatted_sig = f"0x{sig[0]}: {sig[1]}"
-                file.write(formatted_sig + "\n")
-        if os.path.exists(sigs_file):
-            with open(sigs_file) as f:
-                output = f.read()
-
-        return templates.TemplateResponse("index.html", {"request": request, "contract_address": contract_address, "output": output})
-
+        selectors = await api.selectors_route(api.ContractRequest(contract_address=contract_address, rpc_url=rpc_url))
+        output = "".join(f"{entry['selector']}: {entry['signature'] or 'Not found'}\n" for entry in selectors["selectors"])
+        return render(request, contract_address=contract_address, output=output)
+    except HTTPException as e:
+        return error_response(request, e)
     except Exception as e:
         error = f"Error generating signatures: {e}"
         logger.error(error)
-        return templates.TemplateResponse("index.html", {"request": request, "error": error})
-
+        return render(request, error=error)
 
 @app.post('/audit_contract')
-def audit_contract_route(request: Request, contract_address: str = Form(...), rpc_url: str = Form(...), token_type: str = Form(...)):
+async def audit_contract_route(request: Request, contract_address: str = Form(...), rpc_url: str = Form(...), token_type: str = Form(...)):
     try:
-        valid_address, address_error = validate_contract_address(contract_address)
-        if not valid_address:
-            return templates.TemplateResponse("index.html", {"request": request, "error": address_error})
-
-        valid_rpc, rpc_error = validate_rpc_url(rpc_url)
-        if not valid_rpc:
-            return templates.TemplateResponse("index.html", {"request": request, "error": rpc_error})
-
-        dot_file = f'contracts/{contract_address}/{contract_address}.dot'
-        if not os.path.exists(dot_file):
-            bin_file = f'contracts/{contract_address}/{contract_address}.bin'
-            if not os.path.exists(bin_file):
-                scrape_bytecode(contract_address, rpc_url)
-            if os.path.exists(bin_file):
-                generate_cfg.generate_control_flow_graph(bin_file, dot_file)
-
-        if os.path.exists(dot_file):
-            result = audit_contract(dot_file, token_type)
-            result = f"{result * 100:.2f}"
-            if float(result) > 50:
-                output = f"Result: {result}% ➡️ Contract is most likely malicious ⚠️🚫"
-            else:
-                output = f"Result: {result} ➡️ Contract is most likely non-malicious ✅"
+        api.validate_token_type(token_type)
+        code_hash, bytecode = await api.fetch_contract(contract_address, rpc_url)
+        # The graph is handed to the models in memory, no .dot file is written for the audit
+        audit = (await api.run_analysis(pipeline.audit, [(code_hash, bytecode)], token_type))[0]
+        log_cfg(contract_address, audit)
+        result = f"{audit['result'] * 100:.2f}"
+        if float(result) > 50:
+            output = f"Result: {result}% ➡️ Contract is most likely malicious ⚠️🚫"
         else:
-            output = 'Control flow graph file does not exist.'
+            output = f"Result: {result} ➡️ Contract is most likely non-malicious ✅"
+        return render(request, contract_address=contract_address, output=output, partial=audit["partial"])
+    except HTTPException as e:
+        return error_response(request, e)
+    except Exception as e:
+        error = f"Error auditing contract: {e}"
+        logger.error(error)
+        return render(request, error=error)
+
+# Same as /api/v1/audits without streaming, errors are reported in the response body
+@app.post('/audit_contracts')
+async def audit_contracts_route(batch: BatchAuditRequest):
+    valid_rpc, rpc_error = validate_rpc_url(batch.rpc_url)
+    if not valid_rpc:
+        return {"error": rpc_error}
 
-        return templates.TemplateResponse("index.html", {"request": request, "contract_address": contract_address, "output": output})
+    results, contracts = await api.fetch_batch(batch)
 
+    try:
+        # All contracts without cached scores are scored together, each model runs once over the whole batch
+        audits = await api.run_analysis(pipeline.audit, [contract for _, contract in contracts], batch.token_type)
+        for (entry, _), audit in zip(contracts, audits):
+            entry.update(audit)
+    except HTTPException as e:
+        return JSONResponse({"token_type": batch.token_type, "error": e.detail}, status_code=e.status_code)
     except Exception as e:
-        error = f"Error auditing contract: {e}"
+        error = f"Error auditing contracts: {e}"
         logger.error(error)
-        return templates.TemplateResponse("index.html", {"request": request, "error": error})
+        return {"token_type": batch.token_type, "error": error}
+
+    return {"token_type": batch.token_type, "results": results}
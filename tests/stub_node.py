@@ -0,0 +1,91 @@
+from aiohttp import web
+
+# Local JSON-RPC node for the tests. It serves the runtime bytecode in `codes` (address -> hex) and the blocks in
+# `blocks` (number -> list of transactions), and records every request it gets in `requests`.
+class StubNode:
+    def __init__(self, codes=None, blocks=None, receipts=None, chain_id=1):
+        self.codes = {address.lower(): code for address, code in (codes or {}).items()}
+        self.blocks = blocks or {}
+        # Receipts by transaction hash, deployments without one succeed and create the contract in their "creates" field
+        self.receipts = receipts or {}
+        self.chain_id = chain_id
+        # The JSON payload of every HTTP request, a list for batches
+        self.requests = []
+        # HTTP statuses the next requests are answered with, instead of being processed
+        self.failures = []
+        self.retry_after = None
+        # Number of times each method is answered with an RPC error before it succeeds again
+        self.errors = {}
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.url = "http://127.0.0.1:%d/" % self.runner.addresses[0][1]
+        return self
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    # Every call, in order, with batches flattened
+    def all_calls(self):
+        return [call for payload in self.requests for call in (payload if isinstance(payload, list) else [payload])]
+
+    @property
+    def calls(self):
+        # The methods called
+        return [call["method"] for call in self.all_calls()]
+
+    # The params of every call of `method`
+    def params(self, method):
+        return [call.get("params", []) for call in self.all_calls() if call["method"] == method]
+
+    async def handle(self, request):
+        payload = await request.json()
+        self.requests.append(payload)
+        if self.failures:
+            headers = {"Retry-After": self.retry_after} if self.retry_after is not None else {}
+            return web.Response(status=self.failures.pop(0), headers=headers)
+        if isinstance(payload, list):
+            return web.json_response([self.answer(call) for call in payload])
+        return web.json_response(self.answer(payload))
+
+    def answer(self, call):
+        method, params = call["method"], call.get("params", [])
+        if self.errors.get(method):
+            self.errors[method] -= 1
+            return {"jsonrpc": "2.0", "id": call["id"], "error": {"code": -32000, "message": f"{method} failed"}}
+        if method == "eth_chainId":
+            result = hex(self.chain_id)
+        elif method == "eth_getCode":
+            result = "0x" + self.codes.get(params[0].lower(), "")
+        elif method == "eth_blockNumber":
+            result = hex(max(self.blocks, default=0))
+        elif method == "eth_getBlockByNumber":
+            number = int(params[0], 16)
+            result = {"number": hex(number), "transactions": self.blocks.get(number, [])} if number in self.blocks else None
+        elif method == "eth_getTransactionReceipt":
+            result = self.receipt(params[0])
+        else:
+            return {"jsonrpc": "2.0", "id": call["id"], "error": {"code": -32601, "message": "Method not found"}}
+        return {"jsonrpc": "2.0", "id": call["id"], "result": result}
+
+    def receipt(self, transaction_hash):
+        if transaction_hash in self.receipts:
+            return self.receipts[transaction_hash]
+        for transactions in self.blocks.values():
+            for transaction in transactions:
+                if transaction["hash"] == transaction_hash:
+                    return {"transactionHash": transaction_hash, "status": "0x1", "contractAddress": transaction.get("creates")}
+        return None
@@ -0,0 +1,75 @@
+import time
+import asyncio
+import aiohttp
+import pytest
+from utils import rpc_client
+from utils.rpc_client import RpcClient, RpcError
+from tests.stub_node import StubNode
+
+ADDRESSES = ["0x%040x" % idx for idx in range(1, 6)]
+
+def run(test):
+    async def main():
+        async with StubNode(codes={address: "60%02x" % idx for idx, address in enumerate(ADDRESSES[:4])}) as node:
+            await test(node)
+    asyncio.run(main())
+
+def test_batches_calls():
+    async def test(node):
+        client = RpcClient(node.url, batch_size=2, backoff=0)
+        codes = await client.get_codes(ADDRESSES)
+        await client.close()
+        assert codes == [bytes.fromhex("60%02x" % idx) for idx in range(4)] + [b""]
+        assert [len(payload) for payload in node.requests] == [2, 2, 1]
+    run(test)
+
+def test_batch_errors_take_the_place_of_results():
+    async def test(node):
+        client = RpcClient(node.url, backoff=0)
+        node.errors["eth_getBlockByNumber"] = 1
+        results = await client.batch([("eth_getCode", (ADDRESSES[0], "latest")), ("eth_getBlockByNumber", ("0x1", True))], return_exceptions=True)
+        assert results[0] == "0x6000"
+        assert isinstance(results[1], RpcError)
+        node.errors["eth_getCode"] = 1
+        with pytest.raises(RpcError):
+            await client.get_codes(ADDRESSES[:2])
+        await client.close()
+    run(test)
+
+def test_retries_failed_requests():
+    async def test(node):
+        client = RpcClient(node.url, max_retries=2, backoff=0)
+        node.failures = [503, 502]
+        assert await client.chain_id() == 1
+        assert len(node.requests) == 3
+        node.failures = [503, 503, 503]
+        with pytest.raises(aiohttp.ClientResponseError):
+            await client.block_number()
+        await client.close()
+    run(test)
+
+def test_waits_as_long_as_an_overloaded_node_asks():
+    async def test(node):
+        client = RpcClient(node.url, backoff=0)
+        node.failures = [429]
+        node.retry_after = "1"
+        start = time.monotonic()
+        assert await client.get_code(ADDRESSES[1]) == bytes.fromhex("6001")
+        assert time.monotonic() - start >= 1
+        assert node.calls == ["eth_getCode", "eth_getCode"]
+        await client.close()
+    run(test)
+
+def test_closes_least_recently_used_clients(monkeypatch):
+    monkeypatch.setattr(rpc_client, "MAX_CLIENTS", 2)
+    async def test(node):
+        first = rpc_client.get_client(node.url + "?first")
+        await first.chain_id()
+        second = rpc_client.get_client(node.url + "?second")
+        assert rpc_client.get_client(node.url + "?first") is first
+        rpc_client.get_client(node.url + "?third")
+        await asyncio.sleep(0)
+        assert second.session is None and second.retired
+        assert first.session is not None and not first.retired
+        await rpc_client.close_clients()
+    run(test)
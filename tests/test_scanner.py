@@ -0,0 +1,106 @@
+import io
+import os
+import json
+import asyncio
+import pytest
+from utils import pipeline
+from utils import signatures_evm
+from utils.analysis_cache import AnalysisCache
+from utils.executor import BoundedExecutor
+from utils.scanner import ChainScanner
+from utils.signatures_evm import DictBackend
+from tests.stub_node import StubNode
+
+CODE = open(os.path.join(os.path.dirname(__file__), "..", "benchmarks", "corpus", "small", "event_contract.bin")).read().strip()
+DEPLOYER = "0x" + "ab" * 20
+
+def address(idx):
+    return "0x%040x" % idx
+
+def deployment(idx, creates=None):
+    return {"hash": "0x%064x" % idx, "to": None, "from": DEPLOYER, "creates": creates}
+
+def transfer(idx):
+    return {"hash": "0x%064x" % idx, "to": address(0xcd), "from": DEPLOYER}
+
+# Blocks 1 to 5 of the stub chain:
+#   1  a deployment and a transfer
+#   2  a failed deployment, which leaves no contract behind
+#   3  a deployment whose constructor returned no code
+#   4  nothing
+#   5  a deployment of the same code as in block 1
+BLOCKS = {
+    1: [deployment(1, address(1)), transfer(101)],
+    2: [deployment(2, address(2))],
+    3: [deployment(3, address(3))],
+    4: [],
+    5: [deployment(5, address(5))],
+}
+RECEIPTS = {"0x%064x" % 2: {"transactionHash": "0x%064x" % 2, "status": "0x0", "contractAddress": address(2)}}
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, "cache", AnalysisCache(str(tmp_path / "cache")))
+    monkeypatch.setattr(signatures_evm, "backend", DictBackend({}))
+
+def scan(node, checkpoint, end_block, **kwargs):
+    output = io.StringIO()
+    scanner = ChainScanner(
+        node.url, [], output, checkpoint_file=str(checkpoint), start_block=1, end_block=end_block, poll_interval=0.01,
+        retry_interval=0.01, executor=BoundedExecutor(max_workers=1), **kwargs,
+    )
+    return scanner, output
+
+def run(test):
+    async def main():
+        async with StubNode(codes={address(1): CODE, address(2): CODE, address(5): CODE}, blocks=BLOCKS, receipts=RECEIPTS) as node:
+            await test(node)
+    asyncio.run(main())
+
+def results(output):
+    return [json.loads(line) for line in output.getvalue().splitlines()]
+
+def test_resumes_from_checkpoint(tmp_path):
+    checkpoint = tmp_path / "checkpoint.json"
+    async def test(node):
+        scanner, output = scan(node, checkpoint, 3)
+        await scanner.run()
+        first = results(output)
+        assert sorted(result["address"] for result in first) == [address(1), address(3)]
+        assert json.loads(checkpoint.read_text()) == {"chain_id": 1, "next_block": 4}
+
+        # The contract created in block 1 is audited, the failed deployment in block 2 isn't reported at all
+        created = next(result for result in first if result["address"] == address(1))
+        assert "error" not in created
+        assert created["block"] == 1 and created["partial"] is False and created["audits"] == {}
+        empty = next(result for result in first if result["address"] == address(3))
+        assert empty["error"] == "fetch: No bytecode found for the contract address."
+
+        # A new scanner continues after the last block of the checkpoint, not from its start block
+        node.requests.clear()
+        scanner, output = scan(node, checkpoint, 5)
+        await scanner.run()
+        assert [result["address"] for result in results(output)] == [address(5)]
+        assert json.loads(checkpoint.read_text()) == {"chain_id": 1, "next_block": 6}
+        assert [int(params[0], 16) for params in node.params("eth_getBlockByNumber")] == [4, 5]
+    run(test)
+
+def test_rejects_checkpoint_of_other_chain(tmp_path):
+    checkpoint = tmp_path / "checkpoint.json"
+    checkpoint.write_text(json.dumps({"chain_id": 5, "next_block": 3}))
+    async def test(node):
+        scanner, output = scan(node, checkpoint, 5)
+        with pytest.raises(ValueError):
+            await scanner.run()
+    run(test)
+
+def test_retries_blocks_after_node_errors(tmp_path):
+    checkpoint = tmp_path / "checkpoint.json"
+    async def test(node):
+        node.errors = {"eth_blockNumber": 1, "eth_getBlockByNumber": 2, "eth_getTransactionReceipt": 1}
+        scanner, output = scan(node, checkpoint, 5, block_batch_size=2)
+        await scanner.run()
+        assert sorted(result["address"] for result in results(output)) == [address(1), address(3), address(5)]
+        assert json.loads(checkpoint.read_text()) == {"chain_id": 1, "next_block": 6}
+        assert not any(node.errors.values())
+    run(test)
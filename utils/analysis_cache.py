@@ -0,0 +1,185 @@
+import io
+import os
+import json
+import pickle
+import hashlib
+import inspect
+import tempfile
+import time
+from functools import lru_cache
+from utils import disassembly
+from utils import evm_ops
+from utils import stack_mapping
+from utils import evm_cfg
+from utils import exploration
+from utils import visualization
+from utils import generate_cfg
+from utils import metrics
+
+CACHE_DIR = os.environ.get("ANALYSIS_CACHE_DIR", "cache")
+# Seconds after which the code at a known address is fetched from the RPC node again, see `lookup_address`
+ADDRESS_TTL = float(os.environ.get("ADDRESS_INDEX_TTL", 3600))
+
+# Bump this whenever the output of an analysis changes, so that entries computed by older code are not used anymore.
+# Changes to the code that builds the graphs are picked up automatically, see `analysis_version`.
+ANALYSIS_VERSION = 1
+
+# Modules whose code determines the cached graphs: the disassembly, the operation normalization and its usage
+# categories, the basic blocks, the exploration and the export of the graph
+ANALYSIS_MODULES = [disassembly, evm_ops, stack_mapping, evm_cfg, exploration, visualization, generate_cfg]
+
+@lru_cache(maxsize=None)
+def analysis_version():
+    # The normalized block text and the edges are what the models see, so any change to the code producing them has
+    # to invalidate the cached graphs. The state and edge budgets decide where a partial graph is cut off and the context
+    # bound which states are merged, graphs explored with other bounds are kept apart. Graphs cut off by the time
+    # budget are never cached, see `pipeline`.
+    sources = "\n".join(inspect.getsource(module) for module in ANALYSIS_MODULES)
+    budgets = f"{exploration.DEFAULT_MAX_STATES}\n{exploration.DEFAULT_MAX_EDGES}\n{exploration.DEFAULT_MAX_CONTEXTS}"
+    return hashlib.sha256(f"{ANALYSIS_VERSION}\n{budgets}\n{sources}".encode()).hexdigest()[:16]
+
+# Content address of a contract, the sha256 of its runtime bytecode
+def code_hash(bytecode):
+    return hashlib.sha256(bytecode).hexdigest()
+
+# Kind of a cache entry as reported in the metrics, entries that are versioned by their name count as one kind
+def _entry_kind(name):
+    if name.startswith(("scores-", "wl-")):
+        return name.split("-")[0]
+    return name
+
+def _write_atomic(path, data):
+    _write_atomic_with(path, lambda f: f.write(data))
+
+# Write the file at `path` with `write`, which gets the binary file to write to. It is written to a temporary file
+# first, so that concurrent readers never see a partially written entry.
+def _write_atomic_with(path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+# Cache of analysis results keyed by the hash of the runtime bytecode, so that byte-identical contracts deployed
+# at different addresses or on different chains share their results.
+#
+# Layout of the cache directory:
+#   objects/<hash[:2]>/<hash>/code.bin            the runtime bytecode
+#   objects/<hash[:2]>/<hash>/<version>/<name>    analysis results, see `get` and `put`
+#   chains/<chain id>/<address>                   code hash of the contract deployed at the address
+class AnalysisCache:
+    def __init__(self, root=CACHE_DIR, version=None):
+        self.root = root
+        self.version = version if version is not None else analysis_version()
+
+    def object_dir(self, code_hash):
+        return os.path.join(self.root, "objects", code_hash[:2], code_hash)
+
+    def path(self, code_hash, name):
+        return os.path.join(self.object_dir(code_hash), self.version, name)
+
+    # Load an analysis result. The format is chosen by the extension of `name`: ".json" and ".pickle" entries are
+    # decoded accordingly, anything else is returned as text. Returns None if the entry doesn't exist.
+    def get(self, code_hash, name):
+        path = self.path(code_hash, name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            metrics.cache_lookups.inc(entry=_entry_kind(name), result="miss")
+            return None
+        metrics.cache_lookups.inc(entry=_entry_kind(name), result="hit")
+        if name.endswith(".json"):
+            return json.loads(data)
+        elif name.endswith(".pickle"):
+            return pickle.loads(data)
+        else:
+            return data.decode()
+
+    def put(self, code_hash, name, value):
+        if name.endswith(".json"):
+            data = json.dumps(value).encode()
+        elif name.endswith(".pickle"):
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            data = value.encode()
+        _write_atomic(self.path(code_hash, name), data)
+
+    # The path of a text entry, for reading it without loading it into memory. Returns None if the entry doesn't exist.
+    def entry_path(self, code_hash, name):
+        path = self.path(code_hash, name)
+        if not os.path.exists(path):
+            metrics.cache_lookups.inc(entry=_entry_kind(name), result="miss")
+            return None
+        metrics.cache_lookups.inc(entry=_entry_kind(name), result="hit")
+        return path
+
+    # Store a text entry written by `write`, which gets the text file to write to, so that large entries don't have to
+    # be held in memory. Returns the path of the entry.
+    def put_stream(self, code_hash, name, write):
+        path = self.path(code_hash, name)
+        def write_text(f):
+            text = io.TextIOWrapper(f, encoding="utf-8")
+            write(text)
+            # Leave closing the file to `_write_atomic_with`
+            text.flush()
+            text.detach()
+        _write_atomic_with(path, write_text)
+        return path
+
+    # Load an analysis result, computing and storing it first if it isn't cached yet
+    def get_or_compute(self, code_hash, name, compute):
+        value = self.get(code_hash, name)
+        if value is None:
+            value = compute()
+            self.put(code_hash, name, value)
+        return value
+
+    def get_bytecode(self, code_hash):
+        try:
+            with open(os.path.join(self.object_dir(code_hash), "code.bin"), "rb") as f:
+                bytecode = f.read()
+        except FileNotFoundError:
+            metrics.cache_lookups.inc(entry="bytecode", result="miss")
+            return None
+        metrics.cache_lookups.inc(entry="bytecode", result="hit")
+        return bytecode
+
+    # Store the runtime bytecode and return its code hash
+    def put_bytecode(self, bytecode):
+        h = code_hash(bytecode)
+        path = os.path.join(self.object_dir(h), "code.bin")
+        if not os.path.exists(path):
+            _write_atomic(path, bytecode)
+        return h
+
+    def index_path(self, chain_id, address):
+        return os.path.join(self.root, "chains", str(chain_id), address.lower())
+
+    # Code hash of the contract at `address` on the chain with `chain_id`, None if it hasn't been fetched yet or was
+    # fetched more than `max_age` seconds ago. The code at an address can change, e.g. when a contract that destroyed
+    # itself is deployed again with CREATE2, so entries have to be checked against the chain again after a while.
+    def lookup_address(self, chain_id, address, max_age=None):
+        path = self.index_path(chain_id, address)
+        try:
+            with open(path) as f:
+                code_hash = f.read().strip()
+            # The entry is rewritten every time the address is fetched, its modification time is when it was last checked
+            stale = max_age is not None and time.time() - os.stat(path).st_mtime > max_age
+        except FileNotFoundError:
+            stale = True
+        if stale:
+            metrics.cache_lookups.inc(entry="address", result="miss")
+            return None
+        metrics.cache_lookups.inc(entry="address", result="hit")
+        return code_hash
+
+    def index_address(self, chain_id, address, code_hash):
+        _write_atomic(self.index_path(chain_id, address), code_hash.encode())
+
+# The cache shared by everything running in this process
+cache = AnalysisCache()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import os
+import sys
+import mmap
+import struct
+import numpy as np
+import networkx as nx
+from utils.evm_ops import VOCABULARY
+
+# Compact binary format of a control flow graph, laid out so that it can be memory-mapped and used without parsing.
+# All integers are little-endian, every section starts at a multiple of 8 bytes:
+#   header          magic, format version and the sizes of the sections, see `HEADER`
+#   edge_indptr     uint32[nodes + 1]   CSR offsets: the successors of node i are edge_indices[edge_indptr[i]:edge_indptr[i+1]]
+#   edge_indices    uint32[edges]       target node of each edge
+#   token_indptr    uint32[nodes + 1]   the label of node i is made of tokens[token_indptr[i]:token_indptr[i+1]]
+#   tokens          uint32[tokens]      token IDs, indices into the string table
+#   string_indptr   uint32[strings + 1] byte offsets of each string in string_data
+#   string_data     uint8[string_bytes] the UTF-8 encoded strings, concatenated
+# A node's label is the concatenation of its tokens, which are the lines of the label including their newline. The
+# string table starts with `evm_ops.VOCABULARY`, so the ID of a normalized operation is its index in the vocabulary.
+# Lines that aren't normalized operations, like the block addresses, follow after them.
+MAGIC = b"CFGB"
+VERSION = 1
+HEADER = struct.Struct("<4sIIIIII")
+
+def _align(offset):
+	return (offset + 7) & ~7
+
+# Write the graph `G` in the binary format to the binary file-like object `file`. `G` is a graph as returned by
+# `generate_cfg.ControlFlowGraph.to_networkx` or `infer_models.load_file`, nodes are stored in the order of `G.nodes`.
+def write_cfg(G, file):
+	node_ids = {node: idx for idx, node in enumerate(G.nodes)}
+
+	edge_indptr = np.zeros(len(node_ids) + 1, dtype="<u4")
+	edge_indices = np.empty(G.number_of_edges(), dtype="<u4")
+	token_indptr = np.zeros(len(node_ids) + 1, dtype="<u4")
+	tokens = []
+	string_ids = {token: token_id for token_id, token in enumerate(VOCABULARY)}
+
+	num_edges = 0
+	for node, idx in node_ids.items():
+		for target in G.successors(node):
+			edge_indices[num_edges] = node_ids[target]
+			num_edges += 1
+		edge_indptr[idx + 1] = num_edges
+
+		for line in G.nodes[node].get("label", "").splitlines(keepends=True):
+			token_id = string_ids.get(line)
+			if token_id is None:
+				token_id = string_ids[line] = len(string_ids)
+			tokens.append(token_id)
+		token_indptr[idx + 1] = len(tokens)
+
+	strings = [string.encode() for string in string_ids]
+	string_indptr = np.zeros(len(strings) + 1, dtype="<u4")
+	np.cumsum([len(string) for string in strings], out=string_indptr[1:])
+	string_data = b"".join(strings)
+
+	sections = [edge_indptr, edge_indices, token_indptr, np.array(tokens, dtype="<u4"), string_indptr, np.frombuffer(string_data, dtype="u1")]
+	file.write(HEADER.pack(MAGIC, VERSION, len(node_ids), num_edges, len(tokens), len(strings), len(string_data)))
+	offset = HEADER.size
+	for section in sections:
+		padding = _align(offset) - offset
+		file.write(b"\0" * padding)
+		file.write(section.tobytes())
+		offset += padding + section.nbytes
+
+def save_cfg(G, path):
+	with open(path, "wb") as f:
+		write_cfg(G, f)
+
+# A control flow graph in the binary format. The arrays are views into `buffer`, nothing is copied or decoded
+# until a label is asked for.
+class BinaryCfg:
+	def __init__(self, buffer):
+		self.buffer = buffer
+		magic, version, num_nodes, num_edges, num_tokens, num_strings, string_bytes = HEADER.unpack_from(buffer)
+		if magic != MAGIC:
+			raise ValueError("Not a binary control flow graph")
+		if version != VERSION:
+			raise ValueError(f"Unsupported binary control flow graph version {version}, expected {VERSION}")
+
+		offset = HEADER.size
+		arrays = []
+		for dtype, count in [("<u4", num_nodes + 1), ("<u4", num_edges), ("<u4", num_nodes + 1), ("<u4", num_tokens), ("<u4", num_strings + 1), ("u1", string_bytes)]:
+			offset = _align(offset)
+			array = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+			arrays.append(array)
+			offset += array.nbytes
+		self.edge_indptr, self.edge_indices, self.token_indptr, self.tokens, self.string_indptr, self.string_data = arrays
+		self.strings = [None] * num_strings
+
+	def __len__(self):
+		return len(self.edge_indptr) - 1
+
+	def num_edges(self):
+		return len(self.edge_indices)
+
+	def string(self, string_id):
+		string = self.strings[string_id]
+		if string is None:
+			string = self.strings[string_id] = bytes(self.string_data[self.string_indptr[string_id]:self.string_indptr[string_id + 1]]).decode()
+		return string
+
+	def successors(self, node):
+		return self.edge_indices[self.edge_indptr[node]:self.edge_indptr[node + 1]]
+
+	# The token IDs of the node's label, indices into the string table
+	def token_ids(self, node):
+		return self.tokens[self.token_indptr[node]:self.token_indptr[node + 1]]
+
+	def label(self, node):
+		return "".join(self.string(token_id) for token_id in self.token_ids(node).tolist())
+
+	# The graph as `infer_models.load_file` returns it for the .dot export of the same graph
+	def to_networkx(self):
+		# Decode the whole string table at once, it is small compared to the labels built from it
+		data = self.string_data.tobytes()
+		string_indptr = self.string_indptr.tolist()
+		strings = [data[string_indptr[idx]:string_indptr[idx + 1]].decode() for idx in range(len(string_indptr) - 1)]
+		tokens = [strings[token_id] for token_id in self.tokens.tolist()]
+		token_indptr = self.token_indptr.tolist()
+
+		G = nx.DiGraph()
+		G.add_nodes_from((node, {"label": "".join(tokens[token_indptr[node]:token_indptr[node + 1]])}) for node in range(len(self)))
+		sources = np.repeat(np.arange(len(self)), np.diff(self.edge_indptr))
+		G.add_edges_from(zip(sources.tolist(), self.edge_indices.tolist()))
+		return G
+
+# Memory-map the binary control flow graph at `path`
+def load_cfg(path):
+	with open(path, "rb") as f:
+		return BinaryCfg(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+# Convert an existing .dot file to the binary format
+def convert_dot(dot_file, cfg_file):
+	# Imported here, so that reading binary graphs doesn't need pygraphviz
+	from utils.infer_models import load_file
+	save_cfg(load_file(dot_file), cfg_file)
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print(f"Usage: {sys.argv[0]} <dot_file> [<dot_file> ...]")
+		print("Writes a .cfgb file next to each .dot file")
+		sys.exit(1)
+	for dot_file in sys.argv[1:]:
+		cfg_file = os.path.splitext(dot_file)[0] + ".cfgb"
+		convert_dot(dot_file, cfg_file)
+		print(f"{dot_file} -> {cfg_file}")
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+from array import array
+from functools import lru_cache
+import pyevmasm
+
+# Fork the instructions are decoded for, opcodes that are undefined in it decode as INVALID
+FORK = pyevmasm.evmasm.DEFAULT_FORK
+
+# Opcodes used by the passes over the decoded bytecode
+DUP1 = 0x80
+SWAP1 = 0x90
+EQ = 0x14
+LT = 0x10
+GT = 0x11
+JUMPI = 0x57
+PUSH1 = 0x60
+PUSH4 = 0x63
+PUSH32 = 0x7f
+
+# Size of the immediate value of each opcode, only the PUSHes have one
+IMMEDIATE_SIZE = bytes(opcode - PUSH1 + 1 if PUSH1 <= opcode <= PUSH32 else 0 for opcode in range(256))
+
+def _instruction(opcode):
+	instruction = pyevmasm.instruction_tables[FORK].get(opcode, None)
+	if instruction is None:
+		instruction = pyevmasm.evmasm.Instruction(opcode, "INVALID", 0, 0, 0, 0, "Unspecified invalid instruction.")
+	return instruction
+
+# Name of each opcode, and the number of stack items it pops and pushes
+NAMES = tuple(_instruction(opcode).name for opcode in range(256))
+POPS = bytes(_instruction(opcode).pops for opcode in range(256))
+PUSHES = bytes(_instruction(opcode).pushes for opcode in range(256))
+
+# Kind of each opcode as far as the stack analysis is concerned
+OTHER, PUSH, POP, DUP, SWAP = range(5)
+KINDS = bytes(
+	PUSH if name[:4] == "PUSH" else POP if name == "POP" else DUP if name[:3] == "DUP" else SWAP if name[:4] == "SWAP" else OTHER
+	for name in NAMES
+)
+
+# Whether the opcode starts a new basic block, and whether it ends the current one
+STARTS_BLOCK = bytes(NAMES[opcode] == "JUMPDEST" for opcode in range(256))
+ENDS_BLOCK = bytes(NAMES[opcode] in ["JUMP", "JUMPI", "STOP", "REVERT", "RETURN", "INVALID", "SELFDESTRUCT"] for opcode in range(256))
+
+# The bytecode split into its instructions: the opcode and the offset of each instruction, in flat arrays.
+# The immediate value of a PUSH is not copied out, it is the slice of `code` following the opcode.
+class Disassembly:
+	__slots__ = ("code", "opcodes", "offsets")
+
+	def __init__(self, code, opcodes, offsets):
+		# The raw bytecode
+		self.code = code
+		# The opcode of each instruction
+		self.opcodes = opcodes
+		# The offset of each instruction in `code`
+		self.offsets = offsets
+
+	def __len__(self):
+		return len(self.opcodes)
+
+	# The immediate value of the instruction at index `idx` as an int
+	def immediate(self, idx):
+		offset = self.offsets[idx]
+		return int.from_bytes(self.code[offset+1:offset+1+IMMEDIATE_SIZE[self.opcodes[idx]]], "big")
+
+	# End offset of the instruction at index `idx`
+	def end(self, idx):
+		return self.offsets[idx] + 1 + IMMEDIATE_SIZE[self.opcodes[idx]]
+
+def _disassemble(code):
+	opcodes = bytearray()
+	offsets = array("I")
+	pos = 0
+	size = len(code)
+	while pos < size:
+		opcode = code[pos]
+		end = pos + 1 + IMMEDIATE_SIZE[opcode]
+		if end > size:
+			# A push that implies data beyond the end of the bytecode ends the disassembly, like it does in pyevmasm
+			break
+		opcodes.append(opcode)
+		offsets.append(pos)
+		pos = end
+	return Disassembly(code, bytes(opcodes), offsets)
+
+# Decode the bytecode into its instructions. The result is cached, so the selector extraction and the CFG construction
+# of the same bytecode share one decoding pass.
+@lru_cache(maxsize=32)
+def _disassemble_cached(code):
+	return _disassemble(code)
+
+def disassemble(evm_bytecode):
+	return _disassemble_cached(bytes(evm_bytecode))
+
+# The function selectors the dispatcher compares the calldata against. The dispatcher is made of
+#   [DUP1] PUSH<=4 selector EQ PUSH target JUMPI
+# comparisons, which larger contracts split up with
+#   DUP1 PUSH4 pivot GT|LT PUSH target JUMPI
+# comparisons into a binary search over the selectors. The pivots are selectors as well.
+# Selectors are returned as 4-byte values in the order they appear, duplicates included.
+def find_selectors(disassembly):
+	code = disassembly.code
+	opcodes = disassembly.opcodes
+	selectors = []
+	# The earliest instruction a pattern can start at is a PUSH followed by 3 more instructions
+	for idx in range(len(opcodes) - 3):
+		opcode = opcodes[idx]
+		if not PUSH1 <= opcode <= PUSH4:
+			continue
+		compare = opcodes[idx+1]
+		if not PUSH1 <= opcodes[idx+2] <= PUSH32 or opcodes[idx+3] != JUMPI:
+			continue
+		if compare == EQ:
+			pass
+		elif compare in (GT, LT) and opcode == PUSH4 and idx > 0 and opcodes[idx-1] == DUP1:
+			# Only full 4-byte pivots of a DUP1'd selector, range checks of other values don't look like this
+			if disassembly.immediate(idx) == 0xffffffff:
+				continue
+		else:
+			continue
+		offset = disassembly.offsets[idx]
+		# Shorter pushes are selectors with leading zero bytes
+		selectors.append(code[offset+1:offset+2+opcode-PUSH1].rjust(4, b"\x00"))
+	return selectors
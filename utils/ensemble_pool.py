@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import os
+import threading
+import multiprocessing
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from utils import metrics
+from utils.model_registry import registry
+
+# Number of worker processes used to score ensembles, 0 scores everything in the calling process. Only used where
+# `infer_models` is called directly, e.g. by scripts: the analyses of the routes and the scanner run in the workers of
+# `executor.BoundedExecutor`, which score serially.
+DEFAULT_WORKERS = int(os.environ.get("AUDIT_WORKERS", 0))
+
+# Number of graphs scored by one task, so that large batches are spread over the workers as well
+DEFAULT_CHUNK_SIZE = int(os.environ.get("AUDIT_CHUNK_SIZE", 64))
+
+def _init_worker():
+	# Each worker runs one model at a time, letting torch spawn a thread per core in every worker would oversubscribe the machine
+	torch.set_num_threads(1)
+
+# Score graphs, given by their feature `documents`, with one model of the ensemble. Runs inside the worker processes,
+# the models are taken from the worker's own registry so they are only loaded once per worker and never shipped with
+# the tasks.
+def score_member(token_type, version, member_idx, documents):
+	ensemble = registry.get(token_type)
+	if ensemble.version != version:
+		raise RuntimeError(f"Models for token_type {token_type} changed while auditing")
+	return ensemble.members[member_idx].score_documents(documents)
+
+# Persistent pool of worker processes that score ensemble members in parallel
+class EnsemblePool:
+	def __init__(self, workers, chunk_size=DEFAULT_CHUNK_SIZE):
+		self.workers = workers
+		self.chunk_size = chunk_size
+		self.executor = None
+		self.lock = threading.Lock()
+
+	def get_executor(self):
+		with self.lock:
+			if self.executor is None:
+				# Forked workers share the parent's string hash seed, which Doc2Vec uses to initialise inferred vectors.
+				# This keeps the scores identical to the ones computed in the parent process.
+				self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("fork"), initializer=_init_worker)
+				# A pool with the fork context starts all of its workers on the first task, make that happen now
+				self.executor.submit(int).result()
+			return self.executor
+
+	# Start the worker processes before the calling process starts threads of its own, see `executor.BoundedExecutor.start`.
+	# `infer_models.audit_contracts` calls it before the models are loaded, as torch may start its threads then.
+	def start(self):
+		self.get_executor()
+
+	# Scores of each model of `ensemble` for all graphs, indexed by model and then by graph. `features` maps each of
+	# `ensemble.wl_params()` to the feature documents of the graphs.
+	def score(self, ensemble, features):
+		executor = self.get_executor()
+		futures = []
+		for member_idx, member in enumerate(ensemble.members):
+			documents = features[member.wl_params]
+			chunks = [documents[offset:offset+self.chunk_size] for offset in range(0, len(documents), self.chunk_size)]
+			futures.append([
+				executor.submit(metrics.collect, score_member, ensemble.token_type, ensemble.version, member_idx, chunk)
+				for chunk in chunks
+			])
+		# Put the chunks back together in their original order, along with the metrics recorded by the workers
+		model_scores = []
+		for member_futures in futures:
+			scores = []
+			for future in member_futures:
+				chunk_scores, collected = future.result()
+				metrics.merge(collected)
+				scores.extend(chunk_scores)
+			model_scores.append(scores)
+		return model_scores
+
+	def shutdown(self):
+		with self.lock:
+			if self.executor is not None:
+				self.executor.shutdown()
+				self.executor = None
+
+# The pool shared by everything running in this process, None if ensembles are scored serially
+pool = EnsemblePool(DEFAULT_WORKERS) if DEFAULT_WORKERS > 0 else None
@@ -1,84 +1,88 @@
 #!/usr/bin/env python3
 import pyevmasm
-from utils.evm_ops import normalize_op
-from utils.stack_mapping import StackMapping
+from utils.disassembly import disassemble, NAMES, STARTS_BLOCK, ENDS_BLOCK
+from utils.evm_ops import normalize_ops
+from utils.stack_mapping import stack_mapping, OPCODES
+
+# Opcodes after which the control flow can't simply continue with the next instruction
+NO_FALLTROUGH = bytes(NAMES[opcode] in ["JUMP", "STOP", "REVERT", "RETURN", "INVALID", "SELFDESTRUCT"] for opcode in range(256))
+JUMP = OPCODES["JUMP"]
+JUMPI = OPCODES["JUMPI"]
 
 # Represents a "basic block"
 class Block:
-	def __init__(self, start_addr, ops):
+	__slots__ = ("start_addr", "disassembly", "start_idx", "end_idx", "can_falltrough", "can_jump", "falltrough_addr", "stack_mapping", "jump_dest_stack_index", "jump_dest")
+
+	def __init__(self, disassembly, start_idx, end_idx):
         # The address at which this block starts
-		self.start_addr = start_addr
-        # The list of decoded operations this block consists of
-		self.ops = ops
+		self.start_addr = disassembly.offsets[start_idx]
+        # The block consists of the instructions `start_idx` up to (excluding) `end_idx` of the decoded bytecode
+		self.disassembly = disassembly
+		self.start_idx = start_idx
+		self.end_idx = end_idx
+		last_opcode = disassembly.opcodes[end_idx - 1]
 		# Whether or not it is possible for the control flow to simply continue unaltered after the block
-		self.can_falltrough = not self.ops[-1].name in ["JUMP", "STOP", "REVERT", "RETURN", "INVALID", "SELFDESTRUCT"]
+		self.can_falltrough = not NO_FALLTROUGH[last_opcode]
         # Whether or not this block can make a jump
-		self.can_jump = self.ops[-1].name in ["JUMP", "JUMPI"]
+		self.can_jump = last_opcode == JUMP or last_opcode == JUMPI
         # The address at which the control flow resumes after this block if it doesn't jump
-		self.falltrough_addr = start_addr
-		for op in ops:
-			self.falltrough_addr += op.size
+		self.falltrough_addr = disassembly.end(end_idx - 1)
         # Used for operand normalization and to resolve jump destinations
-		self.stack_mapping = StackMapping(ops)
+		self.stack_mapping = stack_mapping(disassembly.code[self.start_addr:self.falltrough_addr])
         # The stack index on the preexisting stack from which this basic block will read a jump destination.
-		self.jump_dest_stack_index = None
+		self.jump_dest_stack_index = self.stack_mapping.jump_dest_stack_index
         # Statically known jump destination
-		self.jump_dest = None
-		if self.can_jump:
-          # Create a stack mapping for this block but exclude the final jump instruction.
-            # This means that the topmost item on the stack at this point will be the jump destination
-			stack_mapping_for_jump = StackMapping(ops[:-1])
-			if len(stack_mapping_for_jump.pushed) == 0:
-                # If there aren't any stack items pushed by ourselves, the topmost item is the topmost remaining stack item after our pops
-				self.jump_dest_stack_index = stack_mapping_for_jump.num_poped
-			elif isinstance(stack_mapping_for_jump.pushed[-1], int):
-                # If the topmost item is a back-reference, we maintain that back-reference as-is.
-				self.jump_dest_stack_index = stack_mapping_for_jump.pushed[-1]
-			elif isinstance(stack_mapping_for_jump.pushed[-1], bytes):
-                # If the topmost item is a literal we have a static jump destination                
-				self.jump_dest = int.from_bytes(stack_mapping_for_jump.pushed[-1], "big")
-            # Otherwise, it is None, meaning that we don't know.
+		self.jump_dest = self.stack_mapping.jump_dest
+
+	# The opcodes of the block's instructions
+	@property
+	def opcodes(self):
+		return self.disassembly.opcodes[self.start_idx:self.end_idx]
+
+	# The block's instructions as pyevmasm `Instruction`s, decoded on demand
+	@property
+	def ops(self):
+		code = self.disassembly.code[self.start_addr:self.falltrough_addr]
+		return list(pyevmasm.evmasm.disassemble_all(code, pc=self.start_addr))
 	
+	# The normalized tokens of the block's operations, see `evm_ops.normalize_op`
+	def tokens(self):
+		return normalize_ops(self.opcodes, self.stack_mapping.value_usage_type)
+
     # Express this basic block in a normalized form
 	def as_text(self):
-        # Prepend the block's address
-		text = "# " + hex(self.start_addr) + "\n"
-        # Append the normalized representation of each operations. Note that `normalize_op` may return an empty string to drop the operation.
-		for op_idx, op in enumerate(self.ops):
-			text = text + normalize_op(op, self.stack_mapping.value_usage_type.get(op_idx))
-		return text
+        # The block's address followed by the normalized representation of each operation. Operations that `normalize_op` drops don't appear.
+		return "# " + hex(self.start_addr) + "\n" + "".join(self.tokens())
 
 
 # Segregate the bytecode into basic blocks
 def create_basic_blocks(evm_bytecode):
+	# The decoded instructions, shared with the selector extraction
+	disassembly = disassemble(evm_bytecode)
+	opcodes = disassembly.opcodes
+
     # Finalized blocks, the key is their starting address
 	blocks = {}
 	
-    # Info for the current non-finalized block
+    # Index of the first instruction of the current non-finalized block
 	current_block_start = 0
-	current_block_ops = []
 	
-    # Current address in the bytecode
-	asm_pos = 0
-	
-	for op in pyevmasm.evmasm.disassemble_all(evm_bytecode):
+	for op_idx, opcode in enumerate(opcodes):
         # If there are any previous instructions not part of a finalized block, a JUMPDEST means that the previous block has ended and needs to be finalized
-		if op.name == "JUMPDEST" and not len(current_block_ops) == 0:
-			blocks[current_block_start] = Block(current_block_start, current_block_ops)
-			current_block_start = asm_pos
-			current_block_ops = []
-		
-		current_block_ops.append(op)
-		asm_pos += op.size
+		if STARTS_BLOCK[opcode] and current_block_start < op_idx:
+			block = Block(disassembly, current_block_start, op_idx)
+			blocks[block.start_addr] = block
+			current_block_start = op_idx
 		
         # Any of these instructions signal the end of a block.
-		if op.name in ["JUMP", "JUMPI", "STOP", "REVERT", "RETURN", "INVALID", "SELFDESTRUCT"]:
-			blocks[current_block_start] = Block(current_block_start, current_block_ops)
-			current_block_start = asm_pos
-			current_block_ops = []
+		if ENDS_BLOCK[opcode]:
+			block = Block(disassembly, current_block_start, op_idx + 1)
+			blocks[block.start_addr] = block
+			current_block_start = op_idx + 1
 	
     # If there are any trailing instructions, we finalize them to a block as well.
-	if len(current_block_ops) > 0:
-		blocks[current_block_start] = Block(current_block_start, current_block_ops)
+	if current_block_start < len(opcodes):
+		block = Block(disassembly, current_block_start, len(opcodes))
+		blocks[block.start_addr] = block
 	
 	return blocks
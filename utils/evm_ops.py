@@ -1,11 +1,37 @@
+from utils.disassembly import NAMES
+
+def _token(name):
+    if name[:3] == "LOG": # Normalize LOG* operations to LOGX
+        return "LOGX\n"
+    elif name[:4] == "PUSH":
+        # PUSHes depend on how their value is used, see `normalize_op`
+        return None
+    elif name[:3] == "DUP" or name[:4] == "SWAP" or name == "POP":
+        # Eliminate all DUPs, SWAPs and POPs
+        return ""
+    else:
+        # All other operations will be maintained as-is.
+        return name + "\n"
+
+# Normalized representation of each opcode, None for the PUSHes
+TOKENS = tuple(_token(name) for name in NAMES)
+
+# Normalized representation of the PUSHes for each usage category of their value
+PUSH_TOKENS = {
+    category: "PUSHX " + category + "\n"
+    for category in ["Data", "ArithData", "BlockData", "LogicData", "MemData", "StorData", "BitData"]
+}
+
+# All normalized tokens, a token's index in this tuple is its token ID
+VOCABULARY = tuple(dict.fromkeys([token for token in TOKENS if token] + list(PUSH_TOKENS.values())))
+
 # Normalize individual operations
 # In case of a PUSH operation, `data_categories` is a list of strings describing how the immediate value is used
 # The return value is the normalized string representation of the operation, including a newline
 # unless the operation should be normalized out entirely, in that case it is an empty string
-def normalize_op(op, data_categories):
-    if op.name[:3] == "LOG": # Normalize LOG* operations to LOGX
-        return "LOGX\n"
-    elif op.name[:4] == "PUSH":
+def normalize_op(opcode, data_categories):
+    token = TOKENS[opcode]
+    if token is None:
         # Normalize `PUSH* 0x...` to `PUSHX [Data|ArithData|...]`
         # If data_categories is available and contains exactly one usage type, we
         # normalize the immediate value to it, otherwise we normalize it to just "Data"
@@ -13,10 +39,17 @@ def normalize_op(op, data_categories):
         if data_categories != None:
             if len(data_categories) == 1:
                 cat_str = data_categories[0]
-        return "PUSHX " + cat_str + "\n"
-    elif op.name[:3] == "DUP" or op.name[:4] == "SWAP" or op.name == "POP":
-        # Eliminate all DUPs, SWAPs and POPs
-        return ""
-    else:
-        # All other operations will be maintained as-is.
-        return op.name + "\n"
+        return PUSH_TOKENS[cat_str]
+    return token
+
+# The normalized tokens of a sequence of operations, given by their `opcodes` and the `value_usage_type` of their
+# stack mapping. Operations that are normalized out are left out.
+def normalize_ops(opcodes, value_usage_type):
+    tokens = []
+    for op_idx, opcode in enumerate(opcodes):
+        token = TOKENS[opcode]
+        if token is None:
+            token = normalize_op(opcode, value_usage_type.get(op_idx))
+        if token:
+            tokens.append(token)
+    return tokens
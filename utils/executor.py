@@ -0,0 +1,90 @@
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from utils import ensemble_pool
+from utils import metrics
+
+# Number of processes running CPU-heavy analyses (CFG recovery, inference)
+DEFAULT_WORKERS = int(os.environ.get("EXECUTOR_WORKERS", os.cpu_count() or 1))
+# Number of analyses that may be queued or running at the same time before new ones are rejected
+DEFAULT_MAX_PENDING = int(os.environ.get("EXECUTOR_MAX_PENDING", 2 * DEFAULT_WORKERS))
+# Seconds a request waits for its analysis before giving up
+DEFAULT_TIMEOUT = float(os.environ.get("EXECUTOR_TIMEOUT", 120))
+
+class ExecutorFull(Exception):
+    pass
+
+def _init_worker():
+    # The analyses already run in parallel in the executor's workers. A pool of ensemble workers in each of them would
+    # start EXECUTOR_WORKERS * AUDIT_WORKERS processes, each with its own copy of the models, so they score serially.
+    ensemble_pool.pool = None
+
+# Process pool for the CPU-heavy parts of the request handlers. It accepts at most `max_pending` analyses at a time,
+# so that a burst of audits is turned away early instead of piling up behind each other, and requests stop waiting
+# for their result after `timeout` seconds.
+class BoundedExecutor:
+    def __init__(self, max_workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING, timeout=DEFAULT_TIMEOUT):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self.executor = None
+
+    def get_executor(self):
+        if self.executor is None:
+            # Forked workers share the parent's string hash seed, which keeps their audit scores identical to the parent's
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("fork"), initializer=_init_worker)
+            # A pool with the fork context starts all of its workers on the first task, make that happen now
+            self.executor.submit(int).result()
+        return self.executor
+
+    # Start the worker processes. Forking a process that runs threads only copies the calling thread, along with any
+    # lock another thread held at that moment, so this is called before the process starts any threads, e.g. in the
+    # startup hook of the web worker. The pool is still started on the first analysis if this wasn't called.
+    def start(self):
+        self.get_executor()
+
+    # Run `fn(*args)` in a worker process and wait for the result.
+    # Raises ExecutorFull if too many analyses are pending and asyncio.TimeoutError if it takes too long. A timed out
+    # analysis keeps its worker busy until it finishes, the budgets in `exploration` make sure this doesn't take forever.
+    # It also keeps its slot until then, so that timed out analyses can't pile up in the pool's queue.
+    # The metrics the analysis records in the worker are added to this process' metrics, unless it timed out.
+    async def run(self, fn, *args, timeout=None):
+        if self.pending >= self.max_pending:
+            metrics.executor_rejected.inc(reason="full")
+            raise ExecutorFull(f"Too many analyses in progress ({self.pending}), try again later.")
+        self.pending += 1
+        metrics.executor_pending.set(self.pending)
+        try:
+            future = self.get_executor().submit(metrics.collect, fn, *args)
+        except BaseException:
+            self.release()
+            raise
+
+        loop = asyncio.get_running_loop()
+        def done(_):
+            # Called from the pool's thread once the analysis is done, whether or not the request still waits for it
+            try:
+                loop.call_soon_threadsafe(self.release)
+            except RuntimeError:
+                # The event loop is closed already
+                pass
+        future.add_done_callback(done)
+
+        try:
+            result, collected = await asyncio.wait_for(asyncio.wrap_future(future), timeout if timeout is not None else self.timeout)
+        except asyncio.TimeoutError:
+            metrics.executor_rejected.inc(reason="timeout")
+            raise
+        metrics.merge(collected)
+        return result
+
+    def release(self):
+        self.pending -= 1
+        metrics.executor_pending.set(self.pending)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import os
+import time
+from utils.stack_mapping import SharedStacks
+
+# The EVM itself never allows more than 1024 items on the stack, so bounding the abstract stack to this
+# depth does not lose any information on valid executions.
+DEFAULT_MAX_STACK_DEPTH = 1024
+
+# By default every block may be reached with any number of distinct stacks and contexts, which yields exactly the
+# same edges as enumerating all execution paths. Set CFG_MAX_CONTEXTS in the environment of the worker to bound them,
+# e.g. on contracts with many branches in a row, whose number of contexts grows exponentially.
+DEFAULT_MAX_CONTEXTS = int(os.environ["CFG_MAX_CONTEXTS"]) if os.environ.get("CFG_MAX_CONTEXTS") else None
+
+# Per-contract budgets for the exploration. Once any of them is exhausted the exploration stops and returns the
+# graph built so far, see `Exploration.partial`. They can be tuned through the environment of the worker.
+DEFAULT_MAX_SECONDS = float(os.environ.get("CFG_MAX_SECONDS", 30))
+DEFAULT_MAX_STATES = int(os.environ.get("CFG_MAX_STATES", 500000))
+DEFAULT_MAX_EDGES = int(os.environ.get("CFG_MAX_EDGES", 200000))
+
+# Result of walking the control flow graph of a contract
+class Exploration:
+	def __init__(self, max_stack_depth, max_contexts):
+		# List of (from_block, to_block) tuples in the order in which they were discovered
+		self.known_edges = []
+		# Blocks that have an outgoing edge to the "[anywhere]" block
+		self.anywhere_edges = []
+		# The stack-depth bound the exploration ran with
+		self.max_stack_depth = max_stack_depth
+		# The number of distinct states per block the exploration ran with
+		self.max_contexts = max_contexts
+		# Number of distinct (block, stack, context) states that were registered for exploration
+		self.num_states = 0
+		# Number of states that were taken off the worklist and analysed
+		self.num_iterations = 0
+		# Deepest abstract stack that was encountered, before applying the bound
+		self.max_stack_seen = 0
+		# Number of times a stack had to be cut down to `max_stack_depth`
+		self.num_truncations = 0
+		# Highest number of distinct states registered for a single block
+		self.max_contexts_seen = 0
+		# Number of states that were folded into the block's context-free state because of `max_contexts`
+		self.num_widenings = 0
+		# Whether the exploration stopped early because a budget ran out, and which one ("time", "states" or "edges")
+		self.partial = False
+		self.exhausted_budget = None
+		# Wall time spent exploring, in seconds
+		self.elapsed = 0.0
+
+	def stats(self):
+		return {
+			"states": self.num_states,
+			"iterations": self.num_iterations,
+			"edges": len(self.known_edges),
+			"anywhere_edges": len(self.anywhere_edges),
+			"max_stack_depth": self.max_stack_depth,
+			"max_stack_seen": self.max_stack_seen,
+			"truncations": self.num_truncations,
+			"max_contexts": self.max_contexts,
+			"max_contexts_seen": self.max_contexts_seen,
+			"widenings": self.num_widenings,
+			"partial": self.partial,
+			"exhausted_budget": self.exhausted_budget,
+			"elapsed": round(self.elapsed, 3),
+		}
+
+
+# Walk the control flow graph to discover all possible edges.
+# This is a fixed-point worklist over (block, abstract stack, context) states, where the context is the set of
+# blocks on the path that led to the state. The context is what decides whether entering a block is a recursive
+# situation, so two paths with the same block set and the same stack always yield the same edges and only one of
+# them has to be explored. In cases where we can't determine the jump destination, the jump is considered to go to
+# a special "[anywhere]" block.
+# `max_stack_depth` bounds the abstract stack and `max_contexts` bounds the number of distinct states per block. Once
+# a block reaches that many states, it is analysed further without making assumptions about the stack contents, just
+# like in a recursive situation. Both bounds keep the number of states finite on contracts where enumerating the
+# execution paths explodes.
+# `max_seconds`, `max_states` and `max_edges` are hard budgets. When one of them runs out, the jumps of the blocks
+# that are still waiting to be analysed are routed to "[anywhere]" and the result is marked as partial. Pass None to
+# disable a budget.
+def explore(blocks, max_stack_depth=DEFAULT_MAX_STACK_DEPTH, max_contexts=DEFAULT_MAX_CONTEXTS,
+		max_seconds=DEFAULT_MAX_SECONDS, max_states=DEFAULT_MAX_STATES, max_edges=DEFAULT_MAX_EDGES):
+	start_time = time.monotonic()
+	result = Exploration(max_stack_depth, max_contexts)
+	known_edges = set()
+	anywhere_edges = set()
+
+	# Each block gets a bit in the context mask, so that contexts can be hashed and extended cheaply
+	block_bits = {offset: 1 << idx for idx, offset in enumerate(blocks)}
+
+	# The abstract stacks of all states, each state refers to its stack by its id in this table
+	stacks = SharedStacks()
+	# States that we have already explored or that are registered to be explored in `worklist`
+	registered_states = set()
+	# Number of registered states for each block
+	contexts_per_block = {}
+	# States to be explored. Each state consists of the block, the known stack and the context mask.
+	worklist = []
+
+	def register(block, stack, context):
+		state = (block.start_addr, stack, context)
+		if not state in registered_states:
+			registered_states.add(state)
+			worklist.append((block, stack, context))
+			contexts = contexts_per_block.get(block.start_addr, 0) + 1
+			contexts_per_block[block.start_addr] = contexts
+			if contexts > result.max_contexts_seen:
+				result.max_contexts_seen = contexts
+
+	def new_edge(a, b):
+		if not (a, b) in known_edges:
+			known_edges.add((a, b))
+			result.known_edges.append((a, b))
+
+	def new_edge_to_anywhere(a):
+		if not a in anywhere_edges:
+			anywhere_edges.add(a)
+			result.anywhere_edges.append(a)
+
+	# Follow the edge from `block` to `b`, registering the resulting state for further exploration
+	def try_new_edge(block, b, stack, context):
+		new_edge(block, b)
+
+		bit = block_bits[b.start_addr]
+		if context & bit:
+			# If we are in a recursive situation, continue the analysis without making assumptions about the stack contents
+			register(b, stacks.EMPTY, bit)
+			return
+		if max_contexts != None and contexts_per_block.get(b.start_addr, 0) >= max_contexts:
+			# The block has been reached in too many different ways already, so we do the same as for recursion
+			result.num_widenings += 1
+			register(b, stacks.EMPTY, bit)
+			return
+
+		new_stack = block.stack_mapping.apply_shared(stacks, stack)
+		depth = stacks.depth(new_stack)
+		if depth > result.max_stack_seen:
+			result.max_stack_seen = depth
+		if depth > max_stack_depth:
+			# Forget about the bottom of the stack, later reads from it will be treated as unknown values
+			new_stack = stacks.from_values(stacks.as_tuple(new_stack)[-max_stack_depth:])
+			result.num_truncations += 1
+		register(b, new_stack, context | bit)
+
+	register(blocks[0], stacks.EMPTY, block_bits[0])
+
+	while len(worklist) > 0:
+		# Stop if any of the budgets has been used up
+		if max_seconds != None and time.monotonic() - start_time > max_seconds:
+			result.exhausted_budget = "time"
+		elif max_states != None and len(registered_states) > max_states:
+			result.exhausted_budget = "states"
+		elif max_edges != None and len(known_edges) + len(anywhere_edges) > max_edges:
+			result.exhausted_budget = "edges"
+		if result.exhausted_budget != None:
+			result.partial = True
+			break
+
+		block, stack, context = worklist.pop()
+		result.num_iterations += 1
+		# If the block can perform a jump, determine the jump destination
+		if block.can_jump:
+			jump_dest = block.jump_dest
+			if jump_dest == None and block.jump_dest_stack_index != None:
+				# If the jump destination is not known, but there's a reference to a stack item, check if we have the value
+				jump_dest = stacks.peek(stack, block.jump_dest_stack_index)
+			if jump_dest != None and blocks.get(jump_dest) != None:
+				try_new_edge(block, blocks[jump_dest], stack, context)
+			else:
+				new_edge_to_anywhere(block)
+
+		# Check if the block can fall through, and if the fall through address is valid
+		if block.can_falltrough and blocks.get(block.falltrough_addr) != None:
+			try_new_edge(block, blocks[block.falltrough_addr], stack, context)
+
+	# Whatever is left on the worklist has not been analysed. Edges that don't depend on the stack are still known,
+	# everything else may go anywhere.
+	for block, stack, context in worklist:
+		if block.can_jump:
+			if block.jump_dest != None and blocks.get(block.jump_dest) != None:
+				new_edge(block, blocks[block.jump_dest])
+			else:
+				new_edge_to_anywhere(block)
+		if block.can_falltrough and blocks.get(block.falltrough_addr) != None:
+			new_edge(block, blocks[block.falltrough_addr])
+
+	result.num_states = len(registered_states)
+	result.elapsed = time.monotonic() - start_time
+	return result
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+import os
+import sys
+import pickle
+import numpy as np
+from utils import metrics
+from utils.model_registry import EnsembleMember, graph_features
+
+# Ensemble members frozen into plain NumPy arrays. A frozen member scores graphs without running karateclub, gensim or torch:
+# the Doc2Vec inference is reimplemented on the exported weights and reproduces the scores of the live models up to
+# floating point differences.
+#
+# Graph2Vec trains a PV-DBOW Doc2Vec model with negative sampling. Inferring the vector of a document starts from a
+# vector derived from the document's text and runs `epochs` passes over its words. For every word, the vector is
+# nudged towards the word's output weights and away from the output weights of `negative` randomly drawn words. The
+# draws come from a linear congruential generator that gensim seeds from the model's random state at the start of
+# every pass. `EnsembleMember` restores that random state before each document, so the seeds of the passes are the
+# same for all documents and are exported along with the weights.
+
+# Constants of gensim's Cython routines
+MAX_DOCUMENT_LEN = 10000
+EXP_TABLE_SIZE = 1000
+MAX_EXP = 6
+MIN_ALPHA = 0.00001
+LCG_MULTIPLIER = np.uint64(25214903917)
+LCG_INCREMENT = np.uint64(11)
+LCG_MASK = np.uint64(2**48 - 1)
+
+# Sigmoid lookup table gensim approximates the sigmoid with
+_exp_table = np.exp((np.arange(EXP_TABLE_SIZE, dtype=np.float32) / np.float32(EXP_TABLE_SIZE) * 2 - 1) * MAX_EXP).astype(np.float32)
+EXP_TABLE = (_exp_table / (_exp_table + 1)).astype(np.float32)
+
+# Freeze an `model_registry.EnsembleMember` into a dict of arrays
+def freeze_member(member):
+	graph2vec = member.graph2vec
+	model = graph2vec.model
+	if model.dm or model.hs or not model.negative:
+		raise ValueError(f"Only PV-DBOW models with negative sampling can be frozen, {member.name} isn't one")
+
+	# The seeds gensim draws for the inference passes, starting from the random state `EnsembleMember` restores
+	random = np.random.RandomState()
+	random.set_state(member.rng_state)
+	epoch_seeds = [(2**24) * random.randint(0, 2**24) + random.randint(0, 2**24) for _ in range(graph2vec.epochs)]
+
+	# The vocabulary sorted by word, so that words can be looked up with a binary search
+	words = np.array(model.wv.index_to_key)
+	order = np.argsort(words)
+
+	state = member.nn.state_dict()
+	return {
+		"name": np.array(member.name),
+		"wl_params": np.array(member.wl_params, dtype=np.int64),
+		"vocabulary": words[order],
+		"vocabulary_index": order.astype(np.uint32),
+		"syn1neg": model.syn1neg.astype(np.float32),
+		"cum_table": model.cum_table.astype(np.uint32),
+		"sample_int": model.wv.expandos["sample_int"].astype(np.uint32) if model.sample else np.zeros(0, dtype=np.uint32),
+		"negative": np.array(model.negative),
+		"epoch_seeds": np.array(epoch_seeds, dtype=np.uint64),
+		"alpha": np.array(graph2vec.learning_rate, dtype=np.float64),
+		"l1_weight": state["l1.weight"].numpy(),
+		"l1_bias": state["l1.bias"].numpy(),
+		"l3_weight": state["l3.weight"].numpy(),
+		"l3_bias": state["l3.bias"].numpy(),
+		"negative_slope": np.array(member.nn.l2.negative_slope, dtype=np.float32),
+	}
+
+# Draw `count` outputs of gensim's random number generator, starting from `seed`. Each output is the state shifted
+# right by 16 bits, like `random_int32` returns it. The states are computed with jump-ahead instead of one by one:
+# state n is A_n * seed + C_n, and (A, C) for n + k follow from those for n and k. All arithmetic wraps at 2^64, which
+# keeps the low 48 bits exact.
+def lcg_stream(seed, count):
+	multipliers = np.ones(1, dtype=np.uint64)
+	increments = np.zeros(1, dtype=np.uint64)
+	step_multiplier, step_increment = LCG_MULTIPLIER, LCG_INCREMENT
+	with np.errstate(over="ignore"):
+		while len(multipliers) < count:
+			multipliers = np.concatenate([multipliers, multipliers * step_multiplier])
+			increments = np.concatenate([increments, increments * step_multiplier + step_increment])
+			step_increment = step_increment * step_multiplier + step_increment
+			step_multiplier = step_multiplier * step_multiplier
+		states = (multipliers[:count] * np.uint64(seed) + increments[:count]) & LCG_MASK
+	return states >> np.uint64(16)
+
+# An ensemble member loaded from its frozen arrays, it can be used wherever an `model_registry.EnsembleMember` is
+class FrozenMember:
+	def __init__(self, arrays):
+		self.name = str(arrays["name"])
+		self.wl_params = tuple(int(value) for value in arrays["wl_params"])
+		self.vocabulary = arrays["vocabulary"]
+		self.vocabulary_index = arrays["vocabulary_index"]
+		self.syn1neg = arrays["syn1neg"]
+		self.cum_table = arrays["cum_table"]
+		self.sample_int = arrays["sample_int"]
+		self.negative = int(arrays["negative"])
+		self.epoch_seeds = arrays["epoch_seeds"]
+		self.alpha = float(arrays["alpha"])
+		self.l1_weight = arrays["l1_weight"]
+		self.l1_bias = arrays["l1_bias"]
+		self.l3_weight = arrays["l3_weight"]
+		self.l3_bias = arrays["l3_bias"]
+		self.negative_slope = arrays["negative_slope"]
+
+	# Indices of the words of `document` that are in the vocabulary, in document order
+	def word_indices(self, document):
+		if len(document) == 0 or len(self.vocabulary) == 0:
+			return np.zeros(0, dtype=np.uint32)
+		words = np.array(document)
+		positions = np.searchsorted(self.vocabulary, words).clip(max=len(self.vocabulary) - 1)
+		known = self.vocabulary[positions] == words
+		return self.vocabulary_index[positions[known]]
+
+	# The words trained on in one pass over the document, and the target words of each of them: the word itself
+	# followed by the negative samples. Returns the (words, negative + 1) targets and a mask of the targets that are
+	# actually trained on.
+	def pass_targets(self, word_indices, stream):
+		consumed = 0
+		if len(self.sample_int) > 0:
+			# Frequent words are randomly skipped, one draw per word of the vocabulary
+			keep = self.sample_int[word_indices] >= stream[:len(word_indices)]
+			consumed = len(word_indices)
+			kept = np.flatnonzero(keep)
+			if len(kept) > MAX_DOCUMENT_LEN:
+				consumed = kept[MAX_DOCUMENT_LEN - 1] + 1
+				kept = kept[:MAX_DOCUMENT_LEN]
+			words = word_indices[kept]
+		else:
+			words = word_indices[:MAX_DOCUMENT_LEN]
+
+		draws = stream[consumed:consumed + len(words) * self.negative].reshape(len(words), self.negative)
+		negatives = np.searchsorted(self.cum_table, draws % np.uint64(self.cum_table[-1]), side="left")
+		targets = np.concatenate([words[:, None].astype(np.int64), negatives.astype(np.int64)], axis=1)
+		# Negative samples that hit the word itself are skipped
+		mask = np.ones(targets.shape, dtype=bool)
+		mask[:, 1:] = negatives != words[:, None]
+		return targets, mask
+
+	# Infer the graph vector of each of the feature `documents` as a (len(documents), dimensions) array, like
+	# `EnsembleMember.infer_documents`. All documents are processed in lockstep, one word of every document at a time.
+	def infer_documents(self, documents):
+		size = self.syn1neg.shape[1]
+		vectors = np.empty((len(documents), size), dtype=np.float32)
+		for idx, document in enumerate(documents):
+			vectors[idx] = _initial_vector(size, document)
+		word_indices = [self.word_indices(document) for document in documents]
+
+		labels = np.zeros(self.negative + 1, dtype=np.float32)
+		labels[0] = 1.0
+		epochs = len(self.epoch_seeds)
+		alpha = self.alpha
+		alpha_delta = (alpha - MIN_ALPHA) / max(epochs - 1, 1)
+		longest = max((len(indices) for indices in word_indices), default=0)
+		for seed in self.epoch_seeds:
+			stream = lcg_stream(int(seed), longest * (self.negative + 1))
+			passes = [self.pass_targets(indices, stream) for indices in word_indices]
+			steps = max((len(targets) for targets, _ in passes), default=0)
+
+			# Pad the targets of all documents to the same number of words, padding is masked out
+			targets = np.zeros((len(documents), steps, self.negative + 1), dtype=np.int64)
+			masks = np.zeros(targets.shape, dtype=bool)
+			for idx, (doc_targets, doc_mask) in enumerate(passes):
+				targets[idx, :len(doc_targets)] = doc_targets
+				masks[idx, :len(doc_mask)] = doc_mask
+
+			alpha32 = np.float32(alpha)
+			for step in range(steps):
+				weights = self.syn1neg[targets[:, step]]
+				f = np.matmul(weights, vectors[:, :, None])[:, :, 0]
+				# Targets the sigmoid is saturated for don't contribute
+				mask = masks[:, step] & (f > -MAX_EXP) & (f < MAX_EXP)
+				table_idx = ((f + np.float32(MAX_EXP)) * np.float32(EXP_TABLE_SIZE // MAX_EXP // 2)).astype(np.int64)
+				sigmoid = EXP_TABLE[table_idx.clip(0, EXP_TABLE_SIZE - 1)]
+				g = np.where(mask, (labels - sigmoid) * alpha32, np.float32(0))
+				vectors += np.matmul(g[:, None, :], weights)[:, 0]
+			alpha -= alpha_delta
+		return vectors
+
+	def graph_features(self, graphs):
+		return graph_features(graphs, self.wl_params)
+
+	def infer(self, graphs):
+		return self.infer_documents(self.graph_features(graphs))
+
+	def score(self, graphs):
+		return self.score_documents(self.graph_features(graphs))
+
+	# Score each graph, given by its feature `documents`, with this model
+	def score_documents(self, documents):
+		with metrics.timer("graph2vec_inference"):
+			graph_vecs = self.infer_documents(documents)
+		with metrics.timer("classifier"):
+			hidden = graph_vecs @ self.l1_weight.T + self.l1_bias
+			hidden = np.where(hidden >= 0, hidden, hidden * self.negative_slope)
+			results = 1 / (1 + np.exp(-(hidden @ self.l3_weight.T + self.l3_bias)))
+		return results[:, 0].tolist()
+
+# The vector Doc2Vec starts inferring the vector of `document` from, see `gensim.models.keyedvectors.pseudorandom_weak_vector`
+def _initial_vector(size, document):
+	seed_string = " ".join(document)
+	if seed_string:
+		generator = np.random.Generator(np.random.SFC64(hash(seed_string) & 0xffffffff))
+	else:
+		generator = np.random.default_rng()
+	return (generator.random(size).astype(np.float32) - 0.5) / size
+
+def load_member(path):
+	with np.load(path) as arrays:
+		return FrozenMember(dict(arrays))
+
+# Freeze the model at `model_file` into a .npz file next to it, returns the path of the frozen model
+def export_model(model_file):
+	with open(model_file, "rb") as f:
+		data = pickle.load(f)
+	member = EnsembleMember(os.path.basename(model_file), data["graph2vec"], data["nn"])
+	frozen_file = os.path.splitext(model_file)[0] + ".npz"
+	np.savez(frozen_file, **freeze_member(member))
+	return frozen_file
+
+# Freeze all models in `model_dir`
+def export_ensemble(model_dir):
+	return [
+		export_model(os.path.join(model_dir, entry.name))
+		for entry in sorted(os.scandir(model_dir), key=lambda entry: entry.name)
+		if entry.name.startswith("model") and entry.name.endswith("obj")
+	]
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print(f"Usage: {sys.argv[0]} <model_dir> [<model_dir> ...]")
+		print("Writes a frozen .npz file next to each model file")
+		sys.exit(1)
+	for model_dir in sys.argv[1:]:
+		for frozen_file in export_ensemble(model_dir):
+			print(frozen_file)
@@ -1,16 +1,63 @@
 from utils import evm_cfg
 from utils import visualization
+from utils import cfg_binary
+from utils import metrics
+from utils.exploration import explore, DEFAULT_MAX_CONTEXTS
 
-def generate_control_flow_graph(bytecode_file, dot_file):
+# A recovered control flow graph, kept in memory. It can be handed to `infer_models.audit_contract` directly,
+# the .dot export is only produced when it is asked for.
+class ControlFlowGraph:
+    def __init__(self, blocks, exploration):
+        # The basic blocks of the contract, keyed by their start address
+        self.blocks = blocks
+        # The edges and statistics found by `exploration.explore`
+        self.exploration = exploration
+
+    @property
+    def partial(self):
+        return self.exploration.partial
+
+    # Graph in the form the models are run on, see `visualization.generate_networkx`
+    def to_networkx(self):
+        return visualization.generate_networkx(self.blocks, self.exploration)
+
+    # Write the graph in .dot format to the file-like object `file`
+    def dot(self, file):
+        with metrics.timer("dot_export"):
+            visualization.write_dot(self.blocks, file, self.exploration)
+
+    # Save the graph to the specified .dot file
+    def write_dot(self, dot_file):
+        with open(dot_file, mode="w") as file:
+            self.dot(file)
+
+    # Save the graph in the binary format, see `cfg_binary`
+    def write_binary(self, cfg_file):
+        cfg_binary.save_cfg(self.to_networkx(), cfg_file)
+
+# `max_contexts` bounds the number of distinct states per block, see `exploration.explore`
+def build_control_flow_graph(evm_bytecode, max_contexts=DEFAULT_MAX_CONTEXTS):
+    # Generate a control flow graph from the raw bytecode
+    with metrics.timer("basic_blocks"):
+        blocks = evm_cfg.create_basic_blocks(evm_bytecode)
+    with metrics.timer("exploration"):
+        exploration = explore(blocks, max_contexts=max_contexts)
+    metrics.states_explored.inc(exploration.num_states)
+    metrics.anywhere_edges.inc(len(exploration.anywhere_edges))
+    if exploration.partial:
+        metrics.partial_graphs.inc(budget=exploration.exhausted_budget)
+    return ControlFlowGraph(blocks, exploration)
+
+def load_control_flow_graph(bytecode_file):
     # Read the hex-encoded bytecode file
     with open(bytecode_file, mode="r") as file:
         evm_bytecode = bytes.fromhex(file.read())
 
-    # Generate a control flow graph
-    blocks = evm_cfg.create_basic_blocks(evm_bytecode)
-    graph = visualization.generate_graph(blocks)
+    return build_control_flow_graph(evm_bytecode)
 
-    # Save the graph to the specified .dot file
-    with open(dot_file, mode="w") as file:
-        graph.dot(file)
+def generate_control_flow_graph(bytecode_file, dot_file):
+    cfg = load_control_flow_graph(bytecode_file)
+    cfg.write_dot(dot_file)
 
+    # Let the caller know how much work the exploration took
+    return cfg.exploration
@@ -1,70 +1,83 @@
 #!/usr/bin/env python3
-import os
-import pickle
-import torch
 import networkx as nx
 import pygraphviz as pgv
+from utils import ensemble_pool
+from utils import cfg_binary
+from utils import model_registry
+from utils import metrics
+from utils.model_registry import registry
 
 def load_file(path):
-	# Load the dot-file with pygraphviz and convert to networkx
-	G = nx.DiGraph(pgv.AGraph(path, directed=True))
-	# Nodes must be indexed by consecutive integers for graph2vec
-	return nx.convert_node_labels_to_integers(G)
+	# Graphs in the binary format are memory-mapped instead of parsed, see `cfg_binary`
+	if path.endswith(".cfgb"):
+		with metrics.timer("cfgb_load"):
+			return cfg_binary.load_cfg(path).to_networkx()
+	with metrics.timer("dot_load"):
+		# Load the dot-file with pygraphviz and convert to networkx
+		G = nx.DiGraph(pgv.AGraph(path, directed=True))
+		# Nodes must be indexed by consecutive integers for graph2vec
+		return nx.convert_node_labels_to_integers(G)
 
-def audit_contract(path, token_type):
-	# Get the list of all model files in the "models" folder
-	if token_type == 'ERC-20':
-		model_dir = 'models_erc20'
-	elif token_type == 'ERC-721':
-		model_dir = 'models_erc721'
-	else:
-		raise ValueError(f"Invalid token_type: {token_type}")
+# The feature documents of `graphs` for each of the `wl_params`, as a dict of wl_params -> documents
+def graph_features(graphs, wl_params):
+	return {params: model_registry.graph_features(graphs, params) for params in wl_params}
+
+# Score a list of graphs with all models of the ensemble for `token_type`.
+# Each element of `graphs` is either the path of a .dot or .cfgb file or a graph as returned by
+# `generate_cfg.ControlFlowGraph.to_networkx`. Every model infers the vectors of all graphs in one go and classifies
+# them as one (N, d) tensor. Returns one dict per graph with the combined "result" and the "scores" of each model.
+# If a pool of workers is configured (see `ensemble_pool`), the models are run in parallel in the workers.
+def audit_contracts(graphs, token_type, pool=None):
+	if pool is None:
+		pool = ensemble_pool.pool
+	if pool is not None:
+		pool.start()
+
+	# Get the models trained for the token type, they are only loaded from disk once per process
+	ensemble = registry.get(token_type)
+
+	graphs = [load_file(graph) if isinstance(graph, str) else graph for graph in graphs]
+	# The Weisfeiler-Lehman features are only computed once for all members that use the same parameters
+	return audit_features(graph_features(graphs, ensemble.wl_params()), ensemble, pool)
 
-	model_files = [f for f in os.listdir(model_dir) if f.startswith("model") and f.endswith("obj")]
+# Score graphs with all models of `ensemble`, given their feature documents as returned by `graph_features` for
+# `ensemble.wl_params()`. Returns the same as `audit_contracts`.
+def audit_features(features, ensemble, pool=None):
+	num_graphs = len(next(iter(features.values()))) if features else 0
+	if num_graphs == 0:
+		return []
+
+	if pool is None:
+		pool = ensemble_pool.pool
+
+	# Scores of each model for all graphs, indexed by model and then by graph
+	if pool is not None:
+		model_scores = pool.score(ensemble, features)
+	else:
+		model_scores = [member.score_documents(features[member.wl_params]) for member in ensemble.members]
 
-	# Initialize lists to store the graph2vec and nn models
-	graph2vecs = []
-	nns = []
+	audits = []
+	for graph_idx in range(num_graphs):
+		# Results from this graph for all models
+		graph_results = [scores[graph_idx] for scores in model_scores]
 
-	# Loop through all the model files
-	for model_file in model_files:
-		# Load the trained model from each file
-		with open(os.path.join(model_dir, model_file), "rb") as f:
-			data = pickle.load(f)
-		
-		# Extract the graph2vec and nn models from the loaded data
-		graph2vec = data["graph2vec"]
-		nn = data["nn"]
-		
-		# Append the models to their respective lists
-		graph2vecs.append(graph2vec)
-		nns.append(nn)
+		# Calculate the average result
+		average_result = sum(graph_results) / len(graph_results)
 
-	graph = load_file(path)
+		# Calculate the majority result
+		majority_result = max(set(graph_results), key=graph_results.count)
 
-	# Initialize list to store results from this graph for all models
-	graph_results = []
+		# Choose the final result as the majority or the average
+		# result = majority_result # choose majority
+		result = average_result # choose average
 
-	# Loop through all the models
-	for i, graph2vec in enumerate(graph2vecs):
-		# Infer the graph vector representation using the graph2vec model
-		graph_vec = graph2vec.infer([graph])
-		
-		# Use the nn model to predict the result from the graph vector
-		result = nns[i](torch.Tensor(graph_vec))
-		
-		# Append the result to the list
-		graph_results.append(result[0][0])
-	
-	# Add the combined result of all models for this graph to the results list
-	# Calculate the average result
-	average_result = sum(graph_results) / len(graph_results)
-	
-	# Calculate the majority result
-	majority_result = max(set(graph_results), key=graph_results.count)
+		audits.append({
+			"result": result,
+			"scores": {member.name: scores[graph_idx] for member, scores in zip(ensemble.members, model_scores)},
+		})
 
-	# Choose the final result as the majority or the average
-	# result = majority_result # choose majority
-	result = average_result # choose average
+	return audits
 
-	return result
\ No newline at end of file
+# `graph` is either the path of a .dot or .cfgb file or a graph as returned by `generate_cfg.ControlFlowGraph.to_networkx`
+def audit_contract(graph, token_type):
+	return audit_contracts([graph], token_type)[0]["result"]
@@ -0,0 +1,238 @@
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Whether responses carry a Server-Timing header with the time the request spent in each stage
+TIMING_HEADERS = bool(os.environ.get("METRICS_TIMING_HEADERS"))
+
+# Upper bounds of the latency buckets in seconds, from cache hits up to the exploration budget
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Upper bounds of the buckets for the number of contracts in an audit
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+# A metric with a value for each combination of its label values
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        # Shared by all metrics of a registry, see `MetricsRegistry.add`
+        self.lock = None
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Metric {self.name} takes the labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, key, (), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(self.labels, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def merge(self, values):
+        with self.lock:
+            for key, value in values.items():
+                self.values[key] = self.values.get(key, 0) + value
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    # Count the work inside the `with` block as in flight
+    @contextmanager
+    def track(self, amount=1, **labels):
+        self.inc(amount, **labels)
+        try:
+            yield
+        finally:
+            self.dec(amount, **labels)
+
+    def merge(self, values):
+        # Gauges describe the process they live in, there is nothing to add up
+        pass
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    # The values are [count per bucket, +Inf bucket included, sum]
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            idx = 0
+            while idx < len(self.buckets) and value > self.buckets[idx]:
+                idx += 1
+            entry[0][idx] += 1
+            entry[1] += value
+
+    def merge(self, values):
+        with self.lock:
+            for key, (counts, total) in values.items():
+                entry = self.values.get(key)
+                if entry is None:
+                    entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield self.name + "_bucket", key, [("le", _format_value(bound))], cumulative
+            yield self.name + "_sum", key, (), total
+            yield self.name + "_count", key, (), cumulative
+
+# The metrics of one process, rendered in the Prometheus text format.
+# Analyses that run in the executor's worker processes record their metrics in the worker and hand them back along
+# with their result, see `collect` and `merge`, so the web process reports the work of its workers as well.
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        # Forked workers start counting from zero, whatever the parent had recorded is reported by the parent
+        os.register_at_fork(after_in_child=self.reset)
+
+    def add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        metric.lock = self.lock
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def reset(self):
+        self.lock = threading.Lock()
+        for metric in self.metrics.values():
+            metric.lock = self.lock
+            metric.values = {}
+
+    # The values of the counters and histograms, to be merged into the registry of another process
+    def export(self):
+        with self.lock:
+            return {
+                name: {key: [list(value[0]), value[1]] if isinstance(value, list) else value for key, value in metric.values.items()}
+                for name, metric in self.metrics.items()
+                if not isinstance(metric, Gauge)
+            }
+
+    def merge(self, exported):
+        for name, values in exported.items():
+            self.metrics[name].merge(values)
+
+    def render(self):
+        with self.lock:
+            return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+# The registry shared by everything running in this process
+registry = MetricsRegistry()
+
+stage_seconds = registry.histogram("safeguard_stage_seconds", "Time spent in each stage of the analysis", ["stage"])
+cache_lookups = registry.counter("safeguard_cache_lookups_total", "Lookups in the analysis cache and the signature index", ["entry", "result"])
+states_explored = registry.counter("safeguard_states_explored_total", "States registered by the control flow graph exploration")
+anywhere_edges = registry.counter("safeguard_anywhere_edges_total", "Edges to the [anywhere] block found by the exploration")
+partial_graphs = registry.counter("safeguard_partial_graphs_total", "Explorations that stopped early, by the budget that ran out", ["budget"])
+audit_batch_size = registry.histogram("safeguard_audit_batch_size", "Contracts per audit", buckets=BATCH_BUCKETS)
+executor_pending = registry.gauge("safeguard_executor_pending", "Analyses queued or running in the executor")
+executor_rejected = registry.counter("safeguard_executor_rejected_total", "Analyses that were turned away because too many were pending (full) or given up on (timeout)", ["reason"])
+requests_in_flight = registry.gauge("safeguard_http_requests_in_flight", "HTTP requests being handled")
+request_seconds = registry.histogram("safeguard_http_request_seconds", "Time spent handling HTTP requests", ["route", "method", "status"])
+
+# Time spent in each stage by the request being handled, see `track_request`
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+def _add_timing(stage, seconds):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+# Time the `with` block as the stage `stage`
+@contextmanager
+def timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=stage)
+        _add_timing(stage, elapsed)
+
+# Start collecting the time spent in each stage for the current request. Returns a dict of stage -> seconds that is
+# filled in as the request is handled, including by work it hands to threads and worker processes.
+def track_request():
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+# The Server-Timing header value for the `timings` of a request
+def server_timing(timings):
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+# Run `fn(*args)` in a worker process and return its result along with the metrics it recorded, to be passed to
+# `merge` in the process that handed out the work
+def collect(fn, *args):
+    registry.reset()
+    timings = track_request()
+    result = fn(*args)
+    return result, {"metrics": registry.export(), "timings": timings}
+
+def merge(collected):
+    registry.merge(collected["metrics"])
+    for stage, seconds in collected["timings"].items():
+        _add_timing(stage, seconds)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import os
+import pickle
+import hashlib
+import threading
+import numpy as np
+import torch
+from collections import OrderedDict
+from karateclub.estimator import Estimator
+from karateclub.utils.treefeatures import WeisfeilerLehmanHashing
+from utils import metrics
+
+# Directory holding the trained ensemble for each token type
+MODEL_DIRS = {
+	"ERC-20": "models_erc20",
+	"ERC-721": "models_erc721",
+}
+
+# Number of ensembles kept in memory at the same time, the least recently used one is dropped first
+DEFAULT_MAX_ENTRIES = int(os.environ.get("MODEL_REGISTRY_MAX_ENTRIES", 4))
+
+# Whether ensembles are loaded from the frozen .npz exports of the models instead of the pickles, see `frozen_models`
+DEFAULT_FROZEN = os.environ.get("FROZEN_MODELS", "0") not in ("", "0")
+
+# (wl_iterations, attributed, erase_base_features) of a Graph2Vec model
+def wl_params(graph2vec):
+	return (graph2vec.wl_iterations, graph2vec.attributed, graph2vec.erase_base_features)
+
+# Weisfeiler-Lehman feature documents of the `graphs` for the given `wl_params`, as Graph2Vec computes them
+def graph_features(graphs, wl_params):
+	wl_iterations, attributed, erase_base_features = wl_params
+	with metrics.timer("wl_features"):
+		graphs = Estimator()._check_graphs(graphs)
+		return [
+			WeisfeilerLehmanHashing(graph, wl_iterations, attributed, erase_base_features).get_graph_features()
+			for graph in graphs
+		]
+
+# One trained model of an ensemble: a Graph2Vec model producing the graph vector and the nn classifying it
+class EnsembleMember:
+	def __init__(self, name, graph2vec, nn):
+		self.name = name
+		self.graph2vec = graph2vec
+		self.nn = nn
+		# Doc2Vec draws from the model's own random state while inferring vectors, so results depend on
+		# every inference that ran before. Remember the state as it was pickled, so that each inference
+		# gives the same result as on a freshly loaded model.
+		self.rng_state = graph2vec.model.random.get_state()
+		self.lock = threading.Lock()
+
+	# The parameters the Weisfeiler-Lehman features of this model depend on. Members with the same parameters
+	# infer their graph vectors from the same feature documents.
+	@property
+	def wl_params(self):
+		return wl_params(self.graph2vec)
+
+	# Weisfeiler-Lehman feature documents of the `graphs`, the words Graph2Vec infers the graph vectors from
+	def graph_features(self, graphs):
+		return graph_features(graphs, self.wl_params)
+
+	# Infer the graph vector of each of the feature `documents` as a (len(documents), dimensions) array.
+	# This does the same as `Graph2Vec.infer`, except that the random state is restored before each document,
+	# so that the vector of a graph doesn't depend on the other graphs it is inferred together with.
+	def infer_documents(self, documents):
+		graph2vec = self.graph2vec
+		with self.lock:
+			graph2vec._set_seed()
+			vectors = []
+			for document in documents:
+				graph2vec.model.random.set_state(self.rng_state)
+				vectors.append(graph2vec.model.infer_vector(document, alpha=graph2vec.learning_rate, min_alpha=0.00001, epochs=graph2vec.epochs))
+			return np.array(vectors)
+
+	# Infer the graph vector representation of each of the `graphs`
+	def infer(self, graphs):
+		return self.infer_documents(self.graph_features(graphs))
+
+	# Score each of the `graphs` with this model
+	def score(self, graphs):
+		return self.score_documents(self.graph_features(graphs))
+
+	# Score each graph, given by its feature `documents`, with this model
+	def score_documents(self, documents):
+		# Infer the graph vector representations using the graph2vec model
+		with metrics.timer("graph2vec_inference"):
+			graph_vecs = self.infer_documents(documents)
+
+		# Use the nn model to predict the results from the stacked graph vectors
+		with torch.no_grad(), metrics.timer("classifier"):
+			results = self.nn(torch.Tensor(graph_vecs))
+
+		return results[:, 0].tolist()
+
+# Short tag identifying a set of model files, changes whenever any of them changes
+def signature_version(signature):
+	return hashlib.sha256(repr(signature).encode()).hexdigest()[:16]
+
+# All models loaded from the model directory of one token type
+class Ensemble:
+	def __init__(self, token_type, model_dir, signature, members):
+		self.token_type = token_type
+		self.model_dir = model_dir
+		# The state of the model files the ensemble was loaded from, see `ModelRegistry.signature`
+		self.signature = signature
+		self.members = members
+
+	@property
+	def version(self):
+		return signature_version(self.signature)
+
+	# The distinct `EnsembleMember.wl_params` of the members, the feature documents of a graph are needed once for each
+	def wl_params(self):
+		return list(dict.fromkeys(member.wl_params for member in self.members))
+
+# Process-wide cache of the loaded ensembles, keyed by token type.
+# Ensembles are loaded on first use (or by `preload`) and reloaded when the files in their model directory change.
+class ModelRegistry:
+	def __init__(self, model_dirs=MODEL_DIRS, max_entries=DEFAULT_MAX_ENTRIES, frozen=DEFAULT_FROZEN):
+		self.model_dirs = model_dirs
+		self.max_entries = max_entries
+		self.frozen = frozen
+		self.ensembles = OrderedDict()
+		self.lock = threading.Lock()
+
+	def model_dir(self, token_type):
+		model_dir = self.model_dirs.get(token_type)
+		if model_dir is None:
+			raise ValueError(f"Invalid token_type: {token_type}")
+		return model_dir
+
+	# Names, modification times and sizes of the model files in `model_dir`
+	def signature(self, model_dir):
+		signature = []
+		extension = ".npz" if self.frozen else "obj"
+		for entry in os.scandir(model_dir):
+			if entry.name.startswith("model") and entry.name.endswith(extension):
+				stat = entry.stat()
+				signature.append((entry.name, stat.st_mtime_ns, stat.st_size))
+		return tuple(sorted(signature))
+
+	def load(self, token_type, model_dir, signature):
+		members = []
+		for model_file, _, _ in signature:
+			if self.frozen:
+				# Imported here, `frozen_models` builds on this module
+				from utils import frozen_models
+				members.append(frozen_models.load_member(os.path.join(model_dir, model_file)))
+				continue
+			# Load the trained model from each file
+			with open(os.path.join(model_dir, model_file), "rb") as f:
+				data = pickle.load(f)
+			# Extract the graph2vec and nn models from the loaded data
+			members.append(EnsembleMember(model_file, data["graph2vec"], data["nn"]))
+		if len(members) == 0:
+			raise ValueError(f"No models found in {model_dir} for token_type {token_type}")
+		return Ensemble(token_type, model_dir, signature, members)
+
+	# Get the ensemble for `token_type`, loading it if it isn't loaded yet or if its files changed
+	def get(self, token_type):
+		model_dir = self.model_dir(token_type)
+		signature = self.signature(model_dir)
+		with self.lock:
+			ensemble = self.ensembles.get(token_type)
+			if ensemble is None or ensemble.signature != signature:
+				with metrics.timer("model_load"):
+					ensemble = self.load(token_type, model_dir, signature)
+				self.ensembles[token_type] = ensemble
+			self.ensembles.move_to_end(token_type)
+			# Evict the least recently used ensembles
+			while len(self.ensembles) > self.max_entries:
+				self.ensembles.popitem(last=False)
+			return ensemble
+
+	# Version tag of the models currently on disk for `token_type`
+	def version(self, token_type):
+		return signature_version(self.signature(self.model_dir(token_type)))
+
+	# Load the ensembles of all configured token types up front
+	def preload(self):
+		for token_type in self.model_dirs:
+			self.get(token_type)
+
+	def clear(self):
+		with self.lock:
+			self.ensembles.clear()
+
+# The registry shared by everything running in this process
+registry = ModelRegistry()
@@ -0,0 +1,246 @@
+import tempfile
+import pyevmasm
+from collections import OrderedDict
+from utils import generate_cfg
+from utils import disassembly
+from utils.analysis_cache import cache, ADDRESS_TTL
+from utils import infer_models
+from utils import metrics
+from utils.model_registry import registry
+from utils.scrape_bytecode import scrape_bytecode_async, scrape_bytecodes_async, get_chain_id_async
+from utils.signatures_evm import get_signatures_async
+
+# The analysis steps behind the routes in main.py. Every result is stored in the analysis cache under the hash of
+# the runtime bytecode, so contracts with identical code are only analysed once.
+
+# Get the runtime bytecode of the contract, only asking the RPC node if the address hasn't been seen on this chain
+# in the last `ADDRESS_TTL` seconds. Returns the code hash and the bytecode, or (None, None) if there is no code at the
+# address.
+async def fetch_bytecode_async(contract_address, rpc_url):
+    chain_id = await get_chain_id_async(rpc_url)
+    code_hash = cache.lookup_address(chain_id, contract_address, ADDRESS_TTL)
+    if code_hash is not None:
+        bytecode = cache.get_bytecode(code_hash)
+        if bytecode is not None:
+            return code_hash, bytecode
+
+    with metrics.timer("rpc_fetch"):
+        bytecode = await scrape_bytecode_async(contract_address, rpc_url)
+    if not bytecode:
+        return None, None
+    code_hash = cache.put_bytecode(bytecode)
+    cache.index_address(chain_id, contract_address, code_hash)
+    return code_hash, bytecode
+
+# `fetch_bytecode_async` for many contracts at once, the bytecode of all addresses that haven't been seen before is
+# fetched in JSON-RPC batches. Returns a (code hash, bytecode) tuple per address, (None, None) if there is no code at
+# the address, or the error if its code couldn't be fetched.
+async def fetch_bytecodes_async(contract_addresses, rpc_url):
+    chain_id = await get_chain_id_async(rpc_url)
+    results = [(None, None)] * len(contract_addresses)
+    missing = []
+    for idx, contract_address in enumerate(contract_addresses):
+        code_hash = cache.lookup_address(chain_id, contract_address, ADDRESS_TTL)
+        bytecode = cache.get_bytecode(code_hash) if code_hash is not None else None
+        if bytecode is not None:
+            results[idx] = (code_hash, bytecode)
+        else:
+            missing.append(idx)
+
+    bytecodes = []
+    if missing:
+        with metrics.timer("rpc_fetch"):
+            bytecodes = await scrape_bytecodes_async([contract_addresses[idx] for idx in missing], rpc_url)
+    for idx, bytecode in zip(missing, bytecodes):
+        if isinstance(bytecode, Exception):
+            results[idx] = bytecode
+        elif bytecode:
+            code_hash = cache.put_bytecode(bytecode)
+            cache.index_address(chain_id, contract_addresses[idx], code_hash)
+            results[idx] = (code_hash, bytecode)
+    return results
+
+# The instructions with index `start` up to `stop` as dicts with the keys "pc", "opcode" and "operand". The operand is
+# the hex encoded immediate value of a PUSH, formatted like `disassemble` does, and None for all other operations.
+# Returns the total number of instructions and the selected ones.
+def instructions(bytecode, start=0, stop=None):
+    decoded = disassembly.disassemble(bytecode)
+    selected = range(len(decoded))[start:stop]
+    return len(decoded), [
+        {
+            "pc": decoded.offsets[idx],
+            "opcode": disassembly.NAMES[decoded.opcodes[idx]],
+            "operand": hex(decoded.immediate(idx)) if disassembly.IMMEDIATE_SIZE[decoded.opcodes[idx]] else None,
+        }
+        for idx in selected
+    ]
+
+def disassemble(code_hash, bytecode):
+    def compute():
+        with metrics.timer("disassembly"):
+            return pyevmasm.evmasm.disassemble(bytecode)
+    return cache.get_or_compute(code_hash, "disasm.asm", compute)
+
+# Signatures aren't stored in the analysis cache, they are cached per selector by the signature index. This way
+# selectors that couldn't be resolved, e.g. while offline, are looked up again the next time.
+async def signatures_async(code_hash, bytecode):
+    return await get_signatures_async(bytecode.hex())
+
+# Whether results derived from a graph with the exploration statistics `stats` may be cached. A graph cut off by the
+# time budget depends on how busy the machine was, it is recomputed the next time instead of being kept for good.
+def _cacheable(stats):
+    return stats["exhausted_budget"] != "time"
+
+# Number of graphs that can't be cached kept in memory, so that the entries of one of them that are asked for one after
+# the other, e.g. the statistics and then the graph for an audit, don't explore it again each time
+UNCACHED_GRAPHS = 4
+_uncached = OrderedDict()
+
+# Recover the control flow graph and store the cache entries derived from it. Returns the graph and the entries by name.
+def _build_cfg(code_hash, bytecode):
+    built = _uncached.get(code_hash)
+    if built is not None:
+        _uncached.move_to_end(code_hash)
+        return built
+
+    cfg = generate_cfg.build_control_flow_graph(bytecode)
+    stats = cfg.exploration.stats()
+    entries = {
+        "blocks.json": [
+            {
+                "start_addr": block.start_addr,
+                "falltrough_addr": block.falltrough_addr,
+                "jump_dest": block.jump_dest,
+                "text": block.as_text(),
+            }
+            for block in cfg.blocks.values()
+        ],
+        # Edges by the start addresses of their blocks, None stands for the [anywhere] block
+        "edges.json": [
+            [from_block.start_addr, to_block.start_addr] for from_block, to_block in cfg.exploration.known_edges
+        ] + [
+            [block.start_addr, None] for block in cfg.exploration.anywhere_edges
+        ],
+        "cfg.pickle": {"graph": cfg.to_networkx(), "partial": cfg.partial, "stats": stats},
+        # Kept apart from the graph, so that it can be read without unpickling the whole graph
+        "cfg-stats.json": {"partial": cfg.partial, "stats": stats},
+    }
+    if _cacheable(stats):
+        for name, value in entries.items():
+            cache.put(code_hash, name, value)
+    else:
+        _uncached[code_hash] = (cfg, entries)
+        while len(_uncached) > UNCACHED_GRAPHS:
+            _uncached.popitem(last=False)
+    return cfg, entries
+
+def _cfg_entry(code_hash, bytecode, name):
+    entry = cache.get(code_hash, name)
+    if entry is None:
+        entry = _build_cfg(code_hash, bytecode)[1][name]
+    return entry
+
+# The control flow graph as the models take it, along with whether it is partial and the exploration statistics.
+# Returns a dict with the keys "graph", "partial" and "stats".
+def control_flow_graph(code_hash, bytecode):
+    return _cfg_entry(code_hash, bytecode, "cfg.pickle")
+
+# Whether the control flow graph is partial and the exploration statistics, as a dict with the keys "partial" and "stats"
+def control_flow_graph_stats(code_hash, bytecode):
+    return _cfg_entry(code_hash, bytecode, "cfg-stats.json")
+
+# The basic blocks of the control flow graph in address order, as dicts with the keys "start_addr",
+# "falltrough_addr", "jump_dest" and "text"
+def control_flow_graph_blocks(code_hash, bytecode):
+    return _cfg_entry(code_hash, bytecode, "blocks.json")
+
+# The edges of the control flow graph as [from, to] pairs of block start addresses, in the order they were found.
+# Edges to the [anywhere] block have None as their target and come last.
+def control_flow_graph_edges(code_hash, bytecode):
+    return _cfg_entry(code_hash, bytecode, "edges.json")
+
+# The .dot export of the control flow graph, it is only written when it is asked for. The graph is written straight to
+# the file, see `visualization.write_dot`. Returns the path of the file, whether it is a temporary file the caller has
+# to delete, which is the case for graphs that aren't cached, and the same as `control_flow_graph_stats`.
+def control_flow_graph_dot_file(code_hash, bytecode):
+    path = cache.entry_path(code_hash, "cfg.dot")
+    if path is not None:
+        return path, False, control_flow_graph_stats(code_hash, bytecode)
+    cfg, entries = _build_cfg(code_hash, bytecode)
+    if _cacheable(entries["cfg-stats.json"]["stats"]):
+        return cache.put_stream(code_hash, "cfg.dot", cfg.dot), False, entries["cfg-stats.json"]
+    with tempfile.NamedTemporaryFile("w", suffix=".dot", delete=False) as f:
+        cfg.dot(f)
+    return f.name, True, entries["cfg-stats.json"]
+
+def _scores_name(ensemble):
+    # Scores are only valid for the models they were computed with
+    return f"scores-{ensemble.token_type}-{ensemble.version}.json"
+
+def _features_name(wl_params):
+    wl_iterations, attributed, erase_base_features = wl_params
+    return f"wl-{wl_iterations}-{int(attributed)}-{int(erase_base_features)}.json"
+
+# The Weisfeiler-Lehman feature documents of the control flow graph for each of the `wl_params`, as a dict of
+# wl_params -> document. They only depend on the graph, so they are shared by all models using the same parameters
+# and stay valid when the models change. `cfg` is the `control_flow_graph` of the contract, if it was loaded already.
+def graph_features(code_hash, bytecode, wl_params, cfg=None):
+    features = {params: cache.get(code_hash, _features_name(params)) for params in wl_params}
+    missing = [params for params, document in features.items() if document is None]
+    if missing:
+        if cfg is None:
+            cfg = control_flow_graph(code_hash, bytecode)
+        for params, documents in infer_models.graph_features([cfg["graph"]], missing).items():
+            if _cacheable(cfg["stats"]):
+                cache.put(code_hash, _features_name(params), documents[0])
+            features[params] = documents[0]
+    return features
+
+# Audit the given contracts, each given as a (code hash, bytecode) tuple. Contracts whose scores are cached are not
+# analysed again, all others are scored together. Returns one dict per contract with the combined "result", the
+# "scores" of each model, whether the graph was "partial" and the exploration "stats", see `control_flow_graph_stats`.
+def audit(contracts, token_type):
+    ensemble = registry.get(token_type)
+    name = _scores_name(ensemble)
+    audits = [cache.get(code_hash, name) for code_hash, _ in contracts]
+    metrics.audit_batch_size.observe(len(contracts))
+
+    missing = [idx for idx, entry in enumerate(audits) if entry is None]
+    wl_params = ensemble.wl_params()
+    contract_features = []
+    contract_stats = []
+    for idx in missing:
+        stats = cache.get(contracts[idx][0], "cfg-stats.json")
+        cfg = None
+        if stats is None:
+            # The graph isn't cached, build it once for both the features and the statistics
+            cfg = stats = control_flow_graph(*contracts[idx])
+        contract_features.append(graph_features(*contracts[idx], wl_params, cfg))
+        contract_stats.append(stats)
+    features = {params: [entry[params] for entry in contract_features] for params in wl_params}
+    results = infer_models.audit_features(features, ensemble) if missing else []
+    for idx, stats, result in zip(missing, contract_stats, results):
+        result["partial"] = stats["partial"]
+        if _cacheable(stats["stats"]):
+            cache.put(contracts[idx][0], name, result)
+        audits[idx] = dict(result, stats=stats["stats"])
+
+    # The statistics aren't stored with the scores, the graphs of cached scores are cached as well
+    for idx, entry in enumerate(audits):
+        if "stats" not in entry:
+            entry["stats"] = control_flow_graph_stats(*contracts[idx])["stats"]
+    return audits
+
+# Audit one contract, given by its code hash and bytecode, with the models of each of the `token_types`. Its control
+# flow graph is built at most once for all of them. Returns the same as `control_flow_graph_stats`, with the "result"
+# and the "scores" of each token type under "audits".
+def audit_token_types(code_hash, bytecode, token_types):
+    audits = {}
+    stats = None
+    for token_type in token_types:
+        audit_result = audit([(code_hash, bytecode)], token_type)[0]
+        audits[token_type] = {"result": audit_result["result"], "scores": audit_result["scores"]}
+        stats = {"partial": audit_result["partial"], "stats": audit_result["stats"]}
+    if stats is None:
+        stats = control_flow_graph_stats(code_hash, bytecode)
+    return dict(stats, audits=audits)
@@ -0,0 +1,199 @@
+import os
+import time
+import random
+import asyncio
+import weakref
+import aiohttp
+from collections import OrderedDict
+
+# Number of requests packed into one JSON-RPC batch, most nodes reject batches beyond a few hundred requests
+DEFAULT_BATCH_SIZE = int(os.environ.get("RPC_BATCH_SIZE", 100))
+# Number of keep-alive connections kept open to each RPC node
+DEFAULT_MAX_CONNECTIONS = int(os.environ.get("RPC_MAX_CONNECTIONS", 8))
+# HTTP requests per second sent to each RPC node, 0 doesn't limit the rate
+DEFAULT_RATE_LIMIT = float(os.environ.get("RPC_RATE_LIMIT", 0))
+# Number of times a failed HTTP request is retried, and the delay before the first retry in seconds
+DEFAULT_MAX_RETRIES = int(os.environ.get("RPC_MAX_RETRIES", 3))
+DEFAULT_BACKOFF = float(os.environ.get("RPC_BACKOFF", 0.5))
+DEFAULT_TIMEOUT = float(os.environ.get("RPC_TIMEOUT", 30))
+# Number of RPC URLs clients are kept for, the connections of the least recently used one are closed beyond that
+MAX_CLIENTS = int(os.environ.get("RPC_MAX_CLIENTS", 64))
+
+# HTTP status codes worth trying again, the node is overloaded or temporarily unavailable
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class RpcError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f"RPC error {code}: {message}")
+        self.code = code
+        self.message = message
+
+# JSON-RPC client for one RPC node. It keeps a pool of keep-alive connections, sends many calls in one
+# round trip as a JSON-RPC batch, retries failed requests with exponential backoff and limits the request rate.
+class RpcClient:
+    def __init__(self, url, batch_size=DEFAULT_BATCH_SIZE, max_connections=DEFAULT_MAX_CONNECTIONS, rate_limit=DEFAULT_RATE_LIMIT,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT):
+        self.url = url
+        self.batch_size = batch_size
+        self.max_connections = max_connections
+        self.rate_limit = rate_limit
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = None
+        self.next_id = 0
+        # Earliest time the next request may be sent at, see `throttle`
+        self.next_slot = 0.0
+        self.rate_lock = asyncio.Lock()
+        self.chain_id_value = None
+        # Number of requests in flight, and whether the connections are closed once they are done, see `retire`
+        self.active = 0
+        self.retired = False
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def throttle(self):
+        # Spread the requests out evenly, each one takes the next free slot
+        if self.rate_limit <= 0:
+            return
+        async with self.rate_lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + 1 / self.rate_limit
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # Send one HTTP request with the JSON `payload`, retrying on connection errors and on overloaded nodes
+    async def post(self, payload):
+        self.active += 1
+        try:
+            return await self.send(payload)
+        finally:
+            self.active -= 1
+            if self.retired and self.active == 0:
+                await self.close()
+
+    async def send(self, payload):
+        attempt = 0
+        while True:
+            await self.throttle()
+            retry_after = None
+            try:
+                async with self.get_session().post(self.url, json=payload) as response:
+                    if response.status not in RETRY_STATUSES:
+                        response.raise_for_status()
+                        return await response.json(content_type=None)
+                    error = aiohttp.ClientResponseError(response.request_info, response.history, status=response.status, message=response.reason)
+                    retry_after = response.headers.get("Retry-After")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+            if attempt >= self.max_retries:
+                raise error
+            # Exponential backoff with jitter, unless the node said how long to wait
+            delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def request(self, method, params):
+        self.next_id += 1
+        return {"jsonrpc": "2.0", "id": self.next_id, "method": method, "params": params}
+
+    async def call(self, method, params=()):
+        response = await self.post(self.request(method, list(params)))
+        if "error" in response:
+            raise RpcError(response["error"].get("code"), response["error"].get("message"))
+        return response["result"]
+
+    # Send all `calls`, each a (method, params) tuple, as JSON-RPC batches and return their results in order.
+    # Like `asyncio.gather`, a failed call raises its RpcError unless `return_exceptions` is set, in which case the
+    # error takes the place of its result.
+    async def batch(self, calls, return_exceptions=False):
+        requests = [self.request(method, list(params)) for method, params in calls]
+        chunks = [requests[offset:offset+self.batch_size] for offset in range(0, len(requests), self.batch_size)]
+        responses = {}
+        for chunk_responses in await asyncio.gather(*(self.post(chunk) for chunk in chunks)):
+            if isinstance(chunk_responses, dict):
+                # Nodes answer a batch they can't handle with a single error
+                raise RpcError(chunk_responses.get("error", {}).get("code"), chunk_responses.get("error", {}).get("message"))
+            for response in chunk_responses:
+                responses[response.get("id")] = response
+
+        results = []
+        for request in requests:
+            response = responses.get(request["id"])
+            if response is None:
+                result = RpcError(None, f"No response to {request['method']}")
+            elif "error" in response:
+                result = RpcError(response["error"].get("code"), response["error"].get("message"))
+            else:
+                result = response["result"]
+            if isinstance(result, RpcError) and not return_exceptions:
+                raise result
+            results.append(result)
+        return results
+
+    async def chain_id(self):
+        # The chain behind an RPC URL doesn't change, so it is only asked for once
+        if self.chain_id_value is None:
+            self.chain_id_value = int(await self.call("eth_chainId"), 16)
+        return self.chain_id_value
+
+    async def get_code(self, address, block="latest"):
+        return bytes.fromhex((await self.call("eth_getCode", (address, block)))[2:])
+
+    # Runtime bytecode of each of the `addresses`, fetched in as few round trips as possible
+    async def get_codes(self, addresses, block="latest", return_exceptions=False):
+        results = await self.batch([("eth_getCode", (address, block)) for address in addresses], return_exceptions=return_exceptions)
+        return [result if isinstance(result, Exception) else bytes.fromhex(result[2:]) for result in results]
+
+    async def block_number(self):
+        return int(await self.call("eth_blockNumber"), 16)
+
+    # The blocks with the given `numbers`, including their full transactions
+    async def get_blocks(self, numbers):
+        return await self.batch([("eth_getBlockByNumber", (hex(number), True)) for number in numbers])
+
+    async def get_receipts(self, transaction_hashes):
+        return await self.batch([("eth_getTransactionReceipt", (transaction_hash,)) for transaction_hash in transaction_hashes])
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    # Close the connections once the requests in flight are done
+    def retire(self):
+        self.retired = True
+        if self.active == 0:
+            task = asyncio.get_running_loop().create_task(self.close())
+            _closing.add(task)
+            task.add_done_callback(_closing.discard)
+
+# The clients shared by everything running in this process, keyed by event loop and RPC URL.
+# Connections belong to the event loop they were opened in, so each loop gets its own clients. The RPC URLs come from
+# the users, so only the `MAX_CLIENTS` most recently used ones are kept per loop.
+_clients = weakref.WeakKeyDictionary()
+# Closing clients that were evicted, kept so that their tasks aren't garbage collected before they are done
+_closing = set()
+
+def get_client(url):
+    clients = _clients.setdefault(asyncio.get_running_loop(), OrderedDict())
+    client = clients.get(url)
+    if client is None:
+        client = clients[url] = RpcClient(url)
+        while len(clients) > MAX_CLIENTS:
+            clients.popitem(last=False)[1].retire()
+    else:
+        clients.move_to_end(url)
+    return client
+
+async def close_clients():
+    clients = _clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.close()
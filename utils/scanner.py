@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+import logging
+import tempfile
+import aiohttp
+from collections import OrderedDict
+from utils import pipeline
+from utils.executor import BoundedExecutor
+from utils.rpc_client import RpcError, get_client, close_clients
+from utils.signatures_evm import unique_selectors
+
+logger = logging.getLogger(__name__)
+
+# Number of blocks fetched in one JSON-RPC batch while catching up with the chain
+DEFAULT_BLOCK_BATCH_SIZE = 20
+# Seconds to wait for a new block once the scanner has caught up
+DEFAULT_POLL_INTERVAL = 5.0
+# Seconds to wait before scanning blocks again after the RPC node failed, doubled after each failure in a row up to
+# `MAX_RETRY_INTERVAL`
+DEFAULT_RETRY_INTERVAL = 1.0
+MAX_RETRY_INTERVAL = 60.0
+# Errors of the RPC node that are worth waiting out
+SCAN_ERRORS = (RpcError, aiohttp.ClientError, asyncio.TimeoutError)
+# Number of contracts waiting between two stages, a full queue holds up the stage in front of it
+DEFAULT_QUEUE_SIZE = 64
+# Number of contracts each stage works on at the same time
+DEFAULT_WORKERS = {"fetch": 8, "selectors": 4, "audit": 2}
+
+# Scan progress, saved to a JSON file so that a restarted scanner resumes where the last one stopped.
+# Contracts complete out of order, so the checkpoint only moves past a block once every contract created in it and in
+# all blocks before it has been through all stages. Contracts that were in flight when the scanner stopped are
+# processed again after a restart, their analyses are taken from the analysis cache.
+class Checkpoint:
+    def __init__(self, path, chain_id, start_block=None):
+        self.path = path
+        self.chain_id = chain_id
+        self.next_block = start_block
+        # Number of contracts of each block that are still in the pipeline, in block order
+        self.outstanding = OrderedDict()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state["chain_id"] != chain_id:
+                raise ValueError(f"Checkpoint {path} belongs to chain {state['chain_id']}, the RPC node serves chain {chain_id}")
+            self.next_block = state["next_block"]
+
+    def save(self):
+        if self.path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"chain_id": self.chain_id, "next_block": self.next_block}, f)
+        os.replace(tmp_path, self.path)
+
+    # Register a block that has been scanned and the number of contracts created in it
+    def add_block(self, number, contracts):
+        self.outstanding[number] = contracts
+        self.advance()
+
+    # A contract created in block `number` went through all stages
+    def complete(self, number):
+        self.outstanding[number] -= 1
+        self.advance()
+
+    def advance(self):
+        moved = False
+        while self.outstanding:
+            number, contracts = next(iter(self.outstanding.items()))
+            if contracts > 0:
+                break
+            self.outstanding.popitem(last=False)
+            self.next_block = number + 1
+            moved = True
+        if moved:
+            self.save()
+
+# Long-running scanner that follows the blocks of a chain and audits every contract deployed in them.
+# Deployments are picked out of the blocks by their transactions without a recipient, and each created contract goes
+# through the stages
+#   fetch      runtime bytecode, from the analysis cache or the RPC node
+#   selectors  function selectors and, where the signature index knows them, their signatures
+#   audit      control flow graph statistics and scores of the models of each token type, in one task in the
+#              executor's worker processes, so that the graph is built once for all of them
+# with a bounded queue in front of each stage. Each stage runs `workers[stage]` contracts at a time. A contract that
+# fails in a stage skips the remaining ones and is reported with its error. Results are written to `output` as one
+# JSON object per line.
+# Contracts created by other contracts, e.g. by factories, are not picked up: they don't have a deployment transaction
+# of their own.
+class ChainScanner:
+    def __init__(self, rpc_url, token_types, output, checkpoint_file=None, start_block=None, end_block=None, confirmations=0,
+                 poll_interval=DEFAULT_POLL_INTERVAL, retry_interval=DEFAULT_RETRY_INTERVAL, block_batch_size=DEFAULT_BLOCK_BATCH_SIZE,
+                 queue_size=DEFAULT_QUEUE_SIZE, workers=None, executor=None):
+        self.rpc_url = rpc_url
+        self.token_types = token_types
+        self.output = output
+        self.checkpoint_file = checkpoint_file
+        self.start_block = start_block
+        self.end_block = end_block
+        self.confirmations = confirmations
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.block_batch_size = block_batch_size
+        self.queue_size = queue_size
+        self.workers = dict(DEFAULT_WORKERS, **(workers or {}))
+        # The CPU-heavy stage never has more contracts in flight than it has workers
+        self.executor = executor or BoundedExecutor(max_pending=self.workers["audit"])
+        self.checkpoint = None
+
+    # Follow the chain from the checkpoint, or from `start_block`, and queue every contract created on the way.
+    # Errors of the RPC node are logged and the same blocks are scanned again after a while, the checkpoint only moves
+    # past blocks that were scanned completely.
+    async def follow(self, queue):
+        client = get_client(self.rpc_url)
+        next_block = self.checkpoint.next_block
+        failures = 0
+        while next_block is None or self.end_block is None or next_block <= self.end_block:
+            try:
+                head = await client.block_number() - self.confirmations
+                if next_block is None:
+                    next_block = self.checkpoint.next_block = head
+                if self.end_block is not None:
+                    head = min(head, self.end_block)
+                if next_block > head:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                numbers = list(range(next_block, min(head, next_block + self.block_batch_size - 1) + 1))
+                deployments, receipts = await self.scan(client, numbers)
+            except SCAN_ERRORS as e:
+                delay = min(self.retry_interval * 2 ** failures, MAX_RETRY_INTERVAL)
+                failures += 1
+                logger.error(f"Error scanning from block {next_block}, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+            failures = 0
+
+            receipts = iter(receipts)
+            for number, transactions in zip(numbers, deployments):
+                contracts = []
+                for transaction in transactions:
+                    receipt = next(receipts)
+                    # Failed deployments don't leave a contract behind
+                    if receipt.get("contractAddress") and int(receipt.get("status") or "0x1", 16) == 1:
+                        contracts.append({"block": number, "transaction": transaction, "address": receipt["contractAddress"]})
+                self.checkpoint.add_block(number, len(contracts))
+                for contract in contracts:
+                    await queue.put(contract)
+            logger.info(f"Scanned blocks {numbers[0]} to {numbers[-1]}")
+            next_block = numbers[-1] + 1
+
+    # The hashes of the deployment transactions in each of the blocks `numbers`, and the receipts of all of them
+    async def scan(self, client, numbers):
+        blocks = await client.get_blocks(numbers)
+        deployments = []
+        for number, block in zip(numbers, blocks):
+            if block is None:
+                # Nodes behind a load balancer may not all have the latest blocks yet
+                raise RpcError(None, f"Block {number} is not available")
+            deployments.append([transaction["hash"] for transaction in block["transactions"] if transaction.get("to") is None])
+        hashes = [transaction for transactions in deployments for transaction in transactions]
+        receipts = await client.get_receipts(hashes)
+        for transaction, receipt in zip(hashes, receipts):
+            if receipt is None:
+                raise RpcError(None, f"Receipt of {transaction} is not available")
+        return deployments, receipts
+
+    async def fetch(self, contract):
+        code_hash, bytecode = await pipeline.fetch_bytecode_async(contract["address"], self.rpc_url)
+        if bytecode is None:
+            # The contract destroyed itself, or its constructor didn't return any code
+            raise ValueError("No bytecode found for the contract address.")
+        contract["code_hash"] = code_hash
+        contract["bytecode"] = bytecode
+
+    async def selectors(self, contract):
+        contract["selectors"] = await asyncio.to_thread(unique_selectors, contract["bytecode"])
+        contract["signatures"] = dict(await pipeline.signatures_async(contract["code_hash"], contract["bytecode"]))
+
+    async def audit(self, contract):
+        audit = await self.executor.run(pipeline.audit_token_types, contract["code_hash"], contract["bytecode"], self.token_types)
+        contract["partial"] = audit["partial"]
+        contract["stats"] = audit["stats"]
+        contract["audits"] = audit["audits"]
+
+    # Write the result of a contract that went through all stages
+    def finish(self, contract):
+        result = {key: value for key, value in contract.items() if key != "bytecode"}
+        self.output.write(json.dumps(result) + "\n")
+        self.output.flush()
+        self.checkpoint.complete(contract["block"])
+
+    async def stage(self, name, step, inbox, outbox):
+        while True:
+            contract = await inbox.get()
+            try:
+                if "error" not in contract:
+                    await step(contract)
+            except Exception as e:
+                logger.error(f"Error in stage {name} for {contract['address']}: {e}")
+                contract["error"] = f"{name}: {e}"
+            if outbox is not None:
+                await outbox.put(contract)
+            else:
+                self.finish(contract)
+            inbox.task_done()
+
+    # Scan until `end_block` has been processed, or forever if there is none
+    async def run(self):
+        # Fork the executor's workers before the RPC client and the stages start any threads
+        self.executor.start()
+        client = get_client(self.rpc_url)
+        self.checkpoint = Checkpoint(self.checkpoint_file, await client.chain_id(), self.start_block)
+        stages = [("fetch", self.fetch), ("selectors", self.selectors), ("audit", self.audit)]
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in stages]
+        workers = []
+        for idx, (name, step) in enumerate(stages):
+            outbox = queues[idx + 1] if idx + 1 < len(queues) else None
+            workers.append([asyncio.create_task(self.stage(name, step, queues[idx], outbox)) for _ in range(self.workers[name])])
+        try:
+            await self.follow(queues[0])
+            # Drain the stages in order, each one only gets new contracts from the one before it
+            for queue, tasks in zip(queues, workers):
+                await queue.join()
+                for task in tasks:
+                    task.cancel()
+        finally:
+            for tasks in workers:
+                for task in tasks:
+                    task.cancel()
+            await close_clients()
+            self.executor.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Follow a chain and audit every contract deployed on it")
+    parser.add_argument("rpc_url", help="RPC node to follow")
+    parser.add_argument("--token-type", action="append", dest="token_types", help="token type to audit the contracts as, can be given more than once (default ERC-20)")
+    parser.add_argument("--output", help="file the results are appended to as JSON lines (default stdout)")
+    parser.add_argument("--checkpoint", help="file the progress is saved to and resumed from")
+    parser.add_argument("--start-block", type=int, help="first block to scan if there is no checkpoint (default the latest block)")
+    parser.add_argument("--end-block", type=int, help="last block to scan (default: keep following the chain)")
+    parser.add_argument("--confirmations", type=int, default=0, help="number of blocks to stay behind the head of the chain")
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL, help="seconds between polls for new blocks")
+    parser.add_argument("--retry-interval", type=float, default=DEFAULT_RETRY_INTERVAL, help="seconds to wait after the RPC node failed, doubled for each failure in a row")
+    parser.add_argument("--block-batch-size", type=int, default=DEFAULT_BLOCK_BATCH_SIZE, help="blocks fetched per batch")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE, help="contracts waiting in front of each stage")
+    for name, workers in DEFAULT_WORKERS.items():
+        parser.add_argument(f"--{name}-workers", type=int, default=workers, help=f"contracts processed at the same time by the {name} stage")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s]: %(message)s")
+    output = open(args.output, "a") if args.output else sys.stdout
+    scanner = ChainScanner(
+        args.rpc_url, args.token_types or ["ERC-20"], output, checkpoint_file=args.checkpoint, start_block=args.start_block,
+        end_block=args.end_block, confirmations=args.confirmations, poll_interval=args.poll_interval,
+        retry_interval=args.retry_interval, block_batch_size=args.block_batch_size, queue_size=args.queue_size,
+        workers={name: getattr(args, f"{name}_workers") for name in DEFAULT_WORKERS},
+    )
+    try:
+        asyncio.run(scanner.run())
+    except KeyboardInterrupt:
+        pass
@@ -1,30 +1,19 @@
 from web3 import Web3
-import os
+from utils.rpc_client import get_client
 
-def get_bytecode(contract_address, web3):
-    bytecode = web3.eth.get_code(contract_address)
-    return bytecode
+async def get_chain_id_async(node):
+    return await get_client(node).chain_id()
 
-def save_bytecode(contract_address, bytecode):
-    directory = "contracts"
-    contract_dir= directory+"/"+contract_address
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    if not os.path.exists(contract_dir):
-        os.makedirs(contract_dir)
-    filename = contract_address + ".bin"
-    with open(f"{contract_dir}/{filename}", "w") as f:
-        f.write(bytecode.hex()[2:])
-    return
+# Runtime bytecode of the contract at `contract_address`, fetched through the shared client of the RPC node.
+# Returns None for invalid addresses and addresses without code.
+async def scrape_bytecode_async(contract_address, node):
+    if not Web3.is_address(contract_address):
+        return None
+    bytecode = await get_client(node).get_code(Web3.to_checksum_address(contract_address))
+    return bytecode or None
 
-def scrape_bytecode(contract_address, node):
-    web3 = Web3(Web3.HTTPProvider(node))
-    if web3.is_address(contract_address):
-        contract_address = web3.to_checksum_address(contract_address)
-        bytecode = get_bytecode(contract_address, web3)
-        if bytecode:
-            save_bytecode(contract_address, bytecode)
-        else:
-            print(f"No bytecode found for contract address {contract_address}")
-    else:
-        print(f"Invalid contract address: {contract_address}")
\ No newline at end of file
+# Runtime bytecode of each of the `contract_addresses`, fetched together in JSON-RPC batches.
+# Returns None for addresses without code, and the error for addresses whose code couldn't be fetched.
+async def scrape_bytecodes_async(contract_addresses, node):
+    codes = await get_client(node).get_codes([Web3.to_checksum_address(address) for address in contract_addresses], return_exceptions=True)
+    return [code if code else None for code in codes]
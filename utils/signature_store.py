@@ -0,0 +1,163 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import asyncio
+import argparse
+import threading
+from collections import OrderedDict
+from utils import metrics
+from utils.analysis_cache import CACHE_DIR
+
+# SQLite file holding the selector -> signature index
+SIGNATURE_DB = os.environ.get("SIGNATURE_DB", os.path.join(CACHE_DIR, "signatures.sqlite"))
+# Number of selectors kept in memory in front of the index
+DEFAULT_LRU_SIZE = int(os.environ.get("SIGNATURE_LRU_SIZE", 65536))
+# Seconds after which a selector the remote backend didn't know is asked for again
+DEFAULT_MISS_TTL = float(os.environ.get("SIGNATURE_MISS_TTL", 7 * 24 * 3600))
+
+# A line of a dump file: the hex encoded selector, a separator and the signature
+DUMP_LINE = re.compile(r"^(?:0x)?([0-9a-fA-F]{8})[\s,:;]+(.+?)\s*$")
+
+# Local index of hex encoded selectors and their signatures, in front of a remote backend.
+# Selectors are looked up in an in-process LRU, then in an SQLite file, and only then in the remote backend. Whatever
+# the remote backend answers is written back into the index, including the selectors it doesn't know, so that once the
+# index is warm no lookup leaves the machine.
+class SignatureStore:
+    def __init__(self, path=SIGNATURE_DB, remote=None, lru_size=DEFAULT_LRU_SIZE, miss_ttl=DEFAULT_MISS_TTL):
+        self.path = path
+        self.remote = remote
+        self.lru_size = lru_size
+        self.miss_ttl = miss_ttl
+        # selector -> (signature, checked_at), the signature is None for selectors that are known to be missing
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def connection(self):
+        # SQLite connections can't be shared between threads, nor survive a fork into the executor's workers
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS signatures (selector INTEGER PRIMARY KEY, signature TEXT, checked_at REAL)")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    # Keep `found`, a dict of selector -> (signature, checked_at), in the LRU
+    def remember(self, found):
+        with self.lock:
+            for selector, entry in found.items():
+                self.lru[selector] = entry
+                self.lru.move_to_end(selector)
+            while len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+
+    # Look up `selectors` locally. Returns the signatures found, with None for known misses, and the selectors that
+    # have to be asked for remotely.
+    def lookup_local(self, selectors):
+        # Misses checked before this are asked for again, in long-running workers as well as in the index
+        stale = time.time() - self.miss_ttl
+        found = {}
+        with self.lock:
+            for selector in selectors:
+                entry = self.lru.get(selector)
+                if entry is None:
+                    continue
+                signature, checked_at = entry
+                if signature is None and checked_at < stale:
+                    del self.lru[selector]
+                    continue
+                found[selector] = signature
+                self.lru.move_to_end(selector)
+        missing = [selector for selector in selectors if selector not in found]
+
+        if missing:
+            indexed = {}
+            conn = self.connection()
+            # SQLite limits the number of parameters of a statement
+            for offset in range(0, len(missing), 500):
+                chunk = missing[offset:offset+500]
+                rows = conn.execute(
+                    f"SELECT selector, signature, checked_at FROM signatures WHERE selector IN ({','.join('?' * len(chunk))})",
+                    [int(selector, 16) for selector in chunk],
+                )
+                for selector, signature, checked_at in rows:
+                    if signature is not None or checked_at >= stale:
+                        indexed[f"{selector:08x}"] = (signature, checked_at)
+            self.remember(indexed)
+            found.update((selector, signature) for selector, (signature, _) in indexed.items())
+            missing = [selector for selector in missing if selector not in indexed]
+
+        metrics.cache_lookups.inc(len(found), entry="signature", result="hit")
+        metrics.cache_lookups.inc(len(missing), entry="signature", result="miss")
+        return found, missing
+
+    # Store what the remote backend answered for `selectors`, selectors missing from `found` are stored as misses
+    def write_back(self, selectors, found):
+        now = time.time()
+        answered = {selector: found.get(selector) for selector in selectors}
+        with self.connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO signatures (selector, signature, checked_at) VALUES (?, ?, ?)",
+                [(int(selector, 16), signature, now) for selector, signature in answered.items()],
+            )
+        self.remember({selector: (signature, now) for selector, signature in answered.items()})
+
+    @staticmethod
+    def known(found):
+        return {selector: signature for selector, signature in found.items() if signature is not None}
+
+    # the signature of each of the hex encoded `selectors` that is known
+    def lookup(self, selectors) -> dict:
+        found, missing = self.lookup_local(selectors)
+        if missing and self.remote is not None:
+            try:
+                remote_found = self.remote.lookup(missing)
+            except Exception as e:
+                # without the remote backend, the local index is all there is
+                print(f"error querying remote signature backend: {e}")
+            else:
+                self.write_back(missing, remote_found)
+                found.update(remote_found)
+        return self.known(found)
+
+    async def lookup_async(self, selectors) -> dict:
+        found, missing = await asyncio.to_thread(self.lookup_local, selectors)
+        if missing and self.remote is not None:
+            try:
+                remote_found = await self.remote.lookup_async(missing)
+            except Exception as e:
+                print(f"error querying remote signature backend: {e}")
+            else:
+                await asyncio.to_thread(self.write_back, missing, remote_found)
+                found.update(remote_found)
+        return self.known(found)
+
+    # Bulk load selectors and signatures from a dump file, either a JSON object of selector -> signature or a text
+    # file with one "<selector> <signature>" pair per line. Returns the number of signatures imported.
+    def import_dump(self, dump_file) -> int:
+        with open(dump_file) as f:
+            if dump_file.endswith(".json"):
+                pairs = [(selector.lower().removeprefix("0x"), signature) for selector, signature in json.load(f).items()]
+            else:
+                pairs = [match.groups() for match in map(DUMP_LINE.match, f) if match]
+        now = time.time()
+        with self.connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO signatures (selector, signature, checked_at) VALUES (?, ?, ?)",
+                [(int(selector, 16), signature, now) for selector, signature in pairs],
+            )
+        with self.lock:
+            self.lru.clear()
+        return len(pairs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import function signatures into the local signature index")
+    parser.add_argument("dump_file", help="JSON object of selector -> signature, or one '<selector> <signature>' pair per line")
+    parser.add_argument("--db", default=SIGNATURE_DB, help="SQLite file of the index")
+    args = parser.parse_args()
+    print(f"Imported {SignatureStore(args.db).import_dump(args.dump_file)} signatures into {args.db}")
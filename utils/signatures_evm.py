@@ -1,107 +1,155 @@
-import binascii
+import asyncio
 import os
+import threading
 import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import credentials, firestore, firestore_async
 from google.cloud.firestore_v1.base_query import FieldFilter
 import json
+from utils import metrics
+from utils.disassembly import disassemble, find_selectors
+from utils.signature_store import SignatureStore
 
-def initialize_firebase() -> None:
-    try:
-        firebase_config = os.environ.get('FIREBASE_CONFIG')
-        if firebase_config:
-            # If firebase_config is defined, use it
-            firebase_cred = credentials.Certificate(json.loads(firebase_config))
+# the Firestore clients, Firebase is only initialized the first time they are needed
+def initialize_firebase():
+    firebase_config = os.environ.get('FIREBASE_CONFIG')
+    if firebase_config:
+        # If firebase_config is defined, use it
+        firebase_cred = credentials.Certificate(json.loads(firebase_config))
+    else:
+        # If firebase_config is not defined, check for firebase_config_path
+        firebase_config_path = os.environ.get('FIREBASE_CONFIG_PATH')
+        if firebase_config_path:
+            # If firebase_config_path is defined, load the config from a json file
+            with open(firebase_config_path) as json_file:
+                firebase_cred = credentials.Certificate(json.load(json_file))
         else:
-            # If firebase_config is not defined, check for firebase_config_path
-            firebase_config_path = os.environ.get('FIREBASE_CONFIG_PATH')
-            if firebase_config_path:
-                # If firebase_config_path is defined, load the config from a json file
-                with open(firebase_config_path) as json_file:
-                    firebase_cred = credentials.Certificate(json.load(json_file))
-            else:
-                # If neither firebase_config nor firebase_config_path is defined, print an error
-                raise Exception("Neither FIREBASE_CONFIG nor FIREBASE_CONFIG_PATH is defined in the environment variables.")
-
-        if not firebase_admin._apps:
-            firebase_admin.initialize_app(firebase_cred)
-        global db
-        db = firestore.client()
-    except Exception as e:
-        print(f"error initializing Firebase: {e}")
-        exit(1)
+            # If neither firebase_config nor firebase_config_path is defined, raise an error
+            raise Exception("Neither FIREBASE_CONFIG nor FIREBASE_CONFIG_PATH is defined in the environment variables.")
 
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(firebase_cred)
+    return firestore.client(), firestore_async.client()
 
-def resolve_sigs(bytecode) -> list:
-    ops = []
-
-    # basic parsing of evm bytecode
-    pos = 0
-    while pos < len(bytecode):
-        op = {}
-        # check if the op is a PUSH
-        if bytecode[pos] >= 0x60 and bytecode[pos] <= 0x7f:
-            if pos+2+int(bytecode[pos]-0x60) > len(bytecode):
-                # A push that implies data beyond the end of the bytecode.
-                break
-            op["Opcode"] = bytecode[pos]
-            op["IsPush"] = True
-            op["arg"] = bytecode[pos+1 : pos+2+int(bytecode[pos]-0x60)]
-            pos += int(bytecode[pos]-0x60) + 1
-        else:
-            op["Opcode"] = bytecode[pos]
-            op["IsPush"] = False
-            op["arg"] = b''
-        ops.append(op)
-        pos += 1
-
-    # search for specific pattern containing the function selector
-    selectors = []
-    for offset in range(len(ops) - 4):
-        # 0x14 = EQ
-        # 0x57 = JUMPI
-        if ops[offset]["IsPush"] and ops[offset+1]["Opcode"] == 0x14 and ops[offset+2]["IsPush"] and ops[offset+3]["Opcode"] == 0x57:
-            selector = ops[offset]["arg"]
-            if len(selector) > 4:
-                # the pattern must have been misinterpreted, selectors can't be
-                # larger than four bytes
-                continue
-            while len(selector) < 4:
-                selector = b'\x00' + selector
-            selectors.append(selector)
 
+# Firestore answers `in` queries with at most this many values
+IN_QUERY_LIMIT = 30
+
+# Looks up signatures in the Signature collection in Firestore, with one `in` query per chunk of selectors
+class FirestoreBackend:
+    def __init__(self):
+        self.clients = None
+        self.lock = threading.Lock()
+
+    @property
+    def db(self):
+        return self.initialize()[0]
+
+    @property
+    def async_db(self):
+        return self.initialize()[1]
+
+    def initialize(self):
+        with self.lock:
+            if self.clients is None:
+                self.clients = initialize_firebase()
+            return self.clients
+
+    def query(self, db, codes):
+        return db.collection(u'Signature').where(filter=FieldFilter(u'Code', u'in', codes))
+
+    # the signature of each of the hex encoded `selectors` that is in Firestore
+    def lookup(self, selectors) -> dict:
+        found = {}
+        with metrics.timer("firestore_lookup"):
+            for offset in range(0, len(selectors), IN_QUERY_LIMIT):
+                for sig in self.query(self.db, selectors[offset:offset+IN_QUERY_LIMIT]).stream():
+                    sig = sig.to_dict()
+                    found[sig['Code']] = sig['Signature']
+        return found
+
+    async def lookup_async(self, selectors) -> dict:
+        async def lookup_chunk(codes):
+            return [sig.to_dict() async for sig in self.query(self.async_db, codes).stream()]
+
+        # the chunks are queried concurrently
+        chunks = [selectors[offset:offset+IN_QUERY_LIMIT] for offset in range(0, len(selectors), IN_QUERY_LIMIT)]
+        found = {}
+        with metrics.timer("firestore_lookup"):
+            chunk_sigs = await asyncio.gather(*(lookup_chunk(codes) for codes in chunks))
+        for sigs in chunk_sigs:
+            for sig in sigs:
+                found[sig['Code']] = sig['Signature']
+        return found
+
+# Looks up signatures in a dict of hex encoded selector -> signature, a local stand-in for Firestore
+class DictBackend:
+    def __init__(self, signatures):
+        self.signatures = signatures
+
+    def lookup(self, selectors) -> dict:
+        return {selector: self.signatures[selector] for selector in selectors if selector in self.signatures}
+
+    async def lookup_async(self, selectors) -> dict:
+        return self.lookup(selectors)
+
+backend = None
+
+# the backend signatures are looked up in: the local signature index, falling back to Firestore, unless another one
+# was set with `set_backend`
+def get_backend():
+    global backend
+    if backend is None:
+        backend = SignatureStore(remote=FirestoreBackend())
+    return backend
+
+def set_backend(new_backend) -> None:
+    global backend
+    backend = new_backend
+
+# each selector only needs to be looked up once, even if the dispatcher compares against it more than once
+def unique_selectors(bytecode) -> list:
+    return list(dict.fromkeys(selector.hex() for selector in find_selectors(disassemble(bytecode))))
+
+def format_signatures(selectors, found) -> list:
     signatures = []
     for selector in selectors:
-        try:
-            name, err = resolve_sig(selector)
-            if err is not None:
-                print(f"Error resolving signature: {err}")
-                continue
-            signatures.append((binascii.hexlify(selector).decode(), name))
-        except Exception as e:
-            print(f"error processing selector: {e}")
-            continue
-
+        if selector not in found:
+            print(f"Signature for selector {selector} not found.")
+        signatures.append((selector, found.get(selector, "Not found")))
     return signatures
 
-def resolve_sig(bin_sig):
+def resolve_sigs(bytecode) -> list:
+    selectors = unique_selectors(bytecode)
     try:
-        sigs_ref = db.collection(u'Signature')
-        sigs = sigs_ref.where(filter=FieldFilter(u'Code', u'==', binascii.hexlify(bin_sig).decode())).stream()
-        for sig in sigs:
-            return sig.to_dict()['Signature'], None
-        print(f"Signature for selector {binascii.hexlify(bin_sig).decode()} not found in Firestore.")
-        return "Not found", None
+        found = get_backend().lookup(selectors)
     except Exception as e:
-        print(f"error querying Firestore: {e}")
-        return None, e
+        print(f"error looking up signatures: {e}")
+        return []
+    return format_signatures(selectors, found)
+
+async def resolve_sigs_async(bytecode) -> list:
+    selectors = unique_selectors(bytecode)
+    try:
+        found = await get_backend().lookup_async(selectors)
+    except Exception as e:
+        print(f"error looking up signatures: {e}")
+        return []
+    return format_signatures(selectors, found)
 
 # get the function signatures of a contract
 def get_signatures(bytecode):
-    initialize_firebase()
     try:
         bytecode = bytes.fromhex(bytecode)
-    except Exception as e:
-        print(f"error processing bytecode: {e}")
-        exit(1)
+    except ValueError as e:
+        raise ValueError(f"error processing bytecode: {e}")
+
+    return resolve_sigs(bytecode)
+
+# same as `get_signatures`, looking up signatures without blocking the event loop
+async def get_signatures_async(bytecode):
+    try:
+        bytecode = bytes.fromhex(bytecode)
+    except ValueError as e:
+        raise ValueError(f"error processing bytecode: {e}")
 
-    return resolve_sigs(bytecode)
\ No newline at end of file
+    return await resolve_sigs_async(bytecode)
@@ -1,15 +1,72 @@
+import os
+from functools import lru_cache
+from utils.disassembly import NAMES, POPS, PUSHES, KINDS, IMMEDIATE_SIZE, PUSH, POP, DUP, SWAP, DUP1, SWAP1
+
+# Opcode of each operation name
+OPCODES = {name: opcode for opcode, name in enumerate(NAMES) if name != "INVALID"}
+
+def opcodes(names):
+	return frozenset(OPCODES[name] for name in names)
+
+# Usage category of the values an operation reads, None for operations whose inputs aren't categorized
+CATEGORIES = [None] * 256
+for category, names in [
+	("ArithData", ["ADD", "MUL", "SUB", "EXP", "SIGNEXTEND"]),
+	("BlockData", ["BLOCKHASH", "COINBASE", "TIMESTAMP", "NUMBER"]),
+	("LogicData", ["LT", "GT", "SLT", "SGT", "EQ", "ISZERO"]),
+	("MemData", ["MLOAD"]),
+	("StorData", ["SLOAD"]),
+	("BitData", ["BYTE", "SHL", "SHR", "SAR", "AND", "OR", "XOR", "NOT"]),
+]:
+	for name in names:
+		CATEGORIES[OPCODES[name]] = category
+CATEGORIES = tuple(CATEGORIES)
+
+BINARY_OPS = opcodes(["ADD", "MUL", "SUB", "DIV", "SDIV", "MOD", "SMOD", "EXP", "SIGNEXTEND", "AND", "OR", "XOR", "BYTE", "SHL", "SHR", "SAR"])
+TERNARY_OPS = opcodes(["ADDMOD", "MULMOD"])
+JUMP_OPS = opcodes(["JUMP", "JUMPI"])
+(NOT, ADD, MUL, SUB, DIV, SDIV, MOD, SMOD, EXP, SIGNEXTEND, AND, OR, XOR, BYTE, SHL, SHR, SAR, ADDMOD, MULMOD) = (
+	OPCODES[name] for name in ["NOT", "ADD", "MUL", "SUB", "DIV", "SDIV", "MOD", "SMOD", "EXP", "SIGNEXTEND", "AND", "OR", "XOR", "BYTE", "SHL", "SHR", "SAR", "ADDMOD", "MULMOD"]
+)
+
+# Stack values are 256-bit words
+MAX_VALUE = 2**256 - 1
+
+# Items of `StackMapping.pushed`: literals are stored as their non-negative value, copies of the preexisting stack
+# item at `index` (0 being the topmost one) as the negative number -1-index, and unknown values as None
+def back_reference(index):
+	return -1 - index
+
+def back_reference_index(item):
+	return -1 - item
+
+def is_back_reference(item):
+	return item is not None and item < 0
+
+def is_literal(item):
+	return item is not None and item >= 0
+
+# The value of the 256-bit word as a two's complement signed number
+def signed(value):
+	return value - 2**256 if value >> 255 else value
+
+# Number of distinct block bodies whose stack mapping is kept around, see `stack_mapping`
+CACHE_SIZE = int(os.environ.get("STACK_MAPPING_CACHE_SIZE", 65536))
+
 # Class for performing basic stack dataflow analysis.
 # It is used to predict jump destinations and track the immediate values of PUSH operations.
+# It runs over `code`, the bytecode of a sequence of complete instructions such as a basic block.
 class StackMapping:
-	def __init__(self, ops):
+	__slots__ = ("num_poped", "pushed", "creation_op_idx", "value_usage_type", "jump_dest", "jump_dest_stack_index")
+
+	def __init__(self, code):
         # Number of preexisting stack items popped by the operations.
 		self.num_poped = 0
 		
         # List of items pushed onto the stack. After executing the operations, the stack will be the preexisting stack 
         # with `self.numpoped` items popped from it and the items in `self.pushed` pushed onto it. Each item in this
-        # list can be None (unknown value), a bytes value (representing a literal and statically known stack item) 
-        # or an int (representing a copy of a preexisting stack item: 0 means the topmost preexisting stack item, 
-        # 1 means the 2nd topmost item, etc.)
+        # list can be None (unknown value), a non-negative int (representing a literal and statically known stack item) 
+        # or a negative int (representing a copy of a preexisting stack item, see `back_reference`)
 		self.pushed = []
 		
         # Index (in the `ops` list) of the instruction at which any given stack item was created (DUPs and SWAPs 
@@ -20,42 +77,63 @@ class StackMapping:
         # Mapping of instruction indices to usage types of the values produced by the instruction. Used for operand 
         # normalization {op_idx: ["ArithData", "LogicData", ...]}
 		self.value_usage_type = {}
+
+		# If the code ends with a jump, where the jump destination comes from: a statically known destination, or the
+		# index on the preexisting stack it is read from. Both are None if it isn't known.
+		self.jump_dest = None
+		self.jump_dest_stack_index = None
 		
-		# Helper function that adds the `category` to the usage type list of the instruction index
-		# that produced the inputs to the instruction if `op` is one of the `ops`
-		def operant_categorization(category, ops, op, stack_op_idx, usage_map):
-			if op.name in ops:     # Check if the operation matches
-       			 # Iterate over the instruction's inputs
-				for stack_idx in range(len(stack_op_idx)-min(len(stack_op_idx), op.pops),len(stack_op_idx)):
-            		# Skip if we don't know where the value came from
+		stack_op_idx = self.creation_op_idx
+		usage_map = self.value_usage_type
+		op_idx = 0
+		pos = 0
+		while pos < len(code):
+			opcode = code[pos]
+			size = IMMEDIATE_SIZE[opcode]
+
+			if opcode in JUMP_OPS and pos + 1 == len(code):
+				# Before the final jump, the topmost item on the stack is the jump destination
+				self.record_jump_dest()
+
+			# Categorize the operands of the instruction, adding the category to the usage type list of the
+			# instructions that produced its inputs
+			category = CATEGORIES[opcode]
+			if category != None:
+				for stack_idx in range(len(stack_op_idx)-min(len(stack_op_idx), POPS[opcode]),len(stack_op_idx)):
+					# Skip if we don't know where the value came from
 					if stack_op_idx[stack_idx] != None:
-               			 # Initialize the usage map if it doesn't have an entry for the instruction
-						if usage_map.get(stack_op_idx[stack_idx]) == None:
-							usage_map[stack_op_idx[stack_idx]] = []
-               			# Add the category if it isn't registered already
-						if not category in usage_map[stack_op_idx[stack_idx]]:
-							usage_map[stack_op_idx[stack_idx]].append(category)
-		
-		for op_idx, op in enumerate(ops):
-			# Categorize the operands of various instructions into various categories
-			operant_categorization("ArithData", ["ADD", "MUL", "SUB", "EXP", "SIGNEXTEND"], op, self.creation_op_idx, self.value_usage_type)
-			operant_categorization("BlockData", ["BLOCKHASH", "COINBASE", "TIMESTAMP", "NUMBER"], op, self.creation_op_idx, self.value_usage_type)
-			operant_categorization("LogicData", ["LT", "GT", "SLT", "SGT", "EQ", "ISZERO"], op, self.creation_op_idx, self.value_usage_type)
-			operant_categorization("MemData", ["MLOAD"], op, self.creation_op_idx, self.value_usage_type)
-			operant_categorization("StorData", ["SLOAD"], op, self.creation_op_idx, self.value_usage_type)
-			operant_categorization("BitData", ["BYTE", "SHL", "SHR", "SAR", "AND", "OR", "XOR", "NOT"], op, self.creation_op_idx, self.value_usage_type)
+						categories = usage_map.setdefault(stack_op_idx[stack_idx], [])
+						# Add the category if it isn't registered already
+						if not category in categories:
+							categories.append(category)
 			
 			# Simulating the effects of stack-modifying operations
-			if op.name[:4] == "PUSH":
-				self.push(op.bytes[1:], op_idx)
-			elif op.name == "POP":
+			kind = KINDS[opcode]
+			if kind == PUSH:
+				self.push(int.from_bytes(code[pos+1:pos+1+size], "big"), op_idx)
+			elif kind == POP:
 				self.pop()
-			elif op.name[:3] == "DUP":
-				self.dup_n(int(op.name[3:]))
-			elif op.name[:4] == "SWAP":
-				self.swap_n(int(op.name[4:]))
+			elif kind == DUP:
+				self.dup_n(opcode - DUP1 + 1)
+			elif kind == SWAP:
+				self.swap_n(opcode - SWAP1 + 1)
 			else:
-				self.misc_op(op, op_idx)
+				self.misc_op(opcode, op_idx)
+
+			op_idx += 1
+			pos += 1 + size
+
+	def record_jump_dest(self):
+		if len(self.pushed) == 0:
+			# If there aren't any stack items pushed by ourselves, the topmost item is the topmost remaining stack item after our pops
+			self.jump_dest_stack_index = self.num_poped
+		elif is_back_reference(self.pushed[-1]):
+			# If the topmost item is a back-reference, we maintain that back-reference as-is.
+			self.jump_dest_stack_index = back_reference_index(self.pushed[-1])
+		elif is_literal(self.pushed[-1]):
+			# If the topmost item is a literal we have a static jump destination
+			self.jump_dest = self.pushed[-1]
+		# Otherwise, it is None, meaning that we don't know.
 	
 	def push(self, value, op_idx):
 		"""
@@ -89,7 +167,7 @@ class StackMapping:
 			# If we're duplicating a value from the pre-existing stack, we store a back-reference
 			# for the value and add 'None' for the creation_op_idx to indicate that
 			# we don't know where the value originally came from.
-			self.pushed.append(n - len(self.pushed) - 1 + self.num_poped)
+			self.pushed.append(back_reference(n - len(self.pushed) - 1 + self.num_poped))
 			self.creation_op_idx.append(None)
 	
 	def swap_n(self, n):
@@ -100,121 +178,99 @@ class StackMapping:
 		# we have to pop more values from the original stack and pretend we pushed them
 		# right back on so that they are in the order as they were originally.
 		if len(self.pushed) < n + 1:
-			for x in range((n + 1) - len(self.pushed)):
-				self.pushed.insert(0, self.num_poped)
-				self.creation_op_idx.insert(0, None)
-				self.num_poped += 1
+			missing = (n + 1) - len(self.pushed)
+			self.pushed[:0] = [back_reference(index) for index in range(self.num_poped + missing - 1, self.num_poped - 1, -1)]
+			self.creation_op_idx[:0] = [None] * missing
+			self.num_poped += missing
 		
 		# Swap the value and creation index of the topmost item with the n-th item
 		# counted from the top down (n=1 means swap the topmost with the 2nd topmost)
 		self.pushed[-1], self.pushed[-1-n] = self.pushed[-1-n], self.pushed[-1]
 		self.creation_op_idx[-1], self.creation_op_idx[-1-n] = self.creation_op_idx[-1-n], self.creation_op_idx[-1]
 	
-	def misc_op(self, op, op_idx):
+	def misc_op(self, opcode, op_idx):
 		"""
         Simulates the stack operations of any operations, treats the output
         value(s) as unknown, except for arithmetic operations if the inputs are known.
         """
 		# Number of items to pop from the stack
-		pops = op.pops
+		pops = POPS[opcode]
 		# Number of items to push to the stack
-		pushes = op.pushes
+		pushes = PUSHES[opcode]
 		out_value = None
+		pushed = self.pushed
 
 		# See <https://ethereum.github.io/yellowpaper/paper.pdf> page 30
 		# Check the operation name and perform corresponding stack operation
-		if op.name == "NOT":
-			# Check if there is at least one item on the stack and if it is bytes
-			if len(self.pushed) >= 1 and isinstance(self.pushed[-1], bytes):
-				out_value = (int.from_bytes(self.pushed[-1], "big", signed=False) ^ ((2**256)-1)).to_bytes(32, "big")
-		elif op.name in ["ADD", "MUL", "SUB", "DIV", "SDIV", "MOD", "SMOD", "EXP", "SIGNEXTEND", "AND", "OR", "XOR", "BYTE", "SHL", "SHR", "SAR"]:
-        	# Check if there are at least two items on the stack and if they are bytes
-			if len(self.pushed) >= 2 and isinstance(self.pushed[-1], bytes) and isinstance(self.pushed[-2], bytes):
-				lhs_u = int.from_bytes(self.pushed[-1], "big", signed=False)
-				rhs_u = int.from_bytes(self.pushed[-2], "big", signed=False)
-				lhs_i = int.from_bytes(self.pushed[-1], "big", signed=True)
-				rhs_i = int.from_bytes(self.pushed[-2], "big", signed=True)
-				if op.name == "ADD":
-					out_value = ((lhs_u + rhs_u) % 2**256).to_bytes(32, "big")
-				elif op.name == "MUL":
-					out_value = ((lhs_u * rhs_u) % 2**256).to_bytes(32, "big")
-				elif op.name == "SUB":
-					out_value = ((lhs_u - rhs_u) % 2**256).to_bytes(32, "big")
-				elif op.name == "DIV":
-					if rhs_u == 0:
-						out_value = (0).to_bytes(32, "big")
-					else:
-						out_value = (lhs_u // rhs_u).to_bytes(32, "big")
-				elif op.name == "SDIV":
+		if opcode == NOT:
+			# Check if there is at least one item on the stack and if it is a literal
+			if len(pushed) >= 1 and is_literal(pushed[-1]):
+				out_value = pushed[-1] ^ MAX_VALUE
+		elif opcode in BINARY_OPS:
+			# Check if there are at least two items on the stack and if they are literals
+			if len(pushed) >= 2 and is_literal(pushed[-1]) and is_literal(pushed[-2]):
+				lhs_u = pushed[-1]
+				rhs_u = pushed[-2]
+				if opcode == ADD:
+					out_value = (lhs_u + rhs_u) & MAX_VALUE
+				elif opcode == MUL:
+					out_value = (lhs_u * rhs_u) & MAX_VALUE
+				elif opcode == SUB:
+					out_value = (lhs_u - rhs_u) & MAX_VALUE
+				elif opcode == DIV:
+					out_value = lhs_u // rhs_u if rhs_u != 0 else 0
+				elif opcode == SDIV:
+					lhs_i, rhs_i = signed(lhs_u), signed(rhs_u)
 					if rhs_i == 0:
-						out_value = (0).to_bytes(32, "big", signed=True)
+						out_value = 0
 					elif lhs_i == (-2 ** 255) and rhs_i == -1:
-						out_value = (-2 ** 255).to_bytes(32, "big", signed=True)
+						out_value = lhs_u
 					else:
-						out_value = (lhs_i // rhs_i).to_bytes(32, "big", signed=True)
-				elif op.name == "MOD":
-					if rhs_u == 0:
-						out_value = (0).to_bytes(32, "big")
+						out_value = (lhs_i // rhs_i) & MAX_VALUE
+				elif opcode == MOD:
+					out_value = lhs_u % rhs_u if rhs_u != 0 else 0
+				elif opcode == SMOD:
+					lhs_i, rhs_i = signed(lhs_u), signed(rhs_u)
+					out_value = (lhs_i % rhs_i) & MAX_VALUE if rhs_i != 0 else 0
+				elif opcode == EXP:
+					out_value = pow(lhs_u, rhs_u, 2**256)
+				elif opcode == SIGNEXTEND:
+					# Extend the sign bit of the (lhs_u+1)-th lowest byte to all higher bits
+					if lhs_u < 31:
+						sign_bit = 8 * lhs_u + 7
+						low_mask = (1 << sign_bit) - 1
+						out_value = rhs_u | (MAX_VALUE ^ low_mask) if (rhs_u >> sign_bit) & 1 else rhs_u & low_mask
 					else:
-						out_value = (lhs_u % rhs_u).to_bytes(32, "big")
-				elif op.name == "SMOD":
-					if rhs_i == 0:
-						out_value = (0).to_bytes(32, "big")
-					else:
-						out_value = (lhs_i % rhs_i).to_bytes(32, "big", signed=True)
-				elif op.name == "EXP":
-					out_value = pow(lhs_u, rhs_u, 2**256).to_bytes(32, "big")
-				elif op.name == "SIGNEXTEND":
-					out_value = 0
-					for i in range(0,256):
-						if i <= (256-8*(lhs_u+1)):
-							out_value += ((rhs_u >> (255-(256-8*(lhs_u+1)))) & 1) << (255 - i)
-						else:
-							out_value += ((rhs_u >> (255-i)) & 1) << (255 - i)
-					out_value = out_value.to_bytes(32, "big")
-				elif op.name == "AND":
-					out_value = (lhs_u & rhs_u).to_bytes(32, "big")
-				elif op.name == "OR":
-					out_value = (lhs_u | rhs_u).to_bytes(32, "big")
-				elif op.name == "XOR":
-					out_value = (lhs_u ^ rhs_u).to_bytes(32, "big")
-				elif op.name == "BYTE":
-					if lhs_u < 32:
-						out_value = rhs_u[lhs_u].to_bytes(32, "big")
-					else:
-						out_value = (0).to_bytes(32, "big")
-				elif op.name == "SHL":
-					if lhs_u > 256:
-						out_value = (0).to_bytes(32, "big")
-					else:
-						out_value = ((rhs_u << lhs_u) % 2**256).to_bytes(32, "big")
-				elif op.name == "SHR":
-					out_value = (rhs_u >> lhs_u).to_bytes(32, "big")
-				elif op.name == "SAR":
-					if lhs_u > 255:
-						out_value = (0).to_bytes(32, "big")
-					else:
-						out_value = (rhs_i // 2**lhs_u).to_bytes(32, "big", signed=True)
+						out_value = rhs_u
+				elif opcode == AND:
+					out_value = lhs_u & rhs_u
+				elif opcode == OR:
+					out_value = lhs_u | rhs_u
+				elif opcode == XOR:
+					out_value = lhs_u ^ rhs_u
+				elif opcode == BYTE:
+					# The lhs_u-th byte, counted from the most significant one
+					out_value = (rhs_u >> (248 - 8 * lhs_u)) & 0xff if lhs_u < 32 else 0
+				elif opcode == SHL:
+					out_value = (rhs_u << lhs_u) & MAX_VALUE if lhs_u < 256 else 0
+				elif opcode == SHR:
+					out_value = rhs_u >> lhs_u if lhs_u < 256 else 0
+				elif opcode == SAR:
+					# Shifting a negative value all the way leaves -1, a positive one 0
+					out_value = (signed(rhs_u) >> min(lhs_u, 255)) & MAX_VALUE
 		# 3-parameter operations
-		elif op.name in ["ADDMOD", "MULMOD"]:
-			# Check if the last 3 items on the pushed stack are bytes
-			if len(self.pushed) >= 3 and isinstance(self.pushed[-1], bytes) and isinstance(self.pushed[-2], bytes) and isinstance(self.pushed[-3], bytes):
-				# Convert the bytes to integers
-				a = int.from_bytes(self.pushed[-1], "big", signed=False)
-				b = int.from_bytes(self.pushed[-2], "big", signed=False)
-				c = int.from_bytes(self.pushed[-3], "big", signed=False)
-				if op.name == "ADDMOD":
-					# Perform the ADDMOD operation and convert the result back to bytes
-					if c == 0:
-						out_value = (0).to_bytes(32, "big")
-					else:
-						out_value = ((a+b) % c).to_bytes(32, "big")
-				elif op.name == "MULMOD":
-					# Perform the MULMOD operation and convert the result back to bytes					
-					if c == 0:
-						out_value = (0).to_bytes(32, "big")
-					else:
-						out_value = ((a*b) % c).to_bytes(32, "big")
+		elif opcode in TERNARY_OPS:
+			# Check if the last 3 items on the pushed stack are literals
+			if len(pushed) >= 3 and is_literal(pushed[-1]) and is_literal(pushed[-2]) and is_literal(pushed[-3]):
+				a = pushed[-1]
+				b = pushed[-2]
+				c = pushed[-3]
+				if c == 0:
+					out_value = 0
+				elif opcode == ADDMOD:
+					out_value = (a+b) % c
+				elif opcode == MULMOD:
+					out_value = (a*b) % c
 		
 		# Remove the items that were used for the operation
 		for x in range(pops):
@@ -229,29 +285,88 @@ class StackMapping:
 			assert pushes == 1
 			self.push(out_value, op_idx)
 	
-	# Modifies the given `stack` as if the operations this `StackMapping` has been created with have been executed.
-	# If the `stack` is shorter than what the operations are accessing, this is not an error and just means that we don't know what those values are.
-	def apply_mapping(self, stack):
-		# Check if the stack is shorter than the number of items being popped
-		if len(stack) < self.num_poped:
-       		# Backfill the stack with None to match the number of items being popped
-			my_stack = stack.copy()
-			for x in range(self.num_poped - len(stack)):
-				my_stack.insert(0, None)
+	# Modifies the given `stack` in the `SharedStacks` table as if the operations this `StackMapping` has been created with
+	# have been executed. Returns the resulting stack in the same table. If the `stack` is shorter than what the operations
+	# are accessing, this is not an error and just means that we don't know what those values are.
+	def apply_shared(self, stacks, stack):
+		num_poped = self.num_poped
+		# The items pushed by the operations are placed on what remains of the stack after the pops. Operations that
+		# don't pop anything start from an empty stack, as the original path enumeration did with `stack[:-0]`.
+		if num_poped == 0:
+			new_stack = stacks.EMPTY
 		else:
-			my_stack = stack
-    	# Remove the old values that are being popped by the operations
-		new_stack = my_stack[:-self.num_poped]
-    	# Insert new values that are being pushed by the operations
+			new_stack = stacks.pop(stack, num_poped)
 		for item in self.pushed:
-			if isinstance(item, int):
-            	# Check if the back-referenced item is available on the stack
-				if len(my_stack) >= item + 1:
-					new_stack.append(my_stack[-item-1])
-				else:
-					new_stack.append(None)
-			else:
-            	# Add the pushed item (literal value or None) to the new stack
-				new_stack.append(item)
+			if is_back_reference(item):
+				# A back-referenced item that isn't on the stack is unknown
+				item = stacks.peek(stack, back_reference_index(item))
+			new_stack = stacks.push(new_stack, item)
 		return new_stack
 
+# The stack mapping of `code`. Byte-identical blocks are common, both within a contract and across contracts, so
+# mappings are shared between them and must not be modified.
+@lru_cache(maxsize=CACHE_SIZE)
+def stack_mapping(code):
+	return StackMapping(code)
+
+# Table of persistent stacks for the exploration. Every stack is an int identifying an entry of the table, pushing a
+# value onto a stack creates a new entry that shares the existing one as its tail, so stacks are never copied.
+# Entries are unique per (tail, value), which makes two stacks equal exactly if they have the same id, so stacks
+# can be compared and hashed in constant time.
+class SharedStacks:
+	__slots__ = ("values", "tails", "depths", "entries")
+
+	# The empty stack
+	EMPTY = 0
+
+	def __init__(self):
+		# The topmost value, the rest of the stack and the number of items of each stack
+		self.values = [None]
+		self.tails = [None]
+		self.depths = [0]
+		# Stack id of each (tail, value) pair
+		self.entries = {}
+
+	def push(self, stack, value):
+		key = (stack, value)
+		new_stack = self.entries.get(key)
+		if new_stack is None:
+			new_stack = len(self.values)
+			self.entries[key] = new_stack
+			self.values.append(value)
+			self.tails.append(stack)
+			self.depths.append(self.depths[stack] + 1)
+		return new_stack
+
+	# The stack with the `n` topmost items removed, the empty stack if it has no more than `n` items
+	def pop(self, stack, n):
+		if n >= self.depths[stack]:
+			return self.EMPTY
+		for _ in range(n):
+			stack = self.tails[stack]
+		return stack
+
+	# The `index`-th item from the top of the stack (0 is the topmost one), None if the stack isn't that deep
+	def peek(self, stack, index):
+		if index >= self.depths[stack]:
+			return None
+		for _ in range(index):
+			stack = self.tails[stack]
+		return self.values[stack]
+
+	def depth(self, stack):
+		return self.depths[stack]
+
+	# The stack as a tuple, from the bottom to the top
+	def as_tuple(self, stack):
+		values = []
+		while stack != self.EMPTY:
+			values.append(self.values[stack])
+			stack = self.tails[stack]
+		return tuple(reversed(values))
+
+	def from_values(self, values):
+		stack = self.EMPTY
+		for value in values:
+			stack = self.push(stack, value)
+		return stack
@@ -1,91 +1,82 @@
-import gvgen
+import networkx as nx
+from utils.exploration import explore
 
 
-# Walk the control flow graph to discover all possible edges.
-# In cases where we can't determine the jump destination,
-# the jump is considered to go to a special "[anywhere]" block
-def generate_graph(blocks):
-	known_edges = []
+# Header gvgen used to write, kept so that exported graphs stay byte-for-byte the same
+DOT_HEADER = "/* Generated by GvGen v.1.0 (https://www.github.com/stricaud/gvgen) */\n\ndigraph G {\ncompound=true;\n"
+
+def _dot_escape(text):
+	return text.replace("\\", "\\\\").replace('"', '\\"')
+
+# Write the graph of the given basic blocks in .dot format to the file-like object `file`, using the edges found by
+# `exploration.explore`. Edges whose jump destination can't be determined go to a special "[anywhere]" block.
+# The graph is written node by node, so it is never held in memory as a whole and `file` can be any stream.
+def write_dot(blocks, file, exploration=None):
+	if exploration is None:
+		exploration = explore(blocks)
+	known_edges = exploration.known_edges
+	anywhere_edges = exploration.anywhere_edges
+	
+	file.write(DOT_HEADER)
 	
-    # Blocks that have an outgoing edge to the "[anywhere]" block.
-	anywhere_edges = []
+	# Nodes are numbered from 1 in the order in which they are written, a node for edges going to [anywhere] comes
+	# first if necessary
+	node_ids = {}
+	if len(anywhere_edges) > 0:
+		anywhere = len(node_ids) + 1
+		file.write('   node%d [label="[anywhere]"];\n' % anywhere)
 	
-    # List of execution paths that we have already explored or that are registered to be explored in `exe_paths`
-	registered_paths = [[blocks[0]]]
+	# Create a node for each block in the graph
+	first_id = 2 if len(anywhere_edges) > 0 else 1
+	for node_id, (offset, block) in enumerate(blocks.items(), first_id):
+		node_ids[offset] = node_id
+		file.write('   node%d [label="# %s\n' % (node_id, hex(block.start_addr)))
+		file.writelines(_dot_escape(token) for token in block.tokens())
+		file.write('"];\n')
 	
-    # List of possible execution paths to be explored. Each execution path consists of the known stack and the list of visited blocks.
-	exe_paths = [([],[blocks[0]])]
+	# Edges are written grouped by their source node, each group in the order in which the edges were found, with
+	# the edges to [anywhere] first
+	outgoing = {}
+	for block in anywhere_edges:
+		outgoing.setdefault(block.start_addr, []).append(anywhere)
+	for from_block, to_block in known_edges:
+		outgoing.setdefault(from_block.start_addr, []).append(node_ids[to_block.start_addr])
 	
-    # Add an outgoing edge to `a` if it doesn't have one already
-	def new_edge_to_anywhere(a, existing):
-		if not a in existing:
-			anywhere_edges.append(a)
+	for offset in blocks:
+		for target in outgoing.get(offset, []):
+			file.write("node%d->node%d;\n" % (node_ids[offset], target))
 	
-	# Create a new path based on the given `path` and the block `b`.
-	def try_new_edge(path, b, edges, exe_paths, stack):
-    	# Add the corresponding edge to the graph if it doesn't exist yet.
-		if not (path[-1], b) in edges:
-			edges.append((path[-1],b))
+	file.write("}\n")
 
-		# Check for recursive situations
-		if b in path:
-        	# If we are in a recursive situation, continue the analysis without making assumptions about the stack contents
-			if not [b] in registered_paths:
-				registered_paths.append([b])
-				exe_paths.append(([],[b]))
-			return
-		
-    	# Create a copy of the path to avoid modifying the original reference
-		new_path = path.copy()
-		new_path.append(b)
-		
-   		 # Register the new path for further exploration if it hasn't been explored yet.
-		if not new_path in registered_paths:
-			registered_paths.append(new_path)
-			new_stack = path[-1].stack_mapping.apply_mapping(stack)
-			exe_paths.append((new_stack, new_path))
-	
-	# Explore all possible paths
-	while len(exe_paths) > 0:
-    	# Take the next path for analysis
-		stack, path = exe_paths.pop()
-		block = path[-1]
-    	# If the block can perform a jump, determine the jump destination
-		if block.can_jump:
-			if block.jump_dest != None:
-				try_new_edge(path, blocks[block.jump_dest], known_edges, exe_paths, stack)
-			elif block.jump_dest_stack_index != None and block.jump_dest_stack_index + 1 <= len(stack):
-				# If the jump destination is not known, but there's a reference to a stack item, check if we have the value
-				if stack[-block.jump_dest_stack_index-1] != None:
-					# If we do, we have our jump destination
-					try_new_edge(path, blocks[int.from_bytes(stack[-block.jump_dest_stack_index-1], "big")], known_edges, exe_paths, stack)
-				else:
-					new_edge_to_anywhere(block, anywhere_edges)
-			else:
-				new_edge_to_anywhere(block, anywhere_edges)
 
-   		# Check if the block can fall through, and if the fall through address is valid
-		if block.can_falltrough and blocks.get(block.falltrough_addr) != None:
-			try_new_edge(path, blocks[block.falltrough_addr], known_edges, exe_paths, stack)
+# Build the same graph as `write_dot`, but directly as a networkx graph. This is what `infer_models.load_file`
+# produces when reading the .dot file back: nodes are numbered consecutively in the order in which they are
+# written to the .dot file and carry the block text as their "label".
+def generate_networkx(blocks, exploration=None):
+	if exploration is None:
+		exploration = explore(blocks)
 	
-	# Create the graph from the collected data
-	g = gvgen.GvGen()
+	G = nx.DiGraph()
 	
-	# Create a node for edges going to [anywhere] if necessary
-	if len(anywhere_edges) > 0:
-		anywhere = g.newItem("[anywhere]")
+	# The [anywhere] node comes first, if there is one
+	if len(exploration.anywhere_edges) > 0:
+		anywhere = len(G)
+		G.add_node(anywhere, label="[anywhere]")
 	
-	# Create a node for each block in the graph
-	graph_blocks = {}
+	node_ids = {}
 	for offset, block in blocks.items():
-		graph_blocks[offset] = g.newItem(block.as_text())
+		node_ids[offset] = len(G)
+		G.add_node(node_ids[offset], label=block.as_text())
 	
-	# Add edges to [anywhere] if necessary
-	for block in anywhere_edges:
-		g.newLink(graph_blocks[block.start_addr], anywhere)
+	# Graphviz hands out the edges of each node ordered by the position of their target node
+	outgoing = {}
+	for block in exploration.anywhere_edges:
+		outgoing.setdefault(block.start_addr, []).append(anywhere)
+	for from_block, to_block in exploration.known_edges:
+		outgoing.setdefault(from_block.start_addr, []).append(node_ids[to_block.start_addr])
 	
-	# Add regular edges
-	for from_block, to_block in known_edges:
-		g.newLink(graph_blocks[from_block.start_addr], graph_blocks[to_block.start_addr])
+	for offset in blocks:
+		for target in sorted(outgoing.get(offset, [])):
+			G.add_edge(node_ids[offset], target)
 	
-	return g
+	return G